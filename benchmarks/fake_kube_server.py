@@ -0,0 +1,460 @@
+import copy
+import json
+import time
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+TICK_SECONDS = 0.05
+TASK_LABEL = 'opereto_pid'
+
+KINDS = {
+    'pods': ('v1', 'Pod'),
+    'configmaps': ('v1', 'ConfigMap'),
+    'events': ('v1', 'Event'),
+    'statefulsets': ('apps/v1', 'StatefulSet'),
+    'jobs': ('batch/v1', 'Job')
+}
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def _merge(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+def _match_labels(obj, selector):
+    labels = obj['metadata'].get('labels') or {}
+    for requirement in [r.strip() for r in (selector or '').split(',') if r.strip()]:
+        if '!=' in requirement:
+            key, value = requirement.split('!=', 1)
+            if labels.get(key) == value:
+                return False
+        elif '=' in requirement:
+            key, value = requirement.replace('==', '=').split('=', 1)
+            if labels.get(key) != value:
+                return False
+        elif requirement.startswith('!'):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+def _match_fields(obj, selector):
+    for requirement in [r.strip() for r in (selector or '').split(',') if r.strip()]:
+        path, value = requirement.split('=', 1)
+        current = obj
+        for part in path.split('.'):
+            current = current.get(part) if isinstance(current, dict) else None
+        if current != value:
+            return False
+    return True
+
+
+class FakeCluster(object):
+    """
+    In-memory cluster state with a minimal pod lifecycle, stateful set and indexed job controllers.
+    Pods labeled with opereto_pid (task pods) terminate successfully after pod_run_time seconds, all other
+    pods (workers) keep running until deleted.
+    """
+
+    def __init__(self, schedule_delay=0.2, start_delay=0.3, pod_run_time=1.0):
+        self.schedule_delay = schedule_delay
+        self.start_delay = start_delay
+        self.pod_run_time = pod_run_time
+        self.objects = {}
+        self.events = []
+        self.resource_version = 0
+        self.condition = threading.Condition()
+        self.request_counts = {}
+        self.stopped = False
+        self.ticker = threading.Thread(target=self._tick, name='fake-cluster-ticker')
+        self.ticker.daemon = True
+        self.ticker.start()
+
+    def count_request(self, verb, kind):
+        with self.condition:
+            key = '{} {}'.format(verb, kind)
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def total_requests(self):
+        with self.condition:
+            return sum(self.request_counts.values())
+
+    def _emit(self, event_type, kind, obj):
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.events.append((self.resource_version, event_type, kind, copy.deepcopy(obj)))
+        if len(self.events) > 100000:
+            del self.events[:50000]
+        self.condition.notify_all()
+
+    def list(self, kind, namespace, label_selector=None, field_selector=None):
+        with self.condition:
+            items = [copy.deepcopy(obj) for (k, ns, name), obj in sorted(self.objects.items())
+                     if k == kind and ns == namespace and _match_labels(obj, label_selector) and _match_fields(obj, field_selector)]
+            return items, str(self.resource_version)
+
+    def get(self, kind, namespace, name):
+        with self.condition:
+            obj = self.objects.get((kind, namespace, name))
+            return copy.deepcopy(obj) if obj is not None else None
+
+    def create(self, kind, namespace, obj):
+        with self.condition:
+            name = obj['metadata']['name']
+            if (kind, namespace, name) in self.objects:
+                return None
+            api_version, object_kind = KINDS[kind]
+            obj.update({'apiVersion': api_version, 'kind': object_kind})
+            obj['metadata'].update({'namespace': namespace, 'creationTimestamp': _now(), 'uid': '{}-{}'.format(name, time.time())})
+            if kind == 'pods':
+                obj['status'] = {'phase': 'Pending', 'conditions': []}
+                obj['_created'] = time.time()
+            elif kind == 'statefulsets':
+                obj['spec'].setdefault('serviceName', '')
+                obj['status'] = {'replicas': 0, 'readyReplicas': 0, 'updatedReplicas': 0, 'currentReplicas': 0}
+            elif kind == 'jobs':
+                obj['status'] = {'active': 0, 'succeeded': 0, 'failed': 0}
+            self.objects[(kind, namespace, name)] = obj
+            self._emit('ADDED', kind, obj)
+            if kind == 'statefulsets':
+                self._reconcile_stateful_set(namespace, obj)
+            elif kind == 'jobs':
+                self._reconcile_job(namespace, obj)
+            return copy.deepcopy(obj)
+
+    def patch(self, kind, namespace, name, patch):
+        with self.condition:
+            obj = self.objects.get((kind, namespace, name))
+            if obj is None:
+                return None, 404
+            expected_version = (patch.get('metadata') or {}).pop('resourceVersion', None)
+            if expected_version is not None and expected_version != obj['metadata']['resourceVersion']:
+                return None, 409
+            _merge(obj, patch)
+            self._emit('MODIFIED', kind, obj)
+            if kind == 'statefulsets':
+                self._reconcile_stateful_set(namespace, obj)
+            return copy.deepcopy(obj), 200
+
+    def delete(self, kind, namespace, name):
+        with self.condition:
+            obj = self.objects.pop((kind, namespace, name), None)
+            if obj is None:
+                return None
+            self._emit('DELETED', kind, obj)
+            if kind == 'statefulsets':
+                for pod in self._owned_pods(namespace, 'statefulset', name):
+                    self.delete('pods', namespace, pod['metadata']['name'])
+            elif kind == 'jobs':
+                for pod in self._owned_pods(namespace, 'job', name):
+                    self.delete('pods', namespace, pod['metadata']['name'])
+            return copy.deepcopy(obj)
+
+    def delete_collection(self, kind, namespace, label_selector=None):
+        items, resource_version = self.list(kind, namespace, label_selector=label_selector)
+        for item in items:
+            self.delete(kind, namespace, item['metadata']['name'])
+        return items
+
+    def _owned_pods(self, namespace, owner_kind, owner_name):
+        return [obj for (k, ns, name), obj in list(self.objects.items())
+                if k == 'pods' and ns == namespace and obj.get('_owner') == (owner_kind, owner_name)]
+
+    def _new_pod(self, namespace, name, template, owner, annotations=None, labels=None):
+        pod = {
+            'metadata': {
+                'name': name,
+                'labels': dict(template.get('metadata', {}).get('labels') or {}, **(labels or {})),
+                'annotations': dict(annotations or {})
+            },
+            'spec': copy.deepcopy(template['spec'])
+        }
+        self.create('pods', namespace, pod)
+        self.objects[('pods', namespace, name)]['_owner'] = owner
+
+    def _reconcile_stateful_set(self, namespace, stateful_set):
+        name = stateful_set['metadata']['name']
+        replicas = stateful_set['spec'].get('replicas', 1)
+        existing = dict((pod['metadata']['name'], pod) for pod in self._owned_pods(namespace, 'statefulset', name))
+        for index in range(replicas):
+            pod_name = '{}-{}'.format(name, index)
+            if pod_name not in existing:
+                self._new_pod(namespace, pod_name, stateful_set['spec']['template'], ('statefulset', name))
+        for pod_name in existing:
+            if int(pod_name.rsplit('-', 1)[1]) >= replicas:
+                self.delete('pods', namespace, pod_name)
+
+    def _reconcile_job(self, namespace, job):
+        name = job['metadata']['name']
+        for index in range(job['spec'].get('completions', 1)):
+            self._new_pod(namespace, '{}-{}'.format(name, index), job['spec']['template'], ('job', name),
+                          annotations={'batch.kubernetes.io/job-completion-index': str(index)}, labels={'job-name': name})
+
+    def _container_statuses(self, pod, state):
+        return [{
+            'name': container['name'],
+            'image': container.get('image', ''),
+            'imageID': '',
+            'ready': 'running' in state,
+            'restartCount': 0,
+            'state': copy.deepcopy(state)
+        } for container in pod['spec']['containers']]
+
+    def _progress_pod(self, key, pod):
+        age = time.time() - pod['_created']
+        status = pod['status']
+        is_task = TASK_LABEL in (pod['metadata'].get('labels') or {}) or pod.get('_owner', ('', ''))[0] == 'job'
+        if status['phase'] == 'Pending' and not status['conditions'] and age >= self.schedule_delay:
+            status['conditions'] = [{'type': 'PodScheduled', 'status': 'True', 'lastTransitionTime': _now()}]
+            return True
+        if status['phase'] == 'Pending' and age >= self.schedule_delay + self.start_delay:
+            status.update({
+                'phase': 'Running',
+                'startTime': _now(),
+                'conditions': status['conditions'] + [{'type': 'Ready', 'status': 'True', 'lastTransitionTime': _now()}],
+                'containerStatuses': self._container_statuses(pod, {'running': {'startedAt': _now()}})
+            })
+            return True
+        if status['phase'] == 'Running' and is_task and age >= self.schedule_delay + self.start_delay + self.pod_run_time:
+            status.update({
+                'phase': 'Succeeded',
+                'conditions': [condition for condition in status['conditions'] if condition['type'] != 'Ready'],
+                'containerStatuses': self._container_statuses(pod, {'terminated': {'exitCode': 0, 'reason': 'Completed', 'finishedAt': _now()}})
+            })
+            return True
+        return False
+
+    def _update_owners(self):
+        for (kind, namespace, name), obj in list(self.objects.items()):
+            if kind == 'statefulsets':
+                pods = self._owned_pods(namespace, 'statefulset', name)
+                status = {
+                    'replicas': len(pods),
+                    'currentReplicas': len(pods),
+                    'updatedReplicas': len(pods),
+                    'readyReplicas': len([pod for pod in pods if pod['status']['phase'] == 'Running'])
+                }
+            elif kind == 'jobs':
+                pods = self._owned_pods(namespace, 'job', name)
+                status = {
+                    'active': len([pod for pod in pods if pod['status']['phase'] in ['Pending', 'Running']]),
+                    'succeeded': len([pod for pod in pods if pod['status']['phase'] == 'Succeeded']),
+                    'failed': len([pod for pod in pods if pod['status']['phase'] == 'Failed'])
+                }
+            else:
+                continue
+            if any(obj['status'].get(key) != value for key, value in status.items()):
+                obj['status'].update(status)
+                self._emit('MODIFIED', kind, obj)
+
+    def _tick(self):
+        while not self.stopped:
+            with self.condition:
+                for key, obj in list(self.objects.items()):
+                    if key[0] == 'pods' and self._progress_pod(key, obj):
+                        self._emit('MODIFIED', 'pods', obj)
+                self._update_owners()
+            time.sleep(TICK_SECONDS)
+
+    def watch(self, kind, namespace, resource_version, label_selector, field_selector, timeout):
+        """
+        Yields the events of the given kind newer than resource_version until the timeout.
+        """
+        deadline = time.time() + timeout
+        last_version = int(resource_version or 0)
+        while time.time() < deadline and not self.stopped:
+            with self.condition:
+                pending = [(version, event_type, obj) for version, event_type, event_kind, obj in self.events
+                           if version > last_version and event_kind == kind and obj['metadata'].get('namespace') == namespace]
+                if not pending:
+                    self.condition.wait(min(1.0, max(deadline - time.time(), 0.01)))
+                    continue
+            for version, event_type, obj in pending:
+                last_version = version
+                if _match_labels(obj, label_selector) and _match_fields(obj, field_selector):
+                    yield event_type, obj
+
+    def pod_finished(self, namespace, name):
+        pod = self.get('pods', namespace, name)
+        return pod is None or pod['status']['phase'] in ['Succeeded', 'Failed']
+
+
+def _public(obj):
+    return dict((key, value) for key, value in obj.items() if not key.startswith('_'))
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    cluster = None
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        parts = [part for part in url.path.split('/') if part]
+        ## /api/v1/namespaces/<ns>/<kind>[/<name>[/<sub>]] or /apis/<group>/<version>/namespaces/<ns>/...
+        if parts[:1] == ['api']:
+            parts = parts[2:]
+        elif parts[:1] == ['apis']:
+            parts = parts[3:]
+        if len(parts) < 3 or parts[0] != 'namespaces':
+            return None
+        namespace, kind = parts[1], parts[2]
+        name = parts[3] if len(parts) > 3 else None
+        sub = parts[4] if len(parts) > 4 else None
+        return namespace, kind, name, sub, query
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _send(self, code, payload, content_type='application/json'):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _status(self, code, reason):
+        self._send(code, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': code, 'reason': reason, 'message': reason})
+
+    def _start_stream(self, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _request(self, verb):
+        ## the body is always consumed to keep the connection usable (e.g. delete options)
+        body = self._body()
+        parsed = self._parse()
+        if parsed is None:
+            return self._status(404, 'NotFound')
+        namespace, kind, name, sub, query = parsed
+        if kind not in KINDS:
+            return self._status(404, 'NotFound')
+        watching = query.get('watch') in ['true', 'True', '1']
+        self.cluster.count_request('watch' if watching else verb, kind + ('/'+sub if sub else ''))
+        if self.latency:
+            time.sleep(self.latency)
+
+        if verb == 'get' and name is None and watching:
+            return self._watch(namespace, kind, query)
+        if verb == 'get' and name is None:
+            items, resource_version = self.cluster.list(kind, namespace, query.get('labelSelector'), query.get('fieldSelector'))
+            return self._send(200, {'kind': KINDS[kind][1]+'List', 'apiVersion': KINDS[kind][0],
+                                    'metadata': {'resourceVersion': resource_version}, 'items': [_public(item) for item in items]})
+        if verb == 'get' and sub == 'log':
+            return self._log(namespace, name, query)
+        if verb == 'get':
+            obj = self.cluster.get(kind, namespace, name)
+            return self._send(200, _public(obj)) if obj is not None else self._status(404, 'NotFound')
+        if verb == 'post':
+            obj = self.cluster.create(kind, namespace, body)
+            return self._send(201, _public(obj)) if obj is not None else self._status(409, 'AlreadyExists')
+        if verb in ['patch', 'put']:
+            obj, code = self.cluster.patch(kind, namespace, name, body)
+            return self._send(200, _public(obj)) if obj is not None else self._status(code, 'NotFound' if code == 404 else 'Conflict')
+        if verb == 'delete' and name is None:
+            items = self.cluster.delete_collection(kind, namespace, query.get('labelSelector'))
+            return self._send(200, {'kind': KINDS[kind][1]+'List', 'apiVersion': KINDS[kind][0], 'metadata': {},
+                                    'items': [_public(item) for item in items]})
+        if verb == 'delete':
+            obj = self.cluster.delete(kind, namespace, name)
+            return self._send(200, _public(obj)) if obj is not None else self._status(404, 'NotFound')
+        return self._status(405, 'MethodNotAllowed')
+
+    def _watch(self, namespace, kind, query):
+        self._start_stream()
+        try:
+            for event_type, obj in self.cluster.watch(kind, namespace, query.get('resourceVersion'), query.get('labelSelector'),
+                                                      query.get('fieldSelector'), float(query.get('timeoutSeconds') or 60)):
+                self._chunk(json.dumps({'type': event_type, 'object': _public(obj)}).encode('utf-8') + b'\n')
+            self._chunk(b'')
+        except (IOError, OSError):
+            pass
+
+    def _log(self, namespace, name, query):
+        if query.get('follow') not in ['true', 'True', '1']:
+            return self._send(200, b'fake log line\n', content_type='text/plain')
+        self._start_stream('text/plain')
+        try:
+            line = 0
+            while not self.cluster.pod_finished(namespace, name):
+                self._chunk('fake log line {}\n'.format(line).encode('utf-8'))
+                line += 1
+                time.sleep(0.2)
+            self._chunk(b'')
+        except (IOError, OSError):
+            pass
+
+    def do_GET(self):
+        self._request('get')
+
+    def do_POST(self):
+        self._request('post')
+
+    def do_PATCH(self):
+        self._request('patch')
+
+    def do_PUT(self):
+        self._request('put')
+
+    def do_DELETE(self):
+        self._request('delete')
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeKubernetesServer(object):
+    """
+    Serves a FakeCluster over HTTP on a local port, with an optional fixed latency added to every request.
+    """
+
+    def __init__(self, cluster=None, latency=0.0, port=0):
+        self.cluster = cluster or FakeCluster()
+        handler = type('Handler', (FakeApiHandler,), {'cluster': self.cluster, 'latency': latency})
+        self.server = ThreadingServer(('127.0.0.1', port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-kubernetes-server')
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.cluster.stopped = True
+        self.server.shutdown()
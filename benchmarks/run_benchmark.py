@@ -0,0 +1,318 @@
+"""
+Runs the service lifecycles against a local fake Kubernetes API server and reports throughput, latency
+percentiles and API calls per task. The services are driven in-process with a stub Opereto client, so the
+numbers reflect the orchestration code (API round trips, watches, polling) rather than a real cluster.
+
+Example:
+    python benchmarks/run_benchmark.py --service kubernetes_task_runner --tasks 50 --concurrency 10 --latency 0.01
+"""
+import os
+import sys
+import imp
+import copy
+import json
+import time
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICES_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'services')
+sys.path.insert(0, SERVICES_DIR)
+
+from kubernetes import client as kubernetes_client
+from kubernetes_api import use_configuration, set_rate_limit, api_metrics
+from fake_kube_server import FakeCluster, FakeKubernetesServer
+from stub_opereto import StubOperetoClient
+
+TASK_POD_TEMPLATE = {
+    "apiVersion": "v1",
+    "kind": "Pod",
+    "metadata": {
+        "name": "benchmark-task"
+    },
+    "spec": {
+        "restartPolicy": "Never",
+        "containers": [
+            {
+                "name": "benchmark-task",
+                "image": "busybox",
+                "command": ["sh", "-c", "echo done"]
+            }
+        ]
+    }
+}
+
+WORKER_POD_TEMPLATE = {
+    "apiVersion": "v1",
+    "kind": "Pod",
+    "metadata": {
+        "name": "benchmark-worker"
+    },
+    "spec": {
+        "containers": [
+            {
+                "name": "benchmark-worker-worker",
+                "image": "opereto/worker"
+            }
+        ]
+    }
+}
+
+WORKER_STATEFULSET_TEMPLATE = {
+    "apiVersion": "apps/v1",
+    "kind": "StatefulSet",
+    "metadata": {
+        "name": "benchmark-workers"
+    },
+    "spec": {
+        "replicas": 3,
+        "selector": {
+            "matchLabels": {
+                "app": "benchmark-workers-cluster"
+            }
+        },
+        "template": {
+            "metadata": {
+                "labels": {
+                    "app": "benchmark-workers-cluster"
+                }
+            },
+            "spec": {
+                "containers": [
+                    {
+                        "name": "benchmark-workers-worker",
+                        "image": "opereto/worker"
+                    }
+                ]
+            }
+        }
+    }
+}
+
+
+def load_service(service_name):
+    """
+    Loads the run.py module of a service under a unique module name, with the service directory on the path
+    for its local modules.
+    """
+    service_dir = os.path.join(SERVICES_DIR, service_name)
+    if service_dir not in sys.path:
+        sys.path.insert(0, service_dir)
+    return imp.load_source('benchmark_'+service_name, os.path.join(service_dir, 'run.py'))
+
+
+def task_runner_lifecycle(module, stub_client, index, options):
+    """
+    Runs one kubernetes_task_runner task through validate, setup, run and teardown.
+    """
+
+    class BenchmarkTaskRunner(module.ServiceRunner):
+
+        def __init__(self, input):
+            self.input = input
+            self.client = stub_client
+            self.test_results_directory = '/tmp/test-results'
+            self.task_output_json = os.devnull
+            self.saved_state = {}
+
+        def _save_state(self, state):
+            self.saved_state = copy.deepcopy(state)
+
+        def _get_state(self):
+            return copy.deepcopy(self.saved_state)
+
+        def _print_step_title(self, title):
+            print(title)
+
+        def _run_parser(self, pod_name):
+            pass
+
+    template = copy.deepcopy(TASK_POD_TEMPLATE)
+    template['metadata']['name'] = 'benchmark-task-{}'.format(index)
+    runner = BenchmarkTaskRunner({
+        'pid': 'benchmark-{}'.format(index),
+        'pod_template': template,
+        'pod_config_files': [{'name': 'task-{}.yaml'.format(count), 'target': '/etc/task', 'data': {'index': index}}
+                             for count in range(options.config_files)],
+        'config_maps_mode': options.config_maps_mode,
+        'output_file_path': None,
+        'test_parser_config': None,
+        'test_results_directory': '/tmp/test-results',
+        'keep_pod_running': False,
+        'api_qps': options.api_qps,
+        'api_burst': options.api_burst,
+        'use_informers': options.use_informers,
+        'teardown_wait': options.teardown_wait
+    })
+    runner._validate_input()
+    runner._setup()
+    try:
+        return runner._run_task() == stub_client.SUCCESS
+    finally:
+        runner._teardown()
+
+
+def worker_statefulset_lifecycle(module, stub_client, index, options):
+    """
+    Creates a worker stateful set, waits for its agents and deletes it.
+    """
+    template = copy.deepcopy(WORKER_STATEFULSET_TEMPLATE)
+    template['spec']['replicas'] = options.replicas
+    base_input = {
+        'deployment_name': 'benchmark-workers-{}'.format(index),
+        'deployment_template': template,
+        'agent_java_config': '-Xms500m -Xmx500m',
+        'agent_log_level': 'info',
+        'worker_config': 'opereto-worker-config',
+        'opereto_host': 'http://localhost',
+        'agent_properties': {},
+        'post_operations': None,
+        'agents_timeout': 300
+    }
+    for operation in ['create_statefulset', 'delete_statefulset']:
+        runner = module.ServiceRunner.__new__(module.ServiceRunner)
+        runner.input = dict(copy.deepcopy(base_input), deployment_operation=operation)
+        runner.client = stub_client
+        runner.validate_input()
+        runner.setup()
+        try:
+            if runner.process() != stub_client.SUCCESS:
+                return False
+        finally:
+            runner.teardown()
+    return True
+
+
+def worker_pod_lifecycle(module, stub_client, index, options):
+    """
+    Creates a worker pod, waits for its agent, runs its post operations and deletes it.
+    """
+    base_input = {
+        'pod_name': 'benchmark-worker-{}'.format(index),
+        'pod_template': copy.deepcopy(WORKER_POD_TEMPLATE),
+        'agent_java_config': '-Xms500m -Xmx500m',
+        'agent_log_level': 'info',
+        'worker_config': 'opereto-worker-config',
+        'opereto_host': 'http://localhost',
+        'agent_properties': {},
+        'post_operations': [{'name': 'operation-{}'.format(count), 'service': 'benchmark_post_operation'}
+                            for count in range(options.post_operations)],
+        'agents_timeout': 300
+    }
+    for operation in ['create_pod', 'delete_pod']:
+        runner = module.ServiceRunner.__new__(module.ServiceRunner)
+        runner.input = dict(copy.deepcopy(base_input), pod_operation=operation)
+        runner.client = stub_client
+        runner.validate_input()
+        runner.setup()
+        try:
+            if runner.process() != stub_client.SUCCESS:
+                return False
+        finally:
+            runner.teardown()
+    return True
+
+
+LIFECYCLES = {
+    'kubernetes_task_runner': task_runner_lifecycle,
+    'dockereto_worker_pod': worker_pod_lifecycle,
+    'dockereto_worker_statefulset': worker_statefulset_lifecycle
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered)-1, int(round(fraction*(len(ordered)-1))))]
+
+
+def run_benchmark(options):
+    cluster = FakeCluster(schedule_delay=options.schedule_delay, start_delay=options.start_delay, pod_run_time=options.run_time)
+    server = FakeKubernetesServer(cluster, latency=options.latency).start()
+    configuration = kubernetes_client.Configuration()
+    configuration.host = server.url
+    use_configuration(configuration)
+    set_rate_limit(options.api_qps, options.api_burst)
+
+    module = load_service(options.service)
+    lifecycle = LIFECYCLES[options.service]
+    stub_client = StubOperetoClient(cluster)
+    results = []
+    results_lock = threading.Lock()
+
+    def _run(index):
+        start = time.time()
+        try:
+            success = lifecycle(module, stub_client, index, options)
+        except Exception as e:
+            sys.__stderr__.write('Task {} failed: {}\n'.format(index, e))
+            success = False
+        with results_lock:
+            results.append((success, time.time()-start))
+
+    stdout = sys.stdout
+    if not options.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        pool = ThreadPool(options.concurrency)
+        try:
+            pool.map(_run, range(options.tasks))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if not options.verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+    elapsed = time.time() - start
+    server.stop()
+
+    durations = [duration for success, duration in results]
+    report = {
+        'service': options.service,
+        'tasks': options.tasks,
+        'concurrency': options.concurrency,
+        'failed': len([success for success, duration in results if not success]),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_per_second': round(options.tasks/elapsed, 3) if elapsed else None,
+        'latency_p50_seconds': round(percentile(durations, 0.5), 3),
+        'latency_p99_seconds': round(percentile(durations, 0.99), 3),
+        'api_requests_per_task': round(cluster.total_requests()/float(options.tasks), 1),
+        'api_requests': cluster.request_counts,
+        'api_client_calls': api_metrics.summary()
+    }
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark service lifecycles against a fake Kubernetes API server.')
+    parser.add_argument('--service', choices=sorted(LIFECYCLES.keys()), default='kubernetes_task_runner')
+    parser.add_argument('--tasks', type=int, default=20, help='number of lifecycles to run')
+    parser.add_argument('--concurrency', type=int, default=5, help='number of lifecycles running at the same time')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--schedule-delay', type=float, default=0.2, help='seconds until a pod is scheduled')
+    parser.add_argument('--start-delay', type=float, default=0.3, help='seconds from scheduling until a pod is running')
+    parser.add_argument('--run-time', type=float, default=1.0, help='seconds a task pod runs before it succeeds')
+    parser.add_argument('--replicas', type=int, default=3, help='worker stateful set replicas')
+    parser.add_argument('--post-operations', type=int, default=2, help='post operations per worker pod')
+    parser.add_argument('--config-files', type=int, default=0, help='config files per task')
+    parser.add_argument('--config-maps-mode', choices=['per_file', 'single', 'shared_immutable'], default='per_file')
+    parser.add_argument('--api-qps', type=int, default=1000, help='client-side Kubernetes API rate limit (calls per second)')
+    parser.add_argument('--api-burst', type=int, default=1000, help='client-side Kubernetes API burst')
+    parser.add_argument('--use-informers', action='store_true', help='serve the task pod and config map reads from informers')
+    parser.add_argument('--teardown-wait', action='store_true', help='wait until the task resources are deleted')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the services output')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    report = run_benchmark(options)
+    print(json.dumps(report, indent=4, sort_keys=True))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
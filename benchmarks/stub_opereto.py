@@ -0,0 +1,70 @@
+import threading
+import uuid
+from pyopereto.client import OperetoClientError
+
+
+class StubOperetoClient(object):
+    """
+    In-process stand-in for the pyopereto client used by the services. Agents are reported online while a
+    pod with the agent name is running in the fake cluster, and processes created by post operations
+    succeed immediately.
+    """
+
+    SUCCESS = 0
+    FAILURE = 1
+
+    def __init__(self, cluster, namespace='default', process_timeout=3600):
+        self.cluster = cluster
+        self.namespace = namespace
+        self.process_timeout = process_timeout
+        self.agents = {}
+        self.processes = {}
+        self.properties = {}
+        self.lock = threading.Lock()
+
+    def _online(self, agent_id):
+        pod = self.cluster.get('pods', self.namespace, agent_id)
+        return pod is not None and pod['status']['phase'] == 'Running'
+
+    def get_process_info(self, pid=None):
+        return {'timeout': self.process_timeout}
+
+    def modify_process_property(self, key, value, pid=None):
+        with self.lock:
+            self.properties[key] = value
+
+    def get_agent(self, agent_id):
+        with self.lock:
+            if agent_id not in self.agents:
+                raise OperetoClientError('Agent {} does not exist.'.format(agent_id), code=404)
+            agent = dict(self.agents[agent_id])
+        agent['online'] = self._online(agent_id)
+        return agent
+
+    def create_agent(self, agent_id, **kwargs):
+        with self.lock:
+            self.agents[agent_id] = dict(kwargs, id=agent_id)
+
+    def modify_agent_properties(self, agent_id, properties):
+        with self.lock:
+            self.agents.setdefault(agent_id, {'id': agent_id}).setdefault('properties', {}).update(properties)
+
+    def search_agents(self, start=0, limit=100, filter=None):
+        with self.lock:
+            agent_ids = sorted(self.agents.keys())[start:start+limit]
+        return [self.get_agent(agent_id) for agent_id in agent_ids]
+
+    def create_process(self, service, agent=None, title=None, **kwargs):
+        pid = str(uuid.uuid4())
+        with self.lock:
+            self.processes[pid] = 'success'
+        return pid
+
+    def get_process_status(self, pid=None):
+        with self.lock:
+            return self.processes.get(pid, 'success')
+
+    def stop_process(self, pids, status='terminated', message=None):
+        with self.lock:
+            for pid in pids if isinstance(pids, list) else [pids]:
+                self.processes[pid] = status
@@ -2,6 +2,8 @@ import json
 import time
 from opereto.helpers.services import ServiceTemplate
 from kubernetes_api import KubernetesAPI
+from kubernetes_metrics import LifecycleTimer, emit_summary
+from dockereto_workers import ReplicaProgress, AgentReadinessTracker, PostOperationScheduler, AGENTS_READINESS_TIMEOUT
 from opereto.utils.validations import JsonSchemeValidator, included_services_scheme, validate_dict, default_variable_pattern, default_variable_name_scheme
 from opereto.exceptions import OperetoRuntimeError
 from pyopereto.client import OperetoClientError
@@ -36,6 +38,17 @@ class ServiceRunner(ServiceTemplate):
                     "type": "string",
                     "minLength": 1
                 },
+                "use_informers": {
+                    "type": ["boolean", "null"]
+                },
+                "post_operations_concurrency": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "agents_timeout": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
                 "agent_properties": {
                     "type":["object", "null"],
                     "patternProperties": {
@@ -78,18 +91,20 @@ class ServiceRunner(ServiceTemplate):
             self.client.modify_agent_properties(agent_id, agent_properties)
 
         def _agents_status(online=True):
-            while (True):
-                try:
-                    agent_attr = self.client.get_agent(self.pod_name)
-                    if agent_attr['online']==online:
-                        break
-                except OperetoClientError:
-                    pass
-                time.sleep(5)
+            progress = ReplicaProgress([self.pod_name])
+            tracker = AgentReadinessTracker(self.client, self.kubernetes_api, [self.pod_name], self.pod_name, progress=progress,
+                                            pod_field_selector='metadata.name='+self.pod_name, timeout=self.agents_timeout)
+            with self.timer.phase('agent_online' if online else 'agent_offline'):
+                stragglers = tracker.wait(online=online)
+            if stragglers:
+                print progress.render()
+                raise OperetoRuntimeError(error='Agent {} is still {} after {} seconds.'.format(
+                    self.pod_name, 'offline' if online else 'online', self.agents_timeout))
 
         def _tearrdown_pod():
             print 'Deleting worker pod..'
-            self.pod_info = self.kubernetes_api.delete_pod(self.pod_name)
+            with self.timer.phase('delete_pod'):
+                self.pod_info = self.kubernetes_api.delete_pod(self.pod_name)
             print 'Waiting that worker pod will be offline (may take some time)..'
             _agents_status(online=False)
             print 'Agent {} is offline.'.format(self.pod_name)
@@ -97,8 +112,10 @@ class ServiceRunner(ServiceTemplate):
 
         if self.pod_operation=='create_pod':
             print 'Creating worker pod..'
-            _modify_agent(self.pod_name)
-            self.kubernetes_api.create_pod(self.pod_template)
+            with self.timer.phase('agent_registration'):
+                _modify_agent(self.pod_name)
+            with self.timer.phase('pod_start'):
+                self.kubernetes_api.create_pod(self.pod_template)
             print 'Waiting that worker pod will be online (may take some time)..'
             _agents_status(online=True)
             print 'Agent {} is online.'.format(self.pod_name)
@@ -106,12 +123,15 @@ class ServiceRunner(ServiceTemplate):
             print self.pod_info.status
 
             ## run post install services
-            for service in self.input['post_operations']:
-                input = service.get('input') or {}
-                agent = service.get('agents') or self.pod_name
-                pid = self.client.create_process(service=service['service'], agent=agent, title=service.get('title'),
-                                                 **input)
-                if not self.client.is_success(pid):
+            if self.input['post_operations']:
+                scheduler = PostOperationScheduler(self.client, concurrency=self.input.get('post_operations_concurrency') or 1)
+                for index, service in enumerate(self.input['post_operations']):
+                    scheduler.add(service.get('name') or str(index), service['service'], service.get('agents') or self.pod_name,
+                                  title=service.get('title'), input=service.get('input'), depends_on=service.get('depends_on'))
+                with self.timer.phase('post_operations'):
+                    post_operations_ok = scheduler.run()
+                self.post_operations_timings = scheduler.timings()
+                if not post_operations_ok:
                     _tearrdown_pod()
                     return self.client.FAILURE
 
@@ -128,9 +148,15 @@ class ServiceRunner(ServiceTemplate):
 
         self.kubernetes_api = KubernetesAPI()
         self.pod_name = self.input['pod_name']
+        if self.input.get('use_informers') and self.pod_name:
+            ## the worker pod is read from a watch of that pod only
+            self.kubernetes_api.enable_informers(kinds=('pods',), field_selector='metadata.name='+self.pod_name)
         self.pod_operation = self.input['pod_operation']
         self.pod_info = {}
         self.pod_template = self.input['pod_template']
+        self.timer = LifecycleTimer()
+        self.post_operations_timings = {}
+        self.agents_timeout = self.input.get('agents_timeout') or AGENTS_READINESS_TIMEOUT
 
         if self.pod_operation=='create_pod':
             if self.pod_name:
@@ -177,6 +203,14 @@ class ServiceRunner(ServiceTemplate):
 
     def teardown(self):
         print self.pod_info
+        summary = self.timer.summary(self.kubernetes_api.metrics)
+        if self.post_operations_timings:
+            summary['post_operations'] = self.post_operations_timings
+        emit_summary(summary, self.input.get('metrics_export_path'))
+        try:
+            self.client.modify_process_property('worker_timings', summary)
+        except Exception as e:
+            print 'Failed to store worker timings: {}'.format(e)
 
 
 
@@ -2,6 +2,10 @@ import time
 import json
 from opereto.helpers.services import ServiceTemplate
 from kubernetes_api import KubernetesAPI
+from kubernetes_metrics import LifecycleTimer, emit_summary
+from dockereto_workers import ReplicaProgress, AgentReadinessTracker, PostOperationScheduler, RollingImageUpdate, QueueAutoscaler, \
+    register_agents, retry, AGENT_REGISTRATION_CONCURRENCY, AGENTS_READINESS_TIMEOUT, POST_OPERATIONS_CONCURRENCY, UPDATE_WAVE_SIZE, \
+    UPDATE_WAVE_TIMEOUT, AUTOSCALE_INTERVAL, AUTOSCALE_UP_COOLDOWN, AUTOSCALE_DOWN_COOLDOWN
 from opereto.utils.validations import JsonSchemeValidator, included_services_scheme, validate_dict, default_variable_pattern, default_variable_name_scheme
 from opereto.exceptions import OperetoRuntimeError
 from pyopereto.client import OperetoClientError
@@ -19,7 +23,7 @@ class ServiceRunner(ServiceTemplate):
             "type": "object",
             "properties": {
                 "deployment_operation": {
-                    "enum": ['create_statefulset', 'modify_statefulset', 'delete_statefulset', 'update_worker_image']
+                    "enum": ['create_statefulset', 'modify_statefulset', 'delete_statefulset', 'update_worker_image', 'autoscale_statefulset']
                 },
                 "deployment_name": {
                     "type": ["null", "string"]
@@ -35,6 +39,70 @@ class ServiceRunner(ServiceTemplate):
                     "type": "string",
                     "minLength": 1
                 },
+                "post_operations_concurrency": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "agents_timeout": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "worker_image": {
+                    "type": ["null", "string"]
+                },
+                "update_wave_size": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "update_wave_timeout": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "update_failure_threshold": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "update_failure_action": {
+                    "enum": ['pause', 'rollback', None]
+                },
+                "autoscale_min_replicas": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "autoscale_max_replicas": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "autoscale_processes_per_worker": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "autoscale_scale_up_cooldown": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "autoscale_scale_down_cooldown": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "autoscale_duration": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "autoscale_interval": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "autoscale_demand_filter": {
+                    "type": ["object", "null"]
+                },
+                "use_informers": {
+                    "type": ["boolean", "null"]
+                },
+                "agent_registration_concurrency": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
                 "agent_properties": {
                     "type":["object", "null"],
                     "patternProperties": {
@@ -52,6 +120,15 @@ class ServiceRunner(ServiceTemplate):
         validator = JsonSchemeValidator(self.input, input_scheme)
         validator.validate()
 
+        if self.input['deployment_operation']=='update_worker_image' and not self.input.get('worker_image'):
+            raise OperetoRuntimeError(error='Worker image must be provided to update the worker image.')
+
+        if self.input['deployment_operation']=='autoscale_statefulset':
+            if not self.input.get('autoscale_max_replicas'):
+                raise OperetoRuntimeError(error='Maximum replicas must be provided to autoscale the worker stateful set.')
+            if (self.input.get('autoscale_min_replicas') or 0) > self.input['autoscale_max_replicas']:
+                raise OperetoRuntimeError(error='Minimum replicas cannot be greater than maximum replicas.')
+
         if self.input['deployment_name']=='opereto-worker-node':
             raise OperetoRuntimeError(error='Deployment name is invalid, this name is used for Opereto standard workers. Please insert different name.')
 
@@ -70,68 +147,72 @@ class ServiceRunner(ServiceTemplate):
                 names.append(self.deployment_name+'-'+str(count))
             return names
 
-        def _modify_agent(agent_id):
-            try:
-                self.client.get_agent(agent_id)
-            except OperetoClientError:
-                self.client.create_agent(agent_id=agent_id, name=agent_id,
-                                         description='This agent worker is part of {} worker stateful set.'.format(
-                                             self.deployment_name))
-                time.sleep(2)
-            agent_properties = self.input['agent_properties']
+        def _modify_agents(agent_ids=None):
+            agent_ids = agent_ids or _get_agent_names()
+            agent_properties = dict(self.input['agent_properties'] or {})
             agent_properties.update({'opereto.shared': True, 'worker.label': self.deployment_name})
-            self.client.modify_agent_properties(agent_id, agent_properties)
-
-        def _agents_status(online=True):
-            while (True):
-                ok = True
-                for agent_id in _get_agent_names():
-                    try:
-                        agent_attr = self.client.get_agent(agent_id)
-                        if agent_attr['online']!=online:
-                            ok = False
-                            break
-                    except OperetoClientError:
-                        pass
-                if ok:
-                    break
-                time.sleep(5)
+            print 'Registering {} worker agents..'.format(len(agent_ids))
+            with self.timer.phase('agents_registration'):
+                errors = register_agents(self.client, agent_ids,
+                                         'This agent worker is part of {} worker stateful set.'.format(self.deployment_name),
+                                         agent_properties, progress=self.progress,
+                                         concurrency=self.input.get('agent_registration_concurrency') or AGENT_REGISTRATION_CONCURRENCY)
+            if errors:
+                for agent_id, error in errors.items():
+                    print 'Failed to register agent {}: {}'.format(agent_id, error)
+                raise OperetoRuntimeError(error='Failed to register {} worker agents.'.format(len(errors)))
+
+        def _agents_status(online=True, agent_ids=None):
+            tracker = AgentReadinessTracker(self.client, self.kubernetes_api, agent_ids or _get_agent_names(), self.deployment_name,
+                                            progress=self.progress, pod_label_selector='app={}-cluster'.format(self.deployment_name),
+                                            timeout=self.agents_timeout)
+            with self.timer.phase('agents_online' if online else 'agents_offline'):
+                stragglers = tracker.wait(online=online)
+            if stragglers:
+                print self.progress.render()
+                raise OperetoRuntimeError(error='{} worker agents are still {} after {} seconds: {}'.format(
+                    len(stragglers), 'offline' if online else 'online', self.agents_timeout, ', '.join(stragglers)))
+            print self.progress.render()
 
         def _tearrdown_statefileset():
             print 'Deleting worker stateful set..'
-            self.deployment_info = self.kubernetes_api.delete_stateful_set(self.deployment_name)
+            with self.timer.phase('delete_statefulset'):
+                self.deployment_info = self.kubernetes_api.delete_stateful_set(self.deployment_name)
             print 'Waiting that all worker pods will be offline (may take some time)..'
             _agents_status(online=False)
 
 
         if self.deployment_operation=='create_statefulset':
             print 'Creating worker stateful set..'
-            self.deployment_info = self.kubernetes_api.create_stateful_set(self.deployment_template)
-            for agent_id in _get_agent_names():
-                _modify_agent(agent_id)
+            with self.timer.phase('create_statefulset'):
+                self.deployment_info = self.kubernetes_api.create_stateful_set(self.deployment_template)
+            _modify_agents()
             print 'Waiting that all worker pods will be online (may take some time)..'
             _agents_status(online=True)
             self.deployment_info = self.kubernetes_api.get_stateful_set(self.deployment_name)
             print self.deployment_info.status
 
             ## run post install services
-            post_install_pids=[]
-            for agent_id in _get_agent_names():
-                for service in self.input['post_operations']:
-                    input = service.get('input') or {}
-                    agent_name = service.get('agents') or agent_id
-                    pid = self.client.create_process(service=service['service'], agent=agent_name, title=service.get('title'),
-                                                     **input)
-                    post_install_pids.append(pid)
-            if post_install_pids and not self.client.is_success(post_install_pids):
-                _tearrdown_statefileset()
-                return self.client.FAILURE
+            if self.input['post_operations']:
+                scheduler = PostOperationScheduler(self.client, concurrency=self.input.get('post_operations_concurrency') or POST_OPERATIONS_CONCURRENCY)
+                for agent_id in _get_agent_names():
+                    for index, service in enumerate(self.input['post_operations']):
+                        name = service.get('name') or str(index)
+                        scheduler.add('{}@{}'.format(name, agent_id), service['service'], service.get('agents') or agent_id,
+                                      title=service.get('title'), input=service.get('input'),
+                                      depends_on=['{}@{}'.format(dependency, agent_id) for dependency in service.get('depends_on') or []])
+                with self.timer.phase('post_operations'):
+                    post_operations_ok = scheduler.run()
+                self.post_operations_timings = scheduler.timings()
+                if not post_operations_ok:
+                    _tearrdown_statefileset()
+                    return self.client.FAILURE
 
         elif self.deployment_operation=='modify_statefulset':
             print 'Modifying worker stateful set..'
-            self.deployment_info = self.kubernetes_api.modify_stateful_set(self.deployment_name, self.deployment_template)
-            for agent_id in _get_agent_names():
-                _modify_agent(agent_id)
+            with self.timer.phase('modify_statefulset'):
+                self.deployment_info = self.kubernetes_api.modify_stateful_set(self.deployment_name, self.deployment_template)
+            _modify_agents()
             print 'Waiting that all worker pods will be online (may take some time)..'
             _agents_status(online=True)
             self.deployment_info = self.kubernetes_api.get_stateful_set(self.deployment_name)
@@ -140,6 +221,60 @@ class ServiceRunner(ServiceTemplate):
         elif self.deployment_operation=='delete_statefulset':
             _tearrdown_statefileset()
 
+        elif self.deployment_operation=='autoscale_statefulset':
+
+            def _register(agent_ids):
+                _modify_agents(agent_ids)
+                _agents_status(online=True, agent_ids=agent_ids)
+
+            def _unregister(agent_ids):
+                _agents_status(online=False, agent_ids=agent_ids)
+                for agent_id in agent_ids:
+                    try:
+                        retry(lambda: self.client.delete_agent(agent_id))
+                    except Exception as e:
+                        print 'Failed to unregister agent {}: {}'.format(agent_id, e)
+
+            autoscaler = QueueAutoscaler(self.client, self.kubernetes_api, self.deployment_name, self.deployment_name,
+                                         self.input.get('autoscale_min_replicas') or 0, self.input['autoscale_max_replicas'],
+                                         processes_per_worker=self.input.get('autoscale_processes_per_worker') or 1,
+                                         scale_up_cooldown=AUTOSCALE_UP_COOLDOWN if self.input.get('autoscale_scale_up_cooldown') is None
+                                         else self.input['autoscale_scale_up_cooldown'],
+                                         scale_down_cooldown=AUTOSCALE_DOWN_COOLDOWN if self.input.get('autoscale_scale_down_cooldown') is None
+                                         else self.input['autoscale_scale_down_cooldown'],
+                                         demand_filter=self.input.get('autoscale_demand_filter'),
+                                         register=_register, unregister=_unregister)
+            with self.timer.phase('autoscale'):
+                autoscaler.run(duration=self.input.get('autoscale_duration') or 0,
+                               interval=self.input.get('autoscale_interval') or AUTOSCALE_INTERVAL)
+            self.autoscale_history = autoscaler.history
+            self.deployment_info = self.kubernetes_api.get_stateful_set(self.deployment_name)
+            print self.deployment_info.status
+
+        elif self.deployment_operation=='update_worker_image':
+
+            def _wait_agents(agent_ids):
+                tracker = AgentReadinessTracker(self.client, self.kubernetes_api, agent_ids, self.deployment_name,
+                                                progress=self.progress, pod_label_selector='app={}-cluster'.format(self.deployment_name),
+                                                timeout=self.agents_timeout)
+                return tracker.wait(online=True)
+
+            update = RollingImageUpdate(self.kubernetes_api, self.deployment_name, self.input['worker_image'],
+                                        wave_size=self.input.get('update_wave_size') or UPDATE_WAVE_SIZE,
+                                        failure_threshold=self.input.get('update_failure_threshold') or 0,
+                                        on_failure=self.input.get('update_failure_action') or 'pause',
+                                        wave_timeout=self.input.get('update_wave_timeout') or UPDATE_WAVE_TIMEOUT,
+                                        pod_label_selector='app={}-cluster'.format(self.deployment_name), wait_agents=_wait_agents)
+            print 'Updating worker image..'
+            with self.timer.phase('update_worker_image'):
+                updated = update.run()
+            self.update_waves_timings = update.timings()
+            self.deployment_info = self.kubernetes_api.get_stateful_set(self.deployment_name)
+            print self.deployment_info.status
+            print self.progress.render()
+            if not updated:
+                return self.client.FAILURE
+
         else:
             raise OperetoRuntimeError(error='Invalid operation: {}'.format(self.deployment_operation))
 
@@ -149,11 +284,19 @@ class ServiceRunner(ServiceTemplate):
 
     def setup(self):
         self.kubernetes_api = KubernetesAPI()
+        if self.input.get('use_informers'):
+            ## the stateful set is polled while waiting for rollouts and autoscaling, read it from a watch instead
+            self.kubernetes_api.enable_informers(kinds=('stateful_sets',))
         self.deployment_name = self.input['deployment_name']
         self.deployment_operation = self.input['deployment_operation']
         self.deployment_info = {}
         self.deployment_template = self.input['deployment_template']
+        self.timer = LifecycleTimer()
+        self.post_operations_timings = {}
+        self.update_waves_timings = {}
+        self.autoscale_history = []
         self.worker_replicas = self.deployment_template["spec"]["replicas"]
+        self.agents_timeout = self.input.get('agents_timeout') or AGENTS_READINESS_TIMEOUT
 
         if self.deployment_operation in ['create_statefulset', 'modify_statefulset']:
             if self.deployment_name:
@@ -208,9 +351,34 @@ class ServiceRunner(ServiceTemplate):
 
             print 'Deployment template:\n{}'.format(json.dumps(self.deployment_template, indent=4))
 
+        elif self.deployment_operation=='autoscale_statefulset':
+            if not self.deployment_name:
+                self.deployment_name = self.deployment_template["metadata"]["name"]
+            self.worker_replicas = max(self.kubernetes_api.get_stateful_set(self.deployment_name).spec.replicas,
+                                       self.input['autoscale_max_replicas'])
+
+        elif self.deployment_operation=='update_worker_image':
+            if not self.deployment_name:
+                self.deployment_name = self.deployment_template["metadata"]["name"]
+            self.worker_replicas = self.kubernetes_api.get_stateful_set(self.deployment_name).spec.replicas
+
+        self.progress = ReplicaProgress([self.deployment_name+'-'+str(count) for count in range(self.worker_replicas)])
+
 
     def teardown(self):
         print self.deployment_info
+        summary = self.timer.summary(self.kubernetes_api.metrics)
+        if self.post_operations_timings:
+            summary['post_operations'] = self.post_operations_timings
+        if self.update_waves_timings:
+            summary['update_waves'] = self.update_waves_timings
+        if self.autoscale_history:
+            summary['autoscale'] = self.autoscale_history
+        emit_summary(summary, self.input.get('metrics_export_path'))
+        try:
+            self.client.modify_process_property('worker_timings', summary)
+        except Exception as e:
+            print 'Failed to store worker timings: {}'.format(e)
 
 
 
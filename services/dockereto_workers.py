@@ -0,0 +1,593 @@
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from pyopereto.client import OperetoClientError, process_result_statuses, process_running_statuses
+from opereto.exceptions import OperetoRuntimeError
+from kubernetes_api import pod_ready
+
+AGENT_REGISTRATION_CONCURRENCY = 10
+AGENT_REGISTRATION_RETRIES = 5
+RETRY_BASE_DELAY = 0.5
+AGENTS_READINESS_TIMEOUT = 1800
+AGENTS_READINESS_SUMMARY_INTERVAL = 60
+AGENT_MISSING = object()
+POST_OPERATIONS_CONCURRENCY = 10
+POST_OPERATIONS_POLL_INTERVAL = 2
+UPDATE_WAVE_SIZE = 1
+UPDATE_WAVE_TIMEOUT = 600
+AUTOSCALE_ANNOTATION = 'opereto.com/last-scale-time'
+AUTOSCALE_DEMAND_LIMIT = 1000
+AUTOSCALE_UP_COOLDOWN = 60
+AUTOSCALE_DOWN_COOLDOWN = 300
+AUTOSCALE_INTERVAL = 30
+
+
+def retry(func, retries=AGENT_REGISTRATION_RETRIES, base_delay=RETRY_BASE_DELAY):
+    """
+    Calls func until it succeeds, retrying up to the given number of times with exponential backoff.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(base_delay * (2 ** attempt))
+            attempt += 1
+
+
+class ReplicaProgress(object):
+    """
+    Per-replica progress table of a worker set (agent registered, pod ready, agent online).
+    """
+
+    columns = ['registered', 'pod_ready', 'agent_online']
+
+    def __init__(self, replicas):
+        self.replicas = list(replicas)
+        self.state = dict((replica, dict((column, False) for column in self.columns)) for replica in self.replicas)
+        self.lock = threading.Lock()
+
+    def update(self, replica, **fields):
+        with self.lock:
+            self.state[replica].update(fields)
+
+    def pending(self, column):
+        with self.lock:
+            return [replica for replica in self.replicas if not self.state[replica][column]]
+
+    def snapshot(self):
+        with self.lock:
+            return dict((replica, dict(state)) for replica, state in self.state.items())
+
+    def changes(self, previous):
+        """
+        Returns a line per replica whose columns changed since the previous snapshot.
+        """
+        current = self.snapshot()
+        lines = []
+        for replica in self.replicas:
+            changed = [column for column in self.columns if bool(current[replica][column]) != bool(previous[replica][column])]
+            if changed:
+                lines.append('{}: {}'.format(replica, ', '.join(
+                    '{} {}'.format(column, 'yes' if current[replica][column] else 'no') for column in changed)))
+        return lines, current
+
+    def summary(self):
+        with self.lock:
+            counts = [len([replica for replica in self.replicas if self.state[replica][column]]) for column in self.columns]
+        return ', '.join('{}/{} {}'.format(count, len(self.replicas), column) for count, column in zip(counts, self.columns))
+
+    def render(self):
+        width = max([len('replica')] + [len(replica) for replica in self.replicas])
+        lines = ['{}  {}'.format('replica'.ljust(width), '  '.join(self.columns))]
+        with self.lock:
+            for replica in self.replicas:
+                lines.append('{}  {}'.format(replica.ljust(width), '  '.join(
+                    ('yes' if self.state[replica][column] else 'no').ljust(len(column)) for column in self.columns)).rstrip())
+        return '\n'.join(lines)
+
+
+def register_agents(client, agent_ids, description, agent_properties, progress=None,
+                    concurrency=AGENT_REGISTRATION_CONCURRENCY, retries=AGENT_REGISTRATION_RETRIES):
+    """
+    Creates (if needed) and sets the properties of the given agents using a bounded pool of threads.
+    Returns a map of agent id to error for the agents that could not be registered.
+    """
+
+    def _register(agent_id):
+        try:
+            try:
+                client.get_agent(agent_id)
+            except OperetoClientError:
+                retry(lambda: client.create_agent(agent_id=agent_id, name=agent_id, description=description), retries=retries)
+            retry(lambda: client.modify_agent_properties(agent_id, agent_properties), retries=retries)
+            if progress is not None:
+                progress.update(agent_id, registered=True)
+            return agent_id, None
+        except Exception as e:
+            return agent_id, e
+
+    if not agent_ids:
+        return {}
+    pool = ThreadPool(min(concurrency, len(agent_ids)))
+    try:
+        results = pool.map(_register, agent_ids)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((agent_id, error) for agent_id, error in results if error is not None)
+
+
+class AgentReadinessTracker(object):
+    """
+    Waits until a set of worker agents is online (or offline) within a deadline.
+    Agent states are fetched in bulk by the worker label when possible, falling back to per-agent queries for
+    the agents still pending only. A pod watch is used as a pre-signal: while waiting for agents to go online,
+    agents whose pod is not Ready yet are not queried. Polling backs off exponentially while nothing changes.
+    Only the replica state changes are printed while waiting, with a summary line every summary_interval seconds.
+    """
+
+    def __init__(self, client, kubernetes_api, agent_ids, worker_label, progress=None, pod_label_selector=None,
+                 pod_field_selector=None, timeout=AGENTS_READINESS_TIMEOUT, initial_delay=1, max_delay=30,
+                 summary_interval=AGENTS_READINESS_SUMMARY_INTERVAL):
+        self.client = client
+        self.kubernetes_api = kubernetes_api
+        self.agent_ids = list(agent_ids)
+        self.worker_label = worker_label
+        self.progress = progress or ReplicaProgress(self.agent_ids)
+        self.pod_label_selector = pod_label_selector
+        self.pod_field_selector = pod_field_selector
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.summary_interval = summary_interval
+        self.pods_seen = set()
+        self.stopped = False
+
+    def _watch_pods(self):
+        try:
+            for event_type, pod in self.kubernetes_api.watch_objects(self.kubernetes_api.v1.list_namespaced_pod,
+                                                                     label_selector=self.pod_label_selector,
+                                                                     field_selector=self.pod_field_selector,
+                                                                     timeout=self.timeout):
+                if self.stopped:
+                    break
+                if pod.metadata.name not in self.progress.state:
+                    continue
+                self.pods_seen.add(pod.metadata.name)
+                self.progress.update(pod.metadata.name, pod_ready=event_type != 'DELETED' and pod_ready(pod))
+        except Exception as e:
+            print('Pod readiness watch stopped: {}'.format(e))
+
+    def _fetch_bulk(self, pending):
+        states = {}
+        try:
+            agents = self.client.search_agents(limit=max(100, 2*len(self.agent_ids)), filter={'generic': self.worker_label}) or []
+            for agent in agents:
+                agent_id = agent.get('id') or agent.get('agent_id')
+                if agent_id in pending and 'online' in agent:
+                    states[agent_id] = agent['online']
+        except Exception as e:
+            print('Bulk agents query failed, querying agents one by one: {}'.format(e))
+        return states
+
+    def _fetch_one(self, agent_id):
+        """
+        Returns the online state of an agent, or AGENT_MISSING if the agent does not exist (e.g. never registered,
+        or unregistered after a scale down).
+        """
+        try:
+            return self.client.get_agent(agent_id)['online']
+        except OperetoClientError:
+            return AGENT_MISSING
+
+    def wait(self, online=True):
+        """
+        Returns the list of straggler agents that did not reach the requested state before the deadline.
+        """
+        for agent_id in self.agent_ids:
+            self.progress.update(agent_id, agent_online=None)
+        watcher = None
+        if self.kubernetes_api is not None and (self.pod_label_selector or self.pod_field_selector):
+            watcher = threading.Thread(target=self._watch_pods, name='agents-pods-watch')
+            watcher.daemon = True
+            watcher.start()
+
+        deadline = time.time() + self.timeout
+        delay = self.initial_delay
+        previous = self.progress.snapshot()
+        last_summary = time.time()
+        try:
+            while True:
+                pending = [agent_id for agent_id in self.agent_ids if self.progress.state[agent_id]['agent_online'] != online]
+                if not pending:
+                    return []
+                states = self._fetch_bulk(pending)
+                for agent_id in pending:
+                    if agent_id in states:
+                        continue
+                    if online and agent_id in self.pods_seen and not self.progress.state[agent_id]['pod_ready']:
+                        continue
+                    state = self._fetch_one(agent_id)
+                    ## a missing agent counts as offline, but not as online
+                    if state is AGENT_MISSING:
+                        state = None if online else False
+                    if state is not None:
+                        states[agent_id] = state
+                changed = False
+                for agent_id, state in states.items():
+                    if state == online:
+                        changed = True
+                    self.progress.update(agent_id, agent_online=state)
+                if time.time() >= deadline:
+                    return [agent_id for agent_id in self.agent_ids if self.progress.state[agent_id]['agent_online'] != online]
+                if online:
+                    lines, previous = self.progress.changes(previous)
+                    for line in lines:
+                        print(line)
+                    if time.time() - last_summary >= self.summary_interval:
+                        print('Waiting for agents: {} ({:.0f} seconds left)'.format(self.progress.summary(), deadline - time.time()))
+                        last_summary = time.time()
+                delay = self.initial_delay if changed else min(delay * 2, self.max_delay)
+                time.sleep(max(min(delay, deadline - time.time()), 0))
+        finally:
+            self.stopped = True
+
+
+class PostOperationScheduler(object):
+    """
+    Runs post operations (Opereto processes) with a concurrency limit, honoring dependencies between operations.
+    When fail_fast is set, the first failure terminates all running operations and skips the pending ones.
+    """
+
+    def __init__(self, client, concurrency=POST_OPERATIONS_CONCURRENCY, fail_fast=True, poll_interval=POST_OPERATIONS_POLL_INTERVAL):
+        self.client = client
+        self.concurrency = concurrency
+        self.fail_fast = fail_fast
+        self.poll_interval = poll_interval
+        self.operations = []
+        self.by_name = {}
+
+    def add(self, name, service, agent, title=None, input=None, depends_on=None):
+        if name in self.by_name:
+            raise OperetoRuntimeError(error='Duplicate post operation name: {}'.format(name))
+        operation = {
+            'name': name,
+            'service': service,
+            'agent': agent,
+            'title': title,
+            'input': input or {},
+            'depends_on': depends_on or [],
+            'status': 'pending',
+            'pid': None,
+            'start': None,
+            'end': None
+        }
+        self.operations.append(operation)
+        self.by_name[name] = operation
+        return operation
+
+    def _validate(self):
+        for operation in self.operations:
+            for dependency in operation['depends_on']:
+                if dependency not in self.by_name:
+                    raise OperetoRuntimeError(error='Post operation {} depends on unknown operation {}'.format(operation['name'], dependency))
+
+        def _visit(name, path):
+            if name in path:
+                raise OperetoRuntimeError(error='Circular post operations dependency: {}'.format(' -> '.join(path+[name])))
+            for dependency in self.by_name[name]['depends_on']:
+                _visit(dependency, path+[name])
+
+        for operation in self.operations:
+            _visit(operation['name'], [])
+
+    def _start(self, operation):
+        """
+        Creates the process of the operation. Returns False, marking the operation as failed (error), if the process
+        could not be created.
+        """
+        try:
+            operation['pid'] = self.client.create_process(service=operation['service'], agent=operation['agent'],
+                                                          title=operation['title'], **operation['input'])
+        except Exception as e:
+            print('Failed to start post operation {}: {}'.format(operation['name'], e))
+            self._finish(operation, 'error')
+            return False
+        operation['start'] = time.time()
+        operation['status'] = 'running'
+        return True
+
+    def _finish(self, operation, status):
+        operation['status'] = status
+        if operation['start'] is not None:
+            operation['end'] = time.time()
+
+    def _abort(self, running):
+        pids = [operation['pid'] for operation in running]
+        if pids:
+            try:
+                self.client.stop_process(pids, status='terminated', message='A post operation has failed.')
+            except Exception as e:
+                print('Failed to terminate post operations {}: {}'.format(pids, e))
+        for operation in running:
+            self._finish(operation, 'terminated')
+        for operation in self.operations:
+            if operation['status'] == 'pending':
+                self._finish(operation, 'skipped')
+
+    def run(self):
+        """
+        Returns True if all operations succeeded.
+        """
+        self._validate()
+        failed = False
+        while True:
+            running = [operation for operation in self.operations if operation['status'] == 'running']
+            for operation in running:
+                status = self.client.get_process_status(operation['pid'])
+                if status in process_result_statuses:
+                    self._finish(operation, status)
+                    if status != 'success':
+                        failed = True
+            running = [operation for operation in self.operations if operation['status'] == 'running']
+            if failed and self.fail_fast:
+                self._abort(running)
+                break
+
+            for operation in self.operations:
+                if operation['status'] != 'pending':
+                    continue
+                dependencies = [self.by_name[dependency]['status'] for dependency in operation['depends_on']]
+                if [status for status in dependencies if status not in ['pending', 'running', 'success']]:
+                    self._finish(operation, 'skipped')
+                    failed = True
+                elif all(status == 'success' for status in dependencies) and (not self.concurrency or len(running) < self.concurrency):
+                    if not self._start(operation):
+                        failed = True
+                        if self.fail_fast:
+                            break
+                    else:
+                        running.append(operation)
+            if failed and self.fail_fast:
+                self._abort(running)
+                break
+
+            if not [operation for operation in self.operations if operation['status'] in ['pending', 'running']]:
+                break
+            time.sleep(self.poll_interval)
+
+        print(self.render())
+        return not failed
+
+    def render(self):
+        lines = ['Post operations:']
+        for operation in self.operations:
+            duration = '-'
+            if operation['start'] is not None and operation['end'] is not None:
+                duration = '{:.1f}s'.format(operation['end'] - operation['start'])
+            lines.append('  {} [{}] on {}: {} ({}), pid: {}'.format(operation['name'], operation['service'], operation['agent'],
+                                                                    operation['status'], duration, operation['pid']))
+        return '\n'.join(lines)
+
+    def timings(self):
+        return dict((operation['name'], {
+            'pid': operation['pid'],
+            'status': operation['status'],
+            'duration': operation['end'] - operation['start'] if operation['start'] is not None and operation['end'] is not None else None
+        }) for operation in self.operations)
+
+
+class RollingImageUpdate(object):
+    """
+    Rolls a new image to a container (the first one by default) of a stateful set in waves, from the highest
+    ordinal down, by lowering the rollingUpdate partition. Each wave is tracked through a stateful set watch until
+    its pods are updated and ready (and, if wait_agents is given, their agents are online). When more than failure_threshold pods of a
+    wave fail, the update either stops where it is (pause) or rolls all pods back to the previous image (rollback).
+    """
+
+    def __init__(self, kubernetes_api, name, image, container_name=None, wave_size=UPDATE_WAVE_SIZE, failure_threshold=0,
+                 on_failure='pause', wave_timeout=UPDATE_WAVE_TIMEOUT, pod_label_selector=None, wait_agents=None):
+        self.kubernetes_api = kubernetes_api
+        self.name = name
+        self.container_name = container_name
+        self.image = image
+        self.wave_size = wave_size
+        self.failure_threshold = failure_threshold
+        self.on_failure = on_failure
+        self.wave_timeout = wave_timeout
+        self.pod_label_selector = pod_label_selector
+        self.wait_agents = wait_agents
+        self.waves = []
+
+    def _patch(self, partition, image=None):
+        patch = {
+            'spec': {
+                'updateStrategy': {
+                    'type': 'RollingUpdate',
+                    'rollingUpdate': {
+                        'partition': partition
+                    }
+                }
+            }
+        }
+        if image:
+            patch['spec']['template'] = {'spec': {'containers': [{'name': self.container_name, 'image': image}]}}
+        return self.kubernetes_api.modify_stateful_set(self.name, patch)
+
+    def _rolled_out(self, replicas, partition):
+        def _condition(stateful_set):
+            status = stateful_set.status
+            return (status.observed_generation or 0) >= (stateful_set.metadata.generation or 0) and \
+                (status.updated_replicas or 0) >= replicas - partition and (status.ready_replicas or 0) >= replicas
+        return _condition
+
+    def _failed_pods(self, partition, update_revision):
+        """
+        Returns the pods of the wave (ordinal >= partition) that are not ready or not at the update revision.
+        """
+        failed = []
+        for pod in self.kubernetes_api.list_pods(label_selector=self.pod_label_selector):
+            if not pod.metadata.name.startswith(self.name+'-') or int(pod.metadata.name.rsplit('-', 1)[1]) < partition:
+                continue
+            revision = (pod.metadata.labels or {}).get('controller-revision-hash')
+            if not pod_ready(pod) or (update_revision and revision != update_revision):
+                failed.append(pod.metadata.name)
+        return failed
+
+    def _rollback(self, replicas, previous_image):
+        print('Rolling back {} to image {}..'.format(self.name, previous_image))
+        self._patch(0, image=previous_image)
+        if self.kubernetes_api.wait_for_stateful_set(self.name, self._rolled_out(replicas, 0),
+                                                     timeout=self.wave_timeout * max(len(self.waves), 1)) is None:
+            print('Rollback of {} did not complete in time'.format(self.name))
+
+    def run(self):
+        """
+        Returns True if all waves were rolled out within the failure threshold.
+        """
+        stateful_set = self.kubernetes_api.get_stateful_set(self.name)
+        replicas = stateful_set.spec.replicas
+        containers = stateful_set.spec.template.spec.containers
+        if self.container_name is None:
+            self.container_name = containers[0].name
+        containers = dict((container.name, container) for container in containers)
+        if self.container_name not in containers:
+            raise OperetoRuntimeError(error='Stateful set {} has no container {}.'.format(self.name, self.container_name))
+        previous_image = containers[self.container_name].image
+        print('Rolling image {} to {} replicas of {} (previous image {}) in waves of {}..'.format(
+            self.image, replicas, self.name, previous_image, self.wave_size))
+
+        ## hold all pods at the current revision while the image changes, then lower the partition wave by wave
+        self._patch(replicas, image=self.image)
+        partition = replicas
+        while partition > 0:
+            previous_partition, partition = partition, max(partition - self.wave_size, 0)
+            wave = {'partition': partition, 'pods': [self.name+'-'+str(ordinal) for ordinal in range(partition, previous_partition)],
+                    'start': time.time()}
+            self.waves.append(wave)
+            print('Updating pods {}..'.format(', '.join(wave['pods'])))
+            self._patch(partition)
+            rolled_out = self.kubernetes_api.wait_for_stateful_set(self.name, self._rolled_out(replicas, partition), timeout=self.wave_timeout)
+            if rolled_out is None:
+                update_revision = self.kubernetes_api.get_stateful_set(self.name).status.update_revision
+                wave['failed'] = self._failed_pods(partition, update_revision)
+            else:
+                wave['failed'] = []
+            if self.wait_agents is not None:
+                wave['failed'] = sorted(set(wave['failed']) | set(self.wait_agents(wave['pods'])))
+            wave['end'] = time.time()
+            print('Wave done in {:.1f} seconds, failed pods: {}'.format(wave['end'] - wave['start'], ', '.join(wave['failed']) or 'none'))
+            if len(wave['failed']) > self.failure_threshold:
+                if self.on_failure == 'rollback':
+                    self._rollback(replicas, previous_image)
+                else:
+                    print('Update paused at partition {}, pods below it keep image {}'.format(partition, previous_image))
+                return False
+        return True
+
+    def timings(self):
+        return dict((','.join(wave['pods']), {'duration': round(wave['end'] - wave['start'], 3), 'failed': wave['failed']})
+                    for wave in self.waves if 'end' in wave)
+
+
+def _process_agents(process):
+    agents = process.get('agents') or []
+    return set(agents if isinstance(agents, list) else [agents])
+
+
+def search_processes(client, demand_filter, limit=AUTOSCALE_DEMAND_LIMIT):
+    """
+    Searches Opereto processes with the client search method if it has one. pyopereto (up to 1.0.151) has none,
+    so the search endpoint used by its other search methods is called otherwise.
+    """
+    if hasattr(client, 'search_processes'):
+        return client.search_processes(start=0, limit=limit, filter=demand_filter) or []
+    request_data = {'start': 0, 'limit': limit, 'filter': demand_filter}
+    return client._call_rest_api('post', '/search/processes', data=request_data, error='Failed to search processes') or []
+
+
+def pending_demand(client, demand_filter, agents=None, limit=AUTOSCALE_DEMAND_LIMIT):
+    """
+    Returns the number of queued (registered) and running (in_process) Opereto processes matching the filter and,
+    if agents are given, whose agents field (the agent or agent label the process was created for) is one of them.
+    """
+    processes = search_processes(client, demand_filter, limit=limit)
+    return len([process for process in processes if process.get('status') in process_running_statuses
+                and (agents is None or _process_agents(process) & agents)])
+
+
+class QueueAutoscaler(object):
+    """
+    Scales a worker stateful set (through its scale subresource) to the pending Opereto process demand of its
+    worker label, within min/max bounds. Scaling up waits scale_up_cooldown and scaling down scale_down_cooldown
+    seconds since the last scale change, which is kept in a stateful set annotation so that it holds across runs.
+    Only the agents added or removed by a scale change are passed to the register/unregister callbacks.
+    """
+
+    def __init__(self, client, kubernetes_api, name, worker_label, min_replicas, max_replicas, processes_per_worker=1,
+                 scale_up_cooldown=AUTOSCALE_UP_COOLDOWN, scale_down_cooldown=AUTOSCALE_DOWN_COOLDOWN, demand_filter=None,
+                 register=None, unregister=None):
+        self.client = client
+        self.kubernetes_api = kubernetes_api
+        self.name = name
+        self.min_replicas = min_replicas
+        self.max_replicas = max_replicas
+        self.processes_per_worker = processes_per_worker
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.demand_filter = demand_filter or {'generic': worker_label}
+        ## the default free text search also matches processes that only mention the label, so its results are
+        ## narrowed to the processes created for the worker label or one of the worker agents
+        self.demand_agents = None if demand_filter else set([worker_label] + self._agent_names(0, max_replicas))
+        self.register = register
+        self.unregister = unregister
+        self.history = []
+
+    def desired_replicas(self, demand):
+        needed = (demand + self.processes_per_worker - 1) // self.processes_per_worker
+        return min(max(needed, self.min_replicas), self.max_replicas)
+
+    def _agent_names(self, start, end):
+        return [self.name+'-'+str(ordinal) for ordinal in range(start, end)]
+
+    def evaluate(self):
+        """
+        Runs one scaling decision and returns the new (or unchanged) number of replicas.
+        """
+        stateful_set = self.kubernetes_api.get_stateful_set(self.name)
+        current = stateful_set.spec.replicas
+        last_scale = float((stateful_set.metadata.annotations or {}).get(AUTOSCALE_ANNOTATION) or 0)
+        demand = pending_demand(self.client, self.demand_filter, agents=self.demand_agents)
+        desired = self.desired_replicas(demand)
+        since_last_scale = time.time() - last_scale
+        cooldown = self.scale_up_cooldown if desired > current else self.scale_down_cooldown
+        print('Worker set {}: {} replicas, demand {}, desired {} replicas'.format(self.name, current, demand, desired))
+        if desired == current:
+            return current
+        if since_last_scale < cooldown:
+            print('Scaling {} is in cooldown for {:.0f} more seconds'.format(self.name, cooldown - since_last_scale))
+            return current
+
+        self.kubernetes_api.scale_stateful_set(self.name, desired)
+        self.kubernetes_api.modify_stateful_set(self.name, {'metadata': {'annotations': {AUTOSCALE_ANNOTATION: str(time.time())}}})
+        print('Scaled {} from {} to {} replicas'.format(self.name, current, desired))
+        self.history.append({'time': time.time(), 'demand': demand, 'from': current, 'to': desired})
+        if desired > current and self.register is not None:
+            self.register(self._agent_names(current, desired))
+        if desired < current and self.unregister is not None:
+            self.unregister(self._agent_names(desired, current))
+        return desired
+
+    def run(self, duration=0, interval=AUTOSCALE_INTERVAL):
+        """
+        Evaluates the demand once, or every interval seconds for the given duration.
+        """
+        deadline = time.time() + duration
+        while True:
+            self.evaluate()
+            if time.time() + interval > deadline:
+                return
+            time.sleep(interval)
@@ -1,27 +1,585 @@
+import os
+import re
 import time
+import random
+import base64
+import shutil
+import socket
+import tarfile
+import tempfile
+import hashlib
+import functools
+import threading
+from multiprocessing.pool import ThreadPool
 from kubernetes import watch, client as kubernetes_client, config as kubernetes_config
-from opereto.utils.shell import run_shell_cmd
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
+from kubernetes.stream import stream
 from opereto.exceptions import OperetoRuntimeError
+from kubernetes_metrics import api_metrics, InstrumentedApi
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+POD_WAIT_TIMEOUT = 600
+WATCH_WINDOW_SECONDS = 60
+POD_TERMINAL_PHASES = ['Succeeded', 'Failed']
+POD_STARTED_PHASES = ['Running', 'Succeeded', 'Failed', 'Unknown']
+INFORMER_RESYNC_SECONDS = 3600
+INFORMER_SYNC_TIMEOUT = 30
+PID_LABEL = 'opereto_pid'
+SHARED_USER_ANNOTATION_PREFIX = 'users.opereto.io/'
+SHARED_CONFIGMAP_HASH_LABEL = 'opereto_config_hash'
+SHARED_ACQUIRE_ATTEMPTS = 5
+API_POOL_MAXSIZE = 32
+API_KEEPALIVE_IDLE_SECONDS = 60
+COPY_CHUNK_SIZE = 3 * 64 * 1024
+COPY_READ_TIMEOUT = 1
+DELETE_COLLECTION_KINDS = ('pods', 'jobs', 'config_maps')
+DELETE_WAIT_TIMEOUT = 120
+ASYNC_POOL_SIZE = 16
+API_QPS = 20
+API_BURST = 40
+API_RETRIES = 5
+API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 30
+API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_api_clients = {}
+_api_groups = {}
+_api_client_lock = threading.Lock()
+_api_client_settings = {'pool_maxsize': API_POOL_MAXSIZE, 'keepalive_idle': API_KEEPALIVE_IDLE_SECONDS}
+_informers = {}
+_informers_lock = threading.Lock()
+_async_pool = None
+
+
+def get_api_client(context=None):
+    """
+    Returns the process-wide ApiClient of a kubeconfig context (the in-cluster config if no context is given).
+    The config and credentials are loaded once per context and all API groups of a context share a single
+    urllib3 connection pool with TCP keep-alive enabled (see set_connection_pool).
+    """
+    with _api_client_lock:
+        if context not in _api_clients:
+            if context is None:
+                kubernetes_config.load_incluster_config()
+            try:
+                configuration = kubernetes_client.Configuration.get_default_copy()
+            except AttributeError:
+                configuration = kubernetes_client.Configuration()
+            if context is not None:
+                kubernetes_config.load_kube_config(context=context, client_configuration=configuration)
+            configuration.connection_pool_maxsize = _api_client_settings['pool_maxsize']
+            if hasattr(configuration, 'socket_options'):
+                keepalive_options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+                if hasattr(socket, 'TCP_KEEPIDLE'):
+                    keepalive_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, _api_client_settings['keepalive_idle']))
+                configuration.socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)] + keepalive_options
+            _api_clients[context] = kubernetes_client.ApiClient(configuration)
+        return _api_clients[context]
+
+
+def use_configuration(configuration, context=None):
+    """
+    Makes the process-wide client of a context use the given Configuration instead of the in-cluster config or
+    kubeconfig (e.g. to run against a local or fake API server). Already created API groups of the context are discarded.
+    """
+    with _api_client_lock:
+        _api_clients[context] = kubernetes_client.ApiClient(configuration)
+        for key in [key for key in _api_groups if key[0] == context]:
+            del _api_groups[key]
+
+
+def set_connection_pool(pool_maxsize, keepalive_idle):
+    """
+    Sets the connection pool size and the TCP keep-alive idle time (seconds) of the API clients created afterwards.
+    """
+    with _api_client_lock:
+        _api_client_settings['pool_maxsize'] = pool_maxsize
+        _api_client_settings['keepalive_idle'] = keepalive_idle
+
+
+class TokenBucket(object):
+    """
+    Client-side rate limiter: tokens are added at qps per second up to burst, and each call takes one, waiting
+    for it when the bucket is empty.
+    """
+
+    def __init__(self, qps=API_QPS, burst=API_BURST):
+        self.qps = float(qps)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def configure(self, qps, burst):
+        with self.lock:
+            self.qps = float(qps)
+            self.burst = float(burst)
+            self.tokens = min(self.tokens, self.burst)
+
+    def acquire(self):
+        """
+        Takes a token and returns the number of seconds waited for it.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.qps if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def _retry_after(error):
+    try:
+        return float((getattr(error, 'headers', None) or {}).get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _subset_of(desired, existing):
+    """
+    Returns whether the existing object holds every field of the desired one. Lists of objects match when each
+    desired item matches an existing item, since admission may add items (e.g. the service account token volume
+    and its mounts); lists of values (e.g. commands) must be equal.
+    """
+    if isinstance(desired, dict):
+        return isinstance(existing, dict) and all(_subset_of(value, existing.get(key)) for key, value in desired.items())
+    if isinstance(desired, list):
+        if not isinstance(existing, list):
+            return False
+        if not all(isinstance(value, dict) for value in desired):
+            return desired == existing
+        return all(any(_subset_of(value, existing_value) for existing_value in existing) for value in desired)
+    return desired == existing
+
+
+class ResilientApi(object):
+    """
+    Wraps a Kubernetes API group so that every call takes a token from the process-wide limiter, and calls failing
+    with 429, 5xx or a connection error are retried with jittered exponential backoff (honoring Retry-After).
+    A retried create that fails with 409 succeeds if the existing object matches the requested one, and a retried
+    delete that fails with 404 succeeds, since an earlier attempt may have been applied.
+    """
+
+    def __init__(self, api, api_client, limiter, metrics, retries=API_RETRIES, base_delay=API_RETRY_BASE_DELAY, max_delay=API_RETRY_MAX_DELAY):
+        self._api = api
+        self._api_client = api_client
+        self._limiter = limiter
+        self._metrics = metrics
+        self._retries = retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def _existing_if_matching(self, name, args, kwargs):
+        body = kwargs.get('body', args[1] if len(args) > 1 else None)
+        namespace = kwargs.get('namespace', args[0] if args else None)
+        body = self._api_client.sanitize_for_serialization(body) or {}
+        read_func = getattr(self._api, name.replace('create_', 'read_', 1), None)
+        object_name = (body.get('metadata') or {}).get('name')
+        if read_func is None or not object_name:
+            return None
+        existing = read_func(object_name, namespace)
+        desired = dict((key, value) for key, value in body.items() if key not in ['apiVersion', 'kind', 'status'])
+        desired['metadata'] = dict((key, value) for key, value in desired.get('metadata', {}).items() if key in ['name', 'labels', 'annotations'])
+        if _subset_of(desired, self._api_client.sanitize_for_serialization(existing)):
+            return existing
+        return None
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def _call(*args, **kwargs):
+            attempt = 0
+            while True:
+                if self._limiter.acquire() > 0:
+                    self._metrics.record_throttled(name)
+                try:
+                    return attr(*args, **kwargs)
+                except ApiException as e:
+                    if attempt > 0 and e.status == 409 and name.startswith('create_'):
+                        existing = self._existing_if_matching(name, args, kwargs)
+                        if existing is not None:
+                            return existing
+                    if attempt > 0 and e.status == 404 and name.startswith('delete_') and 'collection' not in name:
+                        return None
+                    if e.status not in API_RETRY_STATUSES or attempt >= self._retries:
+                        raise
+                    retry_after = _retry_after(e)
+                except HTTPError:
+                    if attempt >= self._retries:
+                        raise
+                    retry_after = None
+                delay = random.uniform(0, min(self._max_delay, self._base_delay * (2 ** attempt)))
+                if retry_after is not None:
+                    delay = max(delay, min(retry_after, self._max_delay))
+                self._metrics.record_retry(name)
+                time.sleep(delay)
+                attempt += 1
+        return _call
+
+
+api_limiter = TokenBucket()
+
+
+def set_rate_limit(qps, burst):
+    """
+    Sets the QPS and burst of the limiter shared by all Kubernetes API calls of the process.
+    """
+    api_limiter.configure(qps, burst)
+
+
+def get_api_group(group_name, context=None, retries=API_RETRIES):
+    """
+    Returns the process-wide instance of an API group (e.g. CoreV1Api) of a context, created on first use. Calls are
+    rate limited, retried on transient errors (up to the given number of retries) and recorded in the API metrics
+    (one record per attempt).
+    """
+    key = (context, group_name) if retries == API_RETRIES else (context, group_name, retries)
+    with _api_client_lock:
+        api_group = _api_groups.get(key)
+    if api_group is None:
+        api_client = get_api_client(context)
+        api_group = ResilientApi(InstrumentedApi(getattr(kubernetes_client, group_name)(api_client), api_metrics),
+                                 api_client, api_limiter, api_metrics, retries=retries)
+        with _api_client_lock:
+            api_group = _api_groups.setdefault(key, api_group)
+    return api_group
+
+
+def get_exec_api(context=None):
+    """
+    Returns a CoreV1Api bound to its own ApiClient, since streaming exec calls swap the request method of the
+    client they run on and must not interfere with the shared one.
+    """
+    with _api_client_lock:
+        exec_api = _api_groups.get((context, 'exec'))
+    if exec_api is None:
+        exec_api = kubernetes_client.CoreV1Api(kubernetes_client.ApiClient(get_api_client(context).configuration))
+        with _api_client_lock:
+            exec_api = _api_groups.setdefault((context, 'exec'), exec_api)
+    return exec_api
+
+
+def get_async_pool(pool_size=ASYNC_POOL_SIZE):
+    """
+    Returns the process-wide thread pool running the calls of AsyncKubernetesAPI, created on first use.
+    """
+    global _async_pool
+    with _api_client_lock:
+        if _async_pool is None:
+            _async_pool = ThreadPool(pool_size)
+        return _async_pool
+
+
+def gather(results, timeout=None):
+    """
+    Returns the values of the given pending results (in order), raising the error of the first failed one.
+    """
+    return [result.get(timeout) for result in results]
+
+
+QUANTITY_SUFFIXES = [('Ki', 2**10), ('Mi', 2**20), ('Gi', 2**30), ('Ti', 2**40), ('Pi', 2**50), ('Ei', 2**60),
+                     ('n', 1e-9), ('u', 1e-6), ('m', 1e-3), ('k', 1e3), ('M', 1e6), ('G', 1e9), ('T', 1e12), ('P', 1e15), ('E', 1e18)]
+
+
+def parse_quantity(quantity):
+    """
+    Returns the value of a Kubernetes resource quantity (e.g. 500m, 2Gi, 1.5) as a float.
+    """
+    quantity = str(quantity).strip()
+    for suffix, multiplier in QUANTITY_SUFFIXES:
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * multiplier
+    return float(quantity)
+
+
+def _annotation_name(value):
+    ## annotation names are at most 63 alphanumeric, '-', '_' or '.' characters
+    return re.sub('[^-._a-zA-Z0-9]+', '-', value).strip('-._')[:63]
+
+
+def pod_phase_in(*phases):
+    def _condition(pod):
+        return pod.status is not None and pod.status.phase in phases
+    return _condition
+
+
+def pod_ready(pod):
+    if pod.status is None or not pod.status.conditions:
+        return False
+    for condition in pod.status.conditions:
+        if condition.type == 'Ready':
+            return condition.status == 'True'
+    return False
+
+
+def container_started(container_name):
+    def _condition(pod):
+        if pod.status is None or not pod.status.container_statuses:
+            return False
+        for container in pod.status.container_statuses:
+            if container.name == container_name:
+                return container.state is not None and (container.state.running is not None or container.state.terminated is not None)
+        return False
+    return _condition
+
+
+class PendingWait(object):
+    """
+    A wait for a named object to meet a condition, checked by an informer on every change of the object, with the
+    get/ready/wait interface of a pool AsyncResult. The wait fails if the object is deleted, or if fail(obj) returns
+    an error message.
+    """
+
+    def __init__(self, name, condition, fail=None):
+        self.name = name
+        self.condition = condition
+        self.fail = fail
+        self.value = None
+        self.met_at = None
+        self.error = None
+        self.deleted = False
+        self.event = threading.Event()
+
+    def check(self, event_type, obj):
+        if self.event.is_set():
+            return True
+        try:
+            if event_type == 'DELETED':
+                self.deleted = True
+                self.error = '{} was deleted while waiting for it.'.format(self.name)
+            elif obj is not None and self.condition(obj):
+                self.value = obj
+            elif obj is not None and self.fail is not None:
+                self.error = self.fail(obj)
+            if self.value is None and self.error is None:
+                return False
+        except Exception as e:
+            self.error = 'Failed to check {}: {}'.format(self.name, e)
+        self.resolve(self.value, self.error)
+        return True
+
+    def resolve(self, value, error=None, met_at=None):
+        self.value = value
+        self.error = error
+        self.met_at = met_at or time.time()
+        self.event.set()
+
+    def ready(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise OperetoRuntimeError(error='Timed out after {} seconds waiting for {}.'.format(timeout, self.name))
+        if self.error:
+            raise OperetoRuntimeError(error=self.error)
+        return self.value
+
+
+class Informer(object):
+    """
+    Lists a resource kind once and keeps a local copy of it up to date from a watch running in a background
+    thread. Objects are indexed by name and by the opereto_pid label. The informer may be limited to the objects
+    matching a label and a field selector (e.g. the resources of one task). Any number of waits (wait_for) are
+    checked by the same thread on every change, so waiting does not take a thread or a watch per wait.
+    """
+
+    def __init__(self, kubernetes_api, list_func, label_selector=None, field_selector=None):
+        self.kubernetes_api = kubernetes_api
+        self.list_func = list_func
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.by_name = {}
+        self.by_pid = {}
+        self.waits = []
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.synced = threading.Event()
+        self.sync_waited = False
+        self.thread = threading.Thread(target=self._run, name='informer-'+list_func.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _pid(self, obj):
+        return (obj.metadata.labels or {}).get(PID_LABEL)
+
+    def _remove(self, name):
+        obj = self.by_name.pop(name, None)
+        if obj is not None and self._pid(obj):
+            self.by_pid.get(self._pid(obj), {}).pop(name, None)
+            if not self.by_pid.get(self._pid(obj)):
+                self.by_pid.pop(self._pid(obj), None)
+
+    def _add(self, obj):
+        self._remove(obj.metadata.name)
+        self.by_name[obj.metadata.name] = obj
+        if self._pid(obj):
+            self.by_pid.setdefault(self._pid(obj), {})[obj.metadata.name] = obj
+
+    def _run(self):
+        while True:
+            initial = []
+            try:
+                for event_type, obj in self.kubernetes_api.watch_objects(self.list_func, label_selector=self.label_selector,
+                                                                         field_selector=self.field_selector,
+                                                                         timeout=INFORMER_RESYNC_SECONDS, sync_marker=True):
+                    if event_type == 'INITIAL':
+                        initial.append(obj)
+                        continue
+                    with self.lock:
+                        if event_type == 'SYNCED':
+                            ## objects deleted while the watch was down are only noticed by the new list
+                            previous = set(self.by_name)
+                            self.by_name = {}
+                            self.by_pid = {}
+                            for item in initial:
+                                self._add(item)
+                            initial = []
+                            self.waits = [wait for wait in self.waits if not wait.check(
+                                'DELETED' if wait.name in previous and wait.name not in self.by_name else 'MODIFIED', self.by_name.get(wait.name))]
+                        else:
+                            if event_type == 'DELETED':
+                                self._remove(obj.metadata.name)
+                            else:
+                                self._add(obj)
+                            self.waits = [wait for wait in self.waits if wait.name != obj.metadata.name or not wait.check(event_type, obj)]
+                        self.changed.notify_all()
+                    self.synced.set()
+            except Exception as e:
+                print('Informer {} failed, re-listing: {}'.format(self.list_func.__name__, e))
+                time.sleep(1)
+
+    def wait_synced(self, timeout=INFORMER_SYNC_TIMEOUT):
+        return self.synced.wait(timeout)
+
+    def is_synced(self):
+        """
+        Waits for the initial list on the first call only, so that reads fall back to the API without blocking
+        while the informer is re-listing or never synced.
+        """
+        if not self.sync_waited:
+            self.sync_waited = True
+            return self.wait_synced()
+        return self.synced.is_set()
+
+    def get(self, name):
+        with self.lock:
+            return self.by_name.get(name)
+
+    def covers(self, pid):
+        """
+        Returns whether all the objects labeled with the pid are in the informer.
+        """
+        return self.field_selector is None and self.label_selector in [None, '{}={}'.format(PID_LABEL, pid)]
+
+    def list_objects(self, pid=None):
+        with self.lock:
+            if pid is None:
+                return list(self.by_name.values())
+            return list(self.by_pid.get(pid, {}).values())
+
+    def wait_for(self, name, condition, fail=None):
+        """
+        Returns a PendingWait that is met once the named object meets the condition.
+        """
+        wait = PendingWait(name, condition, fail=fail)
+        with self.lock:
+            if not wait.check('MODIFIED', self.by_name.get(name)):
+                self.waits.append(wait)
+        return wait
+
+    def wait_until(self, predicate, timeout):
+        """
+        Waits until predicate() holds, checking it on every change. Returns whether it held before the timeout.
+        """
+        deadline = time.time() + timeout
+        with self.changed:
+            while not predicate():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+            return True
+
 
 class KubernetesAPI(object):
 
-    def __init__(self, namespace='default'):
+    def __init__(self, namespace='default', use_informers=False, context=None):
         self.client = kubernetes_client
         self.namespace = namespace
-        kubernetes_config.load_incluster_config()
-        self.v1 = kubernetes_client.CoreV1Api()
-        self.v1b1 = kubernetes_client.AppsV1beta1Api()
-        self.v1b2 = kubernetes_client.AppsV1beta2Api()
-        self.v1b1Storage = kubernetes_client.StorageV1beta1Api()
-        self.v1b1Extensions = kubernetes_client.ExtensionsV1beta1Api()
-        self.AppsV1Api = kubernetes_client.AppsV1Api()
+        self.context = context
+        self.informers = {}
+        self.metrics = api_metrics
         self.v1_body_delete = kubernetes_client.V1DeleteOptions()
-        self.batch_api = kubernetes_client.BatchV1Api()
+        if use_informers:
+            self.enable_informers()
+
+    @property
+    def v1(self):
+        return get_api_group('CoreV1Api', self.context)
+
+    @property
+    def AppsV1Api(self):
+        return get_api_group('AppsV1Api', self.context)
+
+    @property
+    def batch_api(self):
+        return get_api_group('BatchV1Api', self.context)
+
+    def enable_informers(self, kinds=('pods', 'config_maps', 'stateful_sets'), label_selector=None, field_selector=None):
+        """
+        Serves reads of the given kinds from informers, optionally limited to the objects matching the selectors.
+        Informers are shared by all the API instances of the process using the same context, namespace and selectors.
+        """
+        list_funcs = {
+            'pods': self.v1.list_namespaced_pod,
+            'config_maps': self.v1.list_namespaced_config_map,
+            'stateful_sets': self.AppsV1Api.list_namespaced_stateful_set
+        }
+        for kind in kinds:
+            if kind not in self.informers:
+                with _informers_lock:
+                    key = (self.context, self.namespace, kind, label_selector, field_selector)
+                    if key not in _informers:
+                        _informers[key] = Informer(self, list_funcs[kind], label_selector=label_selector, field_selector=field_selector)
+                    self.informers[kind] = _informers[key]
+
+    def _synced_informer(self, kind, pid=None):
+        informer = self.informers.get(kind)
+        if informer is not None and (pid is None or informer.covers(pid)) and informer.is_synced():
+            return informer
+        return None
 
     def get_pods(self):
+        informer = self._synced_informer('pods')
+        if informer is not None:
+            return [pod.metadata.name for pod in informer.list_objects()]
         res = self.v1.list_namespaced_pod(self.namespace)
         return [i.metadata.name for i in res.items]
 
+    def get_pods_by_label(self, pid):
+        informer = self._synced_informer('pods', pid=pid)
+        if informer is not None:
+            return informer.list_objects(pid=pid)
+        return self.v1.list_namespaced_pod(self.namespace, label_selector='{}={}'.format(PID_LABEL, pid)).items
+
+    def list_pods(self, label_selector=None):
+        if label_selector:
+            return self.v1.list_namespaced_pod(self.namespace, label_selector=label_selector).items
+        return self.v1.list_namespaced_pod(self.namespace).items
+
     def create_stateful_set(self, deployment_manifest):
         resp = self.AppsV1Api.create_namespaced_stateful_set(
             body=deployment_manifest, namespace=self.namespace)
@@ -32,34 +590,152 @@ class KubernetesAPI(object):
             name=name, body=deployment_manifest, namespace=self.namespace)
         return resp
 
+    def scale_stateful_set(self, name, replicas):
+        resp = self.AppsV1Api.patch_namespaced_stateful_set_scale(
+            name=name, body={'spec': {'replicas': replicas}}, namespace=self.namespace)
+        return resp
+
     def delete_stateful_set(self, name):
         resp = self.AppsV1Api.delete_namespaced_stateful_set(name=name, namespace=self.namespace, body={}, grace_period_seconds=0)
         return resp
 
     def get_stateful_set(self, name):
+        informer = self._synced_informer('stateful_sets')
+        if informer is not None and informer.get(name) is not None:
+            return informer.get(name)
         resp = self.AppsV1Api.read_namespaced_stateful_set(name=name, namespace=self.namespace)
         return resp
 
-    def create_pod(self, pod_manifest):
+    def wait_for_stateful_set(self, name, condition, timeout=POD_WAIT_TIMEOUT):
+        """
+        Waits (using a stateful set watch) until the condition holds for the stateful set. Returns the stateful
+        set, or None if the condition was not met before the timeout.
+        """
+        for event_type, stateful_set in self.watch_objects(self.AppsV1Api.list_namespaced_stateful_set,
+                                                           field_selector='metadata.name='+name, timeout=timeout):
+            if event_type == 'DELETED':
+                raise OperetoRuntimeError(error='Stateful set {} was deleted while waiting for it.'.format(name))
+            if condition(stateful_set):
+                return stateful_set
+        return None
+
+    def create_pod(self, pod_manifest, timeout=None, wait=True):
         pod_name = pod_manifest['metadata']['name']
-        self.v1.create_namespaced_pod(body=pod_manifest, namespace=self.namespace)
-        while True:
-            resp = self.get_pod(pod_name)
-            if resp.status.phase != 'Pending':
-                print 'Pod status: {}'.format(resp.status.phase)
-                break
-            time.sleep(2)
+        start_time = time.time()
+        resp = self.v1.create_namespaced_pod(body=pod_manifest, namespace=self.namespace)
+        if not wait:
+            return resp
+        resp, met_at = self.wait_for_pod(pod_name, phases=POD_STARTED_PHASES, timeout=timeout)
+        print('Pod status: {} (after {:.2f} seconds)'.format(resp.status.phase, met_at-start_time))
         return resp
 
-    def modify_pod(self, pod_name, deployment_manifest):
+    def dry_run_pod(self, pod_manifest):
+        """
+        Submits a pod with server-side dry run (validation, defaulting and admission without persisting it).
+        Returns the defaulted pod, as a dict. Raises ApiException if the pod is rejected.
+        """
+        resp = self.v1.create_namespaced_pod(body=pod_manifest, namespace=self.namespace, dry_run='All')
+        return get_api_client(self.context).sanitize_for_serialization(resp)
+
+    def modify_pod(self, pod_name, deployment_manifest, timeout=None):
+        start_time = time.time()
         self.v1.patch_namespaced_pod(name=pod_name, body=deployment_manifest, namespace=self.namespace)
-        time.sleep(5)
-        while True:
-            resp = self.get_pod(pod_name)
-            if resp.status.phase == 'Running':
-                print('Pod status: {}'.format(resp.status.phase))
+        resp, met_at = self.wait_for_pod(pod_name, phases=['Running'], timeout=timeout)
+        print('Pod status: {} (after {:.2f} seconds)'.format(resp.status.phase, met_at-start_time))
+        return resp
+
+    def watch_objects(self, list_func, field_selector=None, label_selector=None, timeout=POD_WAIT_TIMEOUT, sync_marker=False):
+        """
+        Yields (event_type, object) tuples for the objects matching the given selectors, starting with an
+        'INITIAL' event per existing object (followed by a ('SYNCED', None) event if sync_marker is set). The watch is resumed from the last seen resourceVersion when
+        the server closes it, and re-listed when that version has expired (410). Stops at the deadline (never if the
+        timeout is None).
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        selectors = {}
+        if field_selector:
+            selectors['field_selector'] = field_selector
+        if label_selector:
+            selectors['label_selector'] = label_selector
+        resource_version = None
+        while deadline is None or time.time() < deadline:
+            if resource_version is None:
+                resp = list_func(self.namespace, **selectors)
+                resource_version = resp.metadata.resource_version
+                for item in resp.items:
+                    yield 'INITIAL', item
+                if sync_marker:
+                    yield 'SYNCED', None
+            window = WATCH_WINDOW_SECONDS if deadline is None else int(min(WATCH_WINDOW_SECONDS, deadline - time.time()))
+            if window <= 0:
                 break
-            time.sleep(1)
+            w = watch.Watch()
+            try:
+                for event in w.stream(list_func, self.namespace, resource_version=resource_version,
+                                      timeout_seconds=window, **selectors):
+                    if event['type'] == 'ERROR':
+                        if event['raw_object'].get('code') == 410:
+                            resource_version = None
+                            break
+                        raise OperetoRuntimeError(error='Watch failed: {}'.format(event['raw_object'].get('message')))
+                    if event['type'] == 'BOOKMARK':
+                        continue
+                    resource_version = event['object'].metadata.resource_version
+                    yield event['type'], event['object']
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                resource_version = None
+            finally:
+                w.stop()
+
+    def pod_wait(self, pod_name, phases=None, ready=False, containers_started=None):
+        """
+        Returns a PendingWait, checked by the pod informer, met once the pod reaches one of the given phases and,
+        optionally, is Ready and has the given containers started. The pod informer must be enabled and cover the pod.
+        """
+        conditions = []
+        if phases:
+            conditions.append(pod_phase_in(*phases))
+        if ready:
+            conditions.append(pod_ready)
+        for container_name in containers_started or []:
+            conditions.append(container_started(container_name))
+
+        def _fail(pod):
+            if pod.status is not None and pod.status.phase in POD_TERMINAL_PHASES and phases and pod.status.phase not in phases:
+                return 'Pod {} ended with phase {} while waiting for it.'.format(pod_name, pod.status.phase)
+        return self.informers['pods'].wait_for(pod_name, lambda pod: all(condition(pod) for condition in conditions), fail=_fail)
+
+    def wait_for_pod(self, pod_name, phases=None, ready=False, containers_started=None, timeout=None):
+        """
+        Waits until the pod reaches one of the given phases and, optionally, is Ready and has the given containers
+        started, using the pod informer if enabled and a pod watch otherwise. Waits without a limit if the timeout
+        is None. Returns the pod and the time the condition was met.
+        """
+        if 'pods' in self.informers:
+            wait = self.pod_wait(pod_name, phases=phases, ready=ready, containers_started=containers_started)
+            return wait.get(timeout), wait.met_at
+
+        conditions = []
+        if phases:
+            conditions.append(pod_phase_in(*phases))
+        if ready:
+            conditions.append(pod_ready)
+        for container_name in containers_started or []:
+            conditions.append(container_started(container_name))
+
+        for event_type, pod in self.watch_objects(self.v1.list_namespaced_pod, field_selector='metadata.name='+pod_name, timeout=timeout):
+            if event_type == 'DELETED':
+                raise OperetoRuntimeError(error='Pod {} was deleted while waiting for it.'.format(pod_name))
+            if all(condition(pod) for condition in conditions):
+                return pod, time.time()
+            if pod.status is not None and pod.status.phase in POD_TERMINAL_PHASES and phases and pod.status.phase not in phases:
+                raise OperetoRuntimeError(error='Pod {} ended with phase {} while waiting for it.'.format(pod_name, pod.status.phase))
+        raise OperetoRuntimeError(error='Timed out after {} seconds waiting for pod {}.'.format(timeout, pod_name))
+
+    def patch_pod(self, pod_name, patch):
+        resp = self.v1.patch_namespaced_pod(name=pod_name, body=patch, namespace=self.namespace)
         return resp
 
     def delete_pod(self, pod_name):
@@ -67,40 +743,267 @@ class KubernetesAPI(object):
         return resp
 
     def get_pod(self, pod_name):
+        informer = self._synced_informer('pods')
+        if informer is not None and informer.get(pod_name) is not None:
+            return informer.get(pod_name)
         resp = self.v1.read_namespaced_pod(name=pod_name, namespace=self.namespace)
         return resp
 
-    def print_pod_log(self, pod_name, container=None):
+    def get_pod_metrics(self, pod_name):
+        """
+        Returns the current usage of the pod containers from the metrics API (requires metrics-server).
+        """
+        return get_api_group('CustomObjectsApi', self.context).get_namespaced_custom_object(
+            'metrics.k8s.io', 'v1beta1', self.namespace, 'pods', pod_name)
+
+    def get_pod_events(self, pod_name):
+        return self.v1.list_namespaced_event(self.namespace, field_selector='involvedObject.name='+pod_name).items
+
+    def create_job(self, job_manifest):
+        resp = self.batch_api.create_namespaced_job(body=job_manifest, namespace=self.namespace)
+        return resp
+
+    def dry_run_job(self, job_manifest):
+        """
+        Submits a job with server-side dry run, including the validation of its pod template. Returns the defaulted
+        job, as a dict. Raises ApiException if the job is rejected.
+        """
+        resp = self.batch_api.create_namespaced_job(body=job_manifest, namespace=self.namespace, dry_run='All')
+        return get_api_client(self.context).sanitize_for_serialization(resp)
+
+    def get_job(self, name):
+        resp = self.batch_api.read_namespaced_job(name=name, namespace=self.namespace)
+        return resp
+
+    def delete_job(self, name, propagation_policy='Background'):
+        resp = self.batch_api.delete_namespaced_job(name=name, namespace=self.namespace, body={}, propagation_policy=propagation_policy)
+        return resp
+
+    def read_pod_log(self, pod_name, container=None, tail_lines=None):
+        kwargs = {}
+        if container:
+            kwargs['container'] = container
+        if tail_lines:
+            kwargs['tail_lines'] = tail_lines
+        return self.v1.read_namespaced_pod_log(name=pod_name, namespace=self.namespace, **kwargs)
+
+    def print_pod_log(self, pod_name, container=None, prefix=''):
         w = watch.Watch()
         for e in w.stream(self.v1.read_namespaced_pod_log, name=pod_name, namespace=self.namespace, container=container,
                           follow=True,
                           _preload_content=False):
             try:
-                print(str(e))
+                print(prefix+str(e))
             except UnicodeDecodeError:
-                print(e.encode('ascii', 'ignore'))
+                print(prefix+e.encode('ascii', 'ignore'))
             except Exception as e:
                 print(e)
 
-    def cp(self, pod_id, pod_path, current_path, direction='copy_from'):
-        if direction=='copy_from':
-            (exc, out,err) = run_shell_cmd('kubectl cp {}/{}:{} {}'.format(self.namespace, pod_id, pod_path, current_path))
-            return int(exc)
-        elif direction=='copy_to':
-            (exc, out, err) = run_shell_cmd('kubectl cp {} {}/{}:{}'.format(current_path, self.namespace, pod_id, pod_path))
-            return int(exc)
-        else:
-            raise OperetoRuntimeError(error='Invalid copy direction.')
-
-    def create_config_map(self, configmap_name, config_data={}, labels={}):
+    def cp(self, pod_id, pod_path, current_path, direction='copy_from', container=None, compress=False, progress_callback=None):
+        """
+        Copies a file or directory from/to a pod by streaming a tar archive over the exec websocket.
+        The archive is base64 encoded on the wire and spooled to a local temporary file in chunks.
+        progress_callback, if given, is called with (transferred_bytes, elapsed_seconds) after every chunk.
+        Returns 0 on success and raises OperetoRuntimeError on failure.
+        """
+        with api_metrics.timed('cp'):
+            if direction=='copy_from':
+                transferred, elapsed = self._copy_from_pod(pod_id, pod_path, current_path, container, compress, progress_callback)
+            elif direction=='copy_to':
+                transferred, elapsed = self._copy_to_pod(pod_id, pod_path, current_path, container, compress, progress_callback)
+            else:
+                raise OperetoRuntimeError(error='Invalid copy direction.')
+        print('Copied {} bytes {} pod {} in {:.2f} seconds ({:.1f} KB/s)'.format(
+            transferred, 'from' if direction=='copy_from' else 'to', pod_id, elapsed, transferred/1024.0/max(elapsed, 0.001)))
+        return 0
+
+    def _exec_stream(self, pod_id, command, container=None, stdin=False):
+        kwargs = {'command': ['sh', '-c', command], 'stderr': True, 'stdin': stdin, 'stdout': True, 'tty': False,
+                  '_preload_content': False}
+        if container:
+            kwargs['container'] = container
+        return stream(get_exec_api(self.context).connect_get_namespaced_pod_exec, pod_id, self.namespace, **kwargs)
+
+    def _check_exec_result(self, resp, pod_id, stderr):
+        resp.close()
+        returncode = getattr(resp, 'returncode', None)
+        if returncode or (returncode is None and stderr):
+            raise OperetoRuntimeError(error='Exec in pod {} failed (exit code {}): {}'.format(pod_id, returncode, ''.join(stderr)))
+
+    def exec_command(self, pod_id, command, container=None):
+        """
+        Runs a shell command in a pod container and returns its stdout. Raises OperetoRuntimeError if it fails.
+        """
+        stdout = []
+        stderr = []
+        resp = self._exec_stream(pod_id, command, container=container)
+        while True:
+            if resp.is_open():
+                resp.update(timeout=COPY_READ_TIMEOUT)
+            if resp.peek_stdout():
+                stdout.append(resp.read_stdout())
+            if resp.peek_stderr():
+                stderr.append(resp.read_stderr())
+            if not resp.is_open() and not resp.peek_stdout():
+                break
+        self._check_exec_result(resp, pod_id, stderr)
+        return ''.join(stdout)
+
+    def _receive_archive(self, pod_id, command, archive_path, container, progress_callback=None):
+        """
+        Runs a command writing a base64 encoded archive to stdout in the pod and decodes it into archive_path.
+        Returns the number of archive bytes received.
+        """
+        start_time = time.time()
+        transferred = 0
+        encoded = ''
+        stderr = []
+        resp = self._exec_stream(pod_id, command, container=container)
+        with open(archive_path, 'wb') as archive:
+            while True:
+                if resp.is_open():
+                    resp.update(timeout=COPY_READ_TIMEOUT)
+                if resp.peek_stdout():
+                    encoded += ''.join(resp.read_stdout().split())
+                if resp.peek_stderr():
+                    stderr.append(resp.read_stderr())
+                decodable = len(encoded) - len(encoded) % 4
+                if decodable:
+                    chunk = base64.b64decode(encoded[:decodable])
+                    encoded = encoded[decodable:]
+                    archive.write(chunk)
+                    transferred += len(chunk)
+                    if progress_callback:
+                        progress_callback(transferred, time.time()-start_time)
+                if not resp.is_open() and not resp.peek_stdout():
+                    break
+        self._check_exec_result(resp, pod_id, stderr)
+        if encoded:
+            raise OperetoRuntimeError(error='Truncated archive received from pod {}.'.format(pod_id))
+        return transferred
+
+    def _extract_archive(self, archive_path, extract_dir):
+        with tarfile.open(archive_path, 'r:*') as archive:
+            members = [member for member in archive.getmembers()
+                       if not os.path.isabs(member.name) and '..' not in member.name.split('/')]
+            archive.extractall(extract_dir, members=members)
+
+    def _copy_from_pod(self, pod_id, pod_path, current_path, container, compress, progress_callback):
+        pod_path = pod_path.rstrip('/')
+        source_dir, source_name = os.path.dirname(pod_path) or '/', os.path.basename(pod_path)
+        command = 'tar c{}f - -C {} {} | base64'.format('z' if compress else '', quote(source_dir), quote(source_name))
+        temp_dir = tempfile.mkdtemp(prefix='opereto-cp-')
+        archive_path = os.path.join(temp_dir, 'archive.tar')
+        start_time = time.time()
+        try:
+            transferred = self._receive_archive(pod_id, command, archive_path, container, progress_callback)
+            extract_dir = os.path.join(temp_dir, 'extract')
+            self._extract_archive(archive_path, extract_dir)
+            if not os.path.exists(os.path.join(extract_dir, source_name)):
+                raise OperetoRuntimeError(error='{} was not found in the archive copied from pod {}.'.format(pod_path, pod_id))
+            shutil.move(os.path.join(extract_dir, source_name), current_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return transferred, time.time()-start_time
+
+    def sync_from_pod(self, pod_id, pod_dir, current_dir, container=None, incremental=True):
+        """
+        Copies the files of a pod directory into a local directory (overwriting existing files). If incremental,
+        only the files modified since the previous incremental sync are copied, tracked by a marker file in the pod.
+        Returns the number of archive bytes transferred (0 if nothing changed).
+        """
+        pod_dir = pod_dir.rstrip('/') or '/'
+        marker = '/tmp/.opereto-sync-'+hashlib.sha1(pod_dir.encode('utf-8')).hexdigest()[:12]
+        find = 'find . -type f'
+        if incremental:
+            find = 'if [ -f {0} ]; then find . -type f -newer {0}; else find . -type f; fi'.format(marker)
+        ## the next marker is touched before listing, so a file changing during the sync is copied again next time
+        command = ('cd {0} && touch {1}.next && {{ {2}; }} > {1}.list && '
+                   'if [ -s {1}.list ]; then tar cf - -T {1}.list | base64; fi && mv {1}.next {1}').format(quote(pod_dir), marker, find)
+        temp_dir = tempfile.mkdtemp(prefix='opereto-sync-')
+        archive_path = os.path.join(temp_dir, 'archive.tar')
+        try:
+            with api_metrics.timed('sync_from_pod'):
+                transferred = self._receive_archive(pod_id, command, archive_path, container)
+            if transferred:
+                self._extract_archive(archive_path, current_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return transferred
+
+    def _copy_to_pod(self, pod_id, pod_path, current_path, container, compress, progress_callback):
+        pod_path = pod_path.rstrip('/')
+        target_dir, target_name = os.path.dirname(pod_path) or '/', os.path.basename(pod_path)
+        temp_dir = tempfile.mkdtemp(prefix='opereto-cp-')
+        archive_path = os.path.join(temp_dir, 'archive.tar')
+        start_time = time.time()
+        transferred = 0
+        stderr = []
+        try:
+            with tarfile.open(archive_path, 'w:gz' if compress else 'w') as archive:
+                archive.add(current_path, arcname=target_name)
+            archive_size = os.path.getsize(archive_path)
+            encoded_size = 4 * ((archive_size + 2) // 3)
+            ## stdin is never closed over the exec websocket, so the pod side reads exactly the encoded size
+            command = 'mkdir -p {0} && head -c {1} | base64 -d | tar x{2}f - -C {0}'.format(
+                quote(target_dir), encoded_size, 'z' if compress else '')
+            resp = self._exec_stream(pod_id, command, container=container, stdin=True)
+            with open(archive_path, 'rb') as archive:
+                while True:
+                    chunk = archive.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    resp.write_stdin(base64.b64encode(chunk).decode('ascii'))
+                    transferred += len(chunk)
+                    if progress_callback:
+                        progress_callback(transferred, time.time()-start_time)
+                    resp.update(timeout=0)
+                    if resp.peek_stderr():
+                        stderr.append(resp.read_stderr())
+            while resp.is_open():
+                resp.update(timeout=COPY_READ_TIMEOUT)
+                if resp.peek_stderr():
+                    stderr.append(resp.read_stderr())
+            self._check_exec_result(resp, pod_id, stderr)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return transferred, time.time()-start_time
+
+    def create_config_map(self, configmap_name, config_data={}, labels={}, immutable=False, exist_ok=False):
         try:
             if config_data:
-                body = kubernetes_client.V1ConfigMap(data=config_data, metadata=kubernetes_client.V1ObjectMeta(name=configmap_name, namespace=self.namespace, labels=labels))
+                body = {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "metadata": {
+                        "name": configmap_name,
+                        "namespace": self.namespace,
+                        "labels": labels
+                    },
+                    "data": config_data
+                }
+                if immutable:
+                    body['immutable'] = True
                 api_response = self.v1.create_namespaced_config_map(self.namespace, body=body, pretty=True)
                 return api_response
+        except ApiException as e:
+            if exist_ok and e.status == 409:
+                return self.get_config_map(configmap_name)
+            raise OperetoRuntimeError(error="Failed to create config map {}: {}".format(configmap_name, e))
         except Exception as e:
             raise OperetoRuntimeError(error="Failed to create config map {}: {}".format(configmap_name, e))
 
+    def get_config_map(self, configmap_name):
+        informer = self._synced_informer('config_maps')
+        if informer is not None and informer.get(configmap_name) is not None:
+            return informer.get(configmap_name)
+        return self.v1.read_namespaced_config_map(configmap_name, self.namespace)
+
+    def get_config_maps_by_label(self, pid):
+        informer = self._synced_informer('config_maps', pid=pid)
+        if informer is not None:
+            return informer.list_objects(pid=pid)
+        return self.v1.list_namespaced_config_map(self.namespace, label_selector='{}={}'.format(PID_LABEL, pid)).items
 
     def delete_config_map(self, configmap_name):
         try:
@@ -109,7 +1012,184 @@ class KubernetesAPI(object):
         except Exception as e:
             raise OperetoRuntimeError(error='Failed to delete config map {}: {}'.format(configmap_name, e))
 
+    def acquire_shared_config_map(self, configmap_name, user, config_data={}, labels={}):
+        """
+        Creates the immutable config map if it does not exist yet and records the user in its annotations, so that
+        it is not deleted while in use. Creation is retried if the last user deleted the config map in between.
+        """
+        annotation = SHARED_USER_ANNOTATION_PREFIX + _annotation_name(user)
+        for attempt in range(SHARED_ACQUIRE_ATTEMPTS):
+            self.create_config_map(configmap_name, config_data=config_data, labels=labels, immutable=True, exist_ok=True)
+            try:
+                return self.v1.patch_namespaced_config_map(configmap_name, self.namespace,
+                                                           {'metadata': {'annotations': {annotation: str(int(time.time()))}}})
+            except ApiException as e:
+                if e.status != 404:
+                    raise OperetoRuntimeError(error='Failed to acquire shared config map {}: {}'.format(configmap_name, e))
+        raise OperetoRuntimeError(error='Failed to acquire shared config map {}: deleted concurrently'.format(configmap_name))
+
+    def release_shared_config_map(self, configmap_name, user):
+        """
+        Removes the user from the annotations of the shared config map and deletes it if it was the last user.
+        The deletion is conditioned on the resource version read, so it fails if another user was added since.
+        Returns whether the config map was deleted.
+        """
+        annotation = SHARED_USER_ANNOTATION_PREFIX + _annotation_name(user)
+        try:
+            config_map = self.v1.patch_namespaced_config_map(configmap_name, self.namespace,
+                                                             {'metadata': {'annotations': {annotation: None}}})
+            users = [key for key in (config_map.metadata.annotations or {}) if key.startswith(SHARED_USER_ANNOTATION_PREFIX)]
+            if users:
+                return False
+            self.v1.delete_namespaced_config_map(configmap_name, self.namespace, body=kubernetes_client.V1DeleteOptions(
+                preconditions=kubernetes_client.V1Preconditions(resource_version=config_map.metadata.resource_version)))
+            return True
+        except ApiException as e:
+            if e.status == 404:
+                return False
+            if e.status == 409:
+                ## a user was added after the annotation was removed
+                return False
+            raise OperetoRuntimeError(error='Failed to release shared config map {}: {}'.format(configmap_name, e))
+
+    def _collection_funcs(self, kind):
+        return {
+            'pods': (self.v1.delete_collection_namespaced_pod, self.v1.list_namespaced_pod),
+            'config_maps': (self.v1.delete_collection_namespaced_config_map, self.v1.list_namespaced_config_map),
+            'jobs': (self.batch_api.delete_collection_namespaced_job, self.batch_api.list_namespaced_job),
+            'stateful_sets': (self.AppsV1Api.delete_collection_namespaced_stateful_set, self.AppsV1Api.list_namespaced_stateful_set)
+        }[kind]
 
+    def iter_objects(self, kind, label_selector=None, limit=500):
+        """
+        Yields the objects of the given kind (pods, jobs, config_maps or stateful_sets) matching the label selector,
+        listing them page by page. The listing restarts if the continue token expires (410), so objects may be
+        yielded more than once.
+        """
+        list_func = self._collection_funcs(kind)[1]
+        continue_token = None
+        while True:
+            selectors = {'limit': limit}
+            if label_selector:
+                selectors['label_selector'] = label_selector
+            if continue_token:
+                selectors['_continue'] = continue_token
+            try:
+                resp = list_func(self.namespace, **selectors)
+            except ApiException as e:
+                if e.status != 410 or not continue_token:
+                    raise
+                continue_token = None
+                continue
+            for item in resp.items:
+                yield item
+            continue_token = resp.metadata._continue
+            if not continue_token:
+                break
+
+    def delete_collection(self, kind, label_selector, propagation_policy='Background', wait=False, timeout=DELETE_WAIT_TIMEOUT,
+                          grace_period_seconds=None):
+        """
+        Deletes all objects of the given kind (pods, jobs, config_maps or stateful_sets) matching the label selector
+        with a single call, optionally waiting until they are gone.
+        """
+        delete_func, list_func = self._collection_funcs(kind)
+        resp = delete_func(self.namespace, label_selector=label_selector,
+                           body=kubernetes_client.V1DeleteOptions(propagation_policy=propagation_policy,
+                                                                  grace_period_seconds=grace_period_seconds))
+        if wait:
+            pid = label_selector[len(PID_LABEL)+1:] if label_selector.startswith(PID_LABEL+'=') else None
+            informer = self._synced_informer(kind, pid=pid) if pid and ',' not in pid else None
+            if informer is not None:
+                if not informer.wait_until(lambda: not informer.by_pid.get(pid), timeout):
+                    raise OperetoRuntimeError(error='Timed out after {} seconds waiting for the deletion of {}: {}'.format(
+                        timeout, label_selector, ', '.join(sorted(informer.by_pid.get(pid, {})))))
+            else:
+                self.wait_for_deletion(list_func, label_selector, timeout=timeout)
+        return resp
+
+    def wait_for_deletion(self, list_func, label_selector, timeout=DELETE_WAIT_TIMEOUT):
+        """
+        Waits (using a watch) until no object matches the label selector.
+        """
+        listed = set()
+        remaining = None
+        for event_type, obj in self.watch_objects(list_func, label_selector=label_selector, timeout=timeout, sync_marker=True):
+            if event_type == 'INITIAL':
+                listed.add(obj.metadata.name)
+                continue
+            if event_type == 'SYNCED':
+                remaining, listed = listed, set()
+            elif event_type == 'DELETED':
+                remaining.discard(obj.metadata.name)
+            else:
+                remaining.add(obj.metadata.name)
+            if not remaining:
+                return
+        raise OperetoRuntimeError(error='Timed out after {} seconds waiting for the deletion of {}: {}'.format(
+            timeout, label_selector, ', '.join(sorted(remaining or []))))
+
+    def delete_by_label(self, label_selector, kinds=DELETE_COLLECTION_KINDS, propagation_policy='Background', wait=False,
+                        timeout=DELETE_WAIT_TIMEOUT, grace_period_seconds=None):
+        """
+        Deletes the objects of all given kinds matching the label selector concurrently, one call per kind.
+        Returns a map of kind to error for the kinds that could not be deleted.
+        """
+
+        def _delete(kind):
+            try:
+                self.delete_collection(kind, label_selector, propagation_policy=propagation_policy, wait=wait, timeout=timeout,
+                                       grace_period_seconds=grace_period_seconds)
+                return kind, None
+            except Exception as e:
+                return kind, e
+
+        pool = ThreadPool(len(kinds))
+        try:
+            results = pool.map(_delete, kinds)
+        finally:
+            pool.close()
+            pool.join()
+        return dict((kind, error) for kind, error in results if error is not None)
+
+
+class AsyncKubernetesAPI(object):
+    """
+    Concurrent counterpart of KubernetesAPI: each of its public methods starts the call on the shared, bounded
+    async pool and returns at once with a pending result (get/ready/wait), so independent operations (e.g. config
+    map creation and pod start, or several log streams) overlap. Pod waits are checked by the pod informer and take
+    no thread. Calls running on the pool must not wait for other pool calls.
+    """
 
+    def __init__(self, kubernetes_api=None, pool_size=ASYNC_POOL_SIZE):
+        self.api = kubernetes_api or KubernetesAPI()
+        self.pool = get_async_pool(pool_size)
 
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
 
+        @functools.wraps(attr)
+        def _submit(*args, **kwargs):
+            return self.pool.apply_async(attr, args, kwargs)
+        return _submit
+
+    def wait_for_pod(self, pod_name, phases=None, ready=False, containers_started=None, timeout=None):
+        """
+        Returns a PendingWait met once the pod reaches one of the given phases and, optionally, is Ready and has
+        the given containers started. The wait is checked by the pod informer if enabled, otherwise a pod watch
+        runs on the pool.
+        """
+        if 'pods' in self.api.informers:
+            return self.api.pod_wait(pod_name, phases=phases, ready=ready, containers_started=containers_started)
+        wait = PendingWait(pod_name, None)
+
+        def _wait():
+            try:
+                pod, met_at = self.api.wait_for_pod(pod_name, phases=phases, ready=ready, containers_started=containers_started, timeout=timeout)
+                wait.resolve(pod, met_at=met_at)
+            except Exception as e:
+                wait.resolve(None, error=str(e))
+        self.pool.apply_async(_wait)
+        return wait
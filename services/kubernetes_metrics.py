@@ -0,0 +1,166 @@
+import time
+import json
+import calendar
+import threading
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
+
+METRICS_PREFIX = 'opereto_kubernetes'
+
+
+class ApiMetrics(object):
+    """
+    Process-wide latency and error counters of Kubernetes API calls, by method name.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _call(self, method):
+        return self.calls.setdefault(method, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'throttled': 0, 'retries': 0})
+
+    def record(self, method, seconds, error=False):
+        with self.lock:
+            call = self._call(method)
+            call['count'] += 1
+            call['total'] += seconds
+            call['max'] = max(call['max'], seconds)
+            if error:
+                call['errors'] += 1
+
+    def record_throttled(self, method):
+        with self.lock:
+            self._call(method)['throttled'] += 1
+
+    def record_retry(self, method):
+        with self.lock:
+            self._call(method)['retries'] += 1
+
+    @contextmanager
+    def timed(self, method):
+        start_time = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(method, time.time()-start_time, error=True)
+            raise
+        self.record(method, time.time()-start_time)
+
+    def summary(self):
+        with self.lock:
+            return dict((method, {
+                'count': call['count'],
+                'errors': call['errors'],
+                'throttled': call['throttled'],
+                'retries': call['retries'],
+                'avg': round(call['total'] / call['count'], 4) if call['count'] else 0.0,
+                'max': round(call['max'], 4),
+                'total': round(call['total'], 4)
+            }) for method, call in self.calls.items())
+
+
+class InstrumentedApi(object):
+    """
+    Wraps a Kubernetes API group object so that every public method call is recorded in the given ApiMetrics.
+    """
+
+    def __init__(self, api, metrics):
+        self._api = api
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def _call(*args, **kwargs):
+            with self._metrics.timed(name):
+                return attr(*args, **kwargs)
+        return _call
+
+
+class LifecycleTimer(object):
+    """
+    Records the duration of named lifecycle phases (in the order they were first recorded).
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def record(self, name, seconds):
+        if seconds is not None:
+            self.phases[name] = self.phases.get(name, 0.0) + max(seconds, 0.0)
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time()-start_time)
+
+    def summary(self, metrics=None):
+        summary = {'phases': OrderedDict((name, round(seconds, 3)) for name, seconds in self.phases.items())}
+        if metrics is not None:
+            summary['api_calls'] = metrics.summary()
+        return summary
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1000000.0
+
+
+def pod_startup_durations(pod, events):
+    """
+    Returns the scheduling and image pull durations (in seconds) of a pod, from its conditions and events.
+    """
+    durations = {}
+    created = _timestamp(pod.metadata.creation_timestamp)
+    for condition in (pod.status.conditions or []) if pod.status else []:
+        if condition.type == 'PodScheduled' and condition.status == 'True' and created is not None:
+            durations['scheduling'] = _timestamp(condition.last_transition_time) - created
+    pulling, pulled = [], []
+    for event in events:
+        if event.reason == 'Pulling':
+            pulling.append(_timestamp(event.first_timestamp or event.event_time))
+        elif event.reason == 'Pulled':
+            pulled.append(_timestamp(event.last_timestamp or event.event_time))
+    pulling, pulled = [t for t in pulling if t is not None], [t for t in pulled if t is not None]
+    if pulling and pulled:
+        durations['image_pull'] = max(pulled) - min(pulling)
+    return durations
+
+
+def to_prometheus(summary, prefix=METRICS_PREFIX):
+    lines = [
+        '# TYPE {}_phase_seconds gauge'.format(prefix)
+    ]
+    for name, seconds in summary.get('phases', {}).items():
+        lines.append('{}_phase_seconds{{phase="{}"}} {}'.format(prefix, name, seconds))
+    api_calls = sorted(summary.get('api_calls', {}).items())
+    if api_calls:
+        for family, metric_type, fields in [('api_calls_total', 'counter', [('', 'count')]),
+                                            ('api_errors_total', 'counter', [('', 'errors')]),
+                                            ('api_throttled_total', 'counter', [('', 'throttled')]),
+                                            ('api_retries_total', 'counter', [('', 'retries')]),
+                                            ('api_latency_seconds', 'summary', [('_sum', 'total'), ('_count', 'count')])]:
+            lines.append('# TYPE {}_{} {}'.format(prefix, family, metric_type))
+            for suffix, field in fields:
+                for method, call in api_calls:
+                    lines.append('{}_{}{}{{method="{}"}} {}'.format(prefix, family, suffix, method, call[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def emit_summary(summary, export_path=None):
+    print('Timing summary:\n{}'.format(json.dumps(summary, indent=4)))
+    if export_path:
+        with open(export_path, 'w') as f:
+            f.write(to_prometheus(summary))
+
+
+api_metrics = ApiMetrics()
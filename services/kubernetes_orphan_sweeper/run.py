@@ -0,0 +1,288 @@
+import json
+import time
+import calendar
+import threading
+from multiprocessing.pool import ThreadPool
+from opereto.helpers.services import ServiceTemplate
+from kubernetes_api import KubernetesAPI, PID_LABEL, SHARED_USER_ANNOTATION_PREFIX, SHARED_CONFIGMAP_HASH_LABEL
+from kubernetes import client as kubernetes_client
+from kubernetes.client.rest import ApiException
+from opereto.utils.validations import JsonSchemeValidator
+from opereto.exceptions import OperetoRuntimeError
+from pyopereto.client import OperetoClientError, process_result_statuses
+
+SWEEP_KINDS = ('pods', 'jobs', 'config_maps')
+SHARED_CONFIG_MAPS = 'shared_config_maps'
+SUSPECTS_CONFIGMAP = 'opereto-orphan-sweeper'
+SUSPECTS_UPDATE_RETRIES = 5
+DEFAULT_GRACE_PERIOD = 900
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_PID_BATCH_SIZE = 20
+DEFAULT_REQUESTS_PER_SECOND = 5
+
+
+class RateLimiter(object):
+    """
+    Spaces the calls of all threads so that no more than the given number of calls per second are made.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0/rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ServiceRunner(ServiceTemplate):
+
+    def __init__(self, **kwargs):
+        ServiceTemplate.__init__(self, **kwargs)
+
+    def validate_input(self):
+
+        input_scheme = {
+            "type": "object",
+            "properties": {
+                "namespace": {
+                    "type": ["string", "null"]
+                },
+                "grace_period": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "dry_run": {
+                    "type": ["boolean", "null"]
+                },
+                "page_size": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "pid_batch_size": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "requests_per_second": {
+                    "type": ["number", "null"],
+                    "exclusiveMinimum": 0
+                },
+                "additionalProperties": True
+            }
+        }
+
+        validator = JsonSchemeValidator(self.input, input_scheme)
+        validator.validate()
+
+    def setup(self):
+        self.kubernetes_api = KubernetesAPI(namespace=self.input.get('namespace') or 'default')
+        self.grace_period = self.input.get('grace_period')
+        if self.grace_period is None:
+            self.grace_period = DEFAULT_GRACE_PERIOD
+        self.dry_run = bool(self.input.get('dry_run'))
+        self.page_size = self.input.get('page_size') or DEFAULT_PAGE_SIZE
+        self.pid_batch_size = self.input.get('pid_batch_size') or DEFAULT_PID_BATCH_SIZE
+        self.limiter = RateLimiter(self.input.get('requests_per_second') or DEFAULT_REQUESTS_PER_SECOND)
+        self.report = {}
+
+    def _collect_resources(self):
+        """
+        Returns a map of pid to the names (per kind) of the resources labeled with it, or shared with other pids,
+        and the creation (or shared config map acquisition) time of the newest one, and the names of the shared
+        config maps older than the grace period that have no user at all.
+        """
+        resources = {}
+        unused = {}
+        now = time.time()
+        for obj in self.kubernetes_api.iter_objects('config_maps', label_selector=SHARED_CONFIGMAP_HASH_LABEL, limit=self.page_size):
+            users = dict((key[len(SHARED_USER_ANNOTATION_PREFIX):], acquired) for key, acquired in (obj.metadata.annotations or {}).items()
+                         if key.startswith(SHARED_USER_ANNOTATION_PREFIX))
+            ## a runner that crashed between creating the config map and annotating itself leaves it without users
+            created = calendar.timegm(obj.metadata.creation_timestamp.utctimetuple()) if obj.metadata.creation_timestamp else now
+            if not users and now - created >= self.grace_period:
+                unused[obj.metadata.name] = obj.metadata.resource_version
+            for pid, acquired in users.items():
+                entry = resources.setdefault(pid, {'resources': {}, 'created': 0})
+                names = entry['resources'].setdefault(SHARED_CONFIG_MAPS, [])
+                if obj.metadata.name not in names:
+                    names.append(obj.metadata.name)
+                entry['created'] = max(entry['created'], int(acquired or 0))
+        for kind in SWEEP_KINDS:
+            for obj in self.kubernetes_api.iter_objects(kind, label_selector=PID_LABEL, limit=self.page_size):
+                pid = obj.metadata.labels[PID_LABEL]
+                entry = resources.setdefault(pid, {'resources': {}, 'created': 0})
+                names = entry['resources'].setdefault(kind, [])
+                if obj.metadata.name not in names:
+                    names.append(obj.metadata.name)
+                if obj.metadata.creation_timestamp is not None:
+                    entry['created'] = max(entry['created'], calendar.timegm(obj.metadata.creation_timestamp.utctimetuple()))
+        return resources, unused
+
+    def _process_state(self, pid):
+        """
+        Returns running, ended, kept (ended with keep_pod_running), missing or None (unknown).
+        """
+        try:
+            self.limiter.wait()
+            status = self.client.get_process_status(pid)
+            if status not in process_result_statuses:
+                return pid, 'running'
+            self.limiter.wait()
+            if self.client.get_process_property(pid, 'keep_pod_running'):
+                return pid, 'kept'
+            return pid, 'ended'
+        except OperetoClientError as e:
+            if e.code == 404:
+                return pid, 'missing'
+            print('Failed to get the status of process {}: {}'.format(pid, e))
+            return pid, None
+
+    def _process_states(self, pids):
+        states = {}
+        pool = ThreadPool(self.pid_batch_size)
+        try:
+            for start in range(0, len(pids), self.pid_batch_size):
+                states.update(pool.map(self._process_state, pids[start:start+self.pid_batch_size]))
+        finally:
+            pool.close()
+            pool.join()
+        return states
+
+    def _update_suspects(self, update_func):
+        """
+        Applies update_func to the suspected orphan pids (pid to first seen time) stored in a config map, so that
+        a pid is swept only after it has been seen orphaned for the whole grace period. Returns the updated map.
+        In dry run mode the stored suspects are only read and the update is kept in memory, so a dry run reports
+        what a real run would sweep without changing the grace period of the real runs.
+        """
+        for attempt in range(SUSPECTS_UPDATE_RETRIES):
+            try:
+                stored = self.kubernetes_api.v1.read_namespaced_config_map(SUSPECTS_CONFIGMAP, self.kubernetes_api.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                if self.dry_run:
+                    return update_func({})
+                self.kubernetes_api.create_config_map(SUSPECTS_CONFIGMAP, config_data={'suspects': '{}'}, exist_ok=True)
+                continue
+            suspects = update_func(json.loads((stored.data or {}).get('suspects') or '{}'))
+            if self.dry_run:
+                return suspects
+            try:
+                self.kubernetes_api.v1.replace_namespaced_config_map(SUSPECTS_CONFIGMAP, self.kubernetes_api.namespace, {
+                    'metadata': {
+                        'name': SUSPECTS_CONFIGMAP,
+                        'resourceVersion': stored.metadata.resource_version
+                    },
+                    'data': {'suspects': json.dumps(suspects)}
+                })
+                return suspects
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+        raise OperetoRuntimeError(error='Failed to update the orphan suspects config map {}.'.format(SUSPECTS_CONFIGMAP))
+
+    def _sweep(self, pid, resources):
+        """
+        Deletes the resources labeled with the pid and releases the shared config maps used by it (deleting those
+        it was the last user of). Returns the errors per kind.
+        """
+        errors = {}
+        kinds = tuple(kind for kind in resources if kind in SWEEP_KINDS)
+        if kinds:
+            errors.update(self.kubernetes_api.delete_by_label('{}={}'.format(PID_LABEL, pid), kinds=kinds))
+        for configmap_name in resources.get(SHARED_CONFIG_MAPS, []):
+            self.limiter.wait()
+            try:
+                self.kubernetes_api.release_shared_config_map(configmap_name, pid)
+            except OperetoRuntimeError as e:
+                errors[SHARED_CONFIG_MAPS] = e
+        return errors
+
+    def _delete_unused(self, unused):
+        """
+        Deletes shared config maps without users, conditioned on their resource version so that a config map
+        acquired in between is kept. Returns the names of the deleted config maps.
+        """
+        deleted = []
+        for configmap_name, resource_version in sorted(unused.items()):
+            self.limiter.wait()
+            try:
+                self.kubernetes_api.v1.delete_namespaced_config_map(configmap_name, self.kubernetes_api.namespace, body=kubernetes_client.V1DeleteOptions(
+                    preconditions=kubernetes_client.V1Preconditions(resource_version=resource_version)))
+                deleted.append(configmap_name)
+            except ApiException as e:
+                if e.status not in [404, 409]:
+                    print('Failed to delete unused shared config map {}: {}'.format(configmap_name, e.reason))
+        return deleted
+
+    def process(self):
+        now = time.time()
+        print('Listing task resources in namespace {}..'.format(self.kubernetes_api.namespace))
+        resources, unused = self._collect_resources()
+        candidates = sorted(pid for pid, entry in resources.items() if now - entry['created'] >= self.grace_period)
+        print('Found {} task pids, {} with resources older than {} seconds'.format(len(resources), len(candidates), self.grace_period))
+
+        states = self._process_states(candidates)
+        orphans = [pid for pid in candidates if states.get(pid) in ['ended', 'missing']]
+
+        def _refresh(suspects):
+            return dict((pid, suspects.get(pid, now)) for pid in orphans)
+
+        suspects = self._update_suspects(_refresh)
+        expired = [pid for pid in orphans if now - suspects[pid] >= self.grace_period]
+
+        swept = {}
+        failed = {}
+        for pid in expired:
+            if self.dry_run:
+                swept[pid] = resources[pid]['resources']
+                continue
+            self.limiter.wait()
+            errors = self._sweep(pid, resources[pid]['resources'])
+            if errors:
+                failed[pid] = dict((kind, str(error)) for kind, error in errors.items())
+            else:
+                swept[pid] = resources[pid]['resources']
+
+        unused_swept = sorted(unused) if self.dry_run else self._delete_unused(unused)
+
+        if swept and not self.dry_run:
+            self._update_suspects(lambda current: dict((pid, first_seen) for pid, first_seen in current.items() if pid not in swept))
+
+        self.report = {
+            'dry_run': self.dry_run,
+            'namespace': self.kubernetes_api.namespace,
+            'pids': len(resources),
+            'running': len([pid for pid in candidates if states.get(pid) == 'running']),
+            'kept': sorted(pid for pid in candidates if states.get(pid) == 'kept'),
+            'unknown': sorted(pid for pid in candidates if states.get(pid) is None),
+            'suspected': dict((pid, int(now - suspects[pid])) for pid in orphans if pid not in expired),
+            'swept': swept,
+            'unused_shared_config_maps': unused_swept,
+            'failed': failed
+        }
+        print('{} {} orphaned task pids: {}'.format('Would sweep' if self.dry_run else 'Swept', len(swept), json.dumps(swept, indent=4)))
+        if unused_swept:
+            print('{} {} unused shared config maps: {}'.format('Would delete' if self.dry_run else 'Deleted', len(unused_swept), ', '.join(unused_swept)))
+        if self.report['suspected']:
+            print('Suspected orphans within their grace period: {}'.format(json.dumps(self.report['suspected'], indent=4)))
+        if failed:
+            print('Failed to sweep: {}'.format(json.dumps(failed, indent=4)))
+            return self.client.FAILURE
+        return self.client.SUCCESS
+
+    def teardown(self):
+        try:
+            self.client.modify_process_property('sweep_report', self.report)
+        except Exception as e:
+            print('Failed to store sweep report: {}'.format(e))
+
+
+if __name__ == "__main__":
+    exit(ServiceRunner().run())
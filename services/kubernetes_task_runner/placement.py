@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import fcntl
+import random
+import tempfile
+from urllib3.exceptions import HTTPError
+from kubernetes.client.rest import ApiException
+from kubernetes.config.config_exception import ConfigException
+from kubernetes_api import get_api_group, parse_quantity
+from opereto.exceptions import OperetoRuntimeError
+
+PLACEMENT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'opereto-placement-cache.json')
+PLACEMENT_CACHE_TTL = 60
+## (connect, read) timeout of the headroom probe calls, which are not retried
+PLACEMENT_PROBE_TIMEOUT = (3, 10)
+QUOTA_RESOURCES = {
+    'cpu': ['requests.cpu', 'cpu'],
+    'memory': ['requests.memory', 'memory'],
+    'pods': ['pods', 'count/pods']
+}
+
+
+def task_requests(pod_template):
+    """
+    Returns the cpu (cores), memory (bytes) and pods requested by a pod template.
+    """
+    requests = {'cpu': 0.0, 'memory': 0.0, 'pods': 1.0}
+    for container in pod_template['spec']['containers']:
+        container_requests = (container.get('resources') or {}).get('requests') or {}
+        for resource in ['cpu', 'memory']:
+            if container_requests.get(resource) is not None:
+                requests[resource] += parse_quantity(container_requests[resource])
+    return requests
+
+
+def target_key(target):
+    return '{}/{}'.format(target.get('context') or 'in-cluster', target.get('namespace') or 'default')
+
+
+class TaskPlacement(object):
+    """
+    Picks the namespace/kubeconfig context target of a task by its headroom: the free ResourceQuota of the
+    namespace and the unrequested allocatable capacity of the cluster nodes. Headroom is cached in a local file
+    shared by the runners of the agent for cache_ttl seconds, and each placement subtracts its requests from the
+    cached headroom so that concurrent tasks spread over the targets. A dimension that cannot be read (e.g. no
+    quota, or no permission to list nodes) does not limit the placement, while a target that cannot be reached
+    (e.g. a missing kubeconfig context or an unreachable API server) is left out for cache_ttl seconds. Targets are
+    probed outside the cache lock, which is only held to merge the probes and reserve the task requests.
+    """
+
+    def __init__(self, targets, cache_path=PLACEMENT_CACHE_PATH, cache_ttl=PLACEMENT_CACHE_TTL):
+        if not targets:
+            raise OperetoRuntimeError(error='At least one placement target must be provided.')
+        self.targets = targets
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+
+    def _quota_headroom(self, core_api, namespace):
+        headroom = {}
+        for quota in core_api.list_namespaced_resource_quota(namespace, _request_timeout=PLACEMENT_PROBE_TIMEOUT).items:
+            hard = (quota.status and quota.status.hard) or {}
+            used = (quota.status and quota.status.used) or {}
+            for resource, keys in QUOTA_RESOURCES.items():
+                for key in keys:
+                    if key in hard:
+                        free = parse_quantity(hard[key]) - parse_quantity(used.get(key, 0))
+                        headroom[resource] = min(headroom.get(resource, free), free)
+        return headroom
+
+    def _cluster_headroom(self, core_api, namespace):
+        headroom = {'cpu': 0.0, 'memory': 0.0, 'pods': 0.0}
+        nodes = set()
+        for node in core_api.list_node(_request_timeout=PLACEMENT_PROBE_TIMEOUT).items:
+            ready = [condition for condition in (node.status.conditions or []) if condition.type == 'Ready' and condition.status == 'True']
+            if node.spec.unschedulable or not ready:
+                continue
+            nodes.add(node.metadata.name)
+            for resource in headroom:
+                headroom[resource] += parse_quantity((node.status.allocatable or {}).get(resource, 0))
+        pods = core_api.list_pod_for_all_namespaces(field_selector='status.phase!=Succeeded,status.phase!=Failed',
+                                                    _request_timeout=PLACEMENT_PROBE_TIMEOUT).items
+        for pod in pods:
+            if pod.spec.node_name not in nodes:
+                continue
+            headroom['pods'] -= 1
+            for container in pod.spec.containers:
+                requests = (container.resources and container.resources.requests) or {}
+                for resource in ['cpu', 'memory']:
+                    if requests.get(resource) is not None:
+                        headroom[resource] -= parse_quantity(requests[resource])
+        return headroom
+
+    def _headroom(self, target):
+        """
+        Returns the headroom of the target, or None if the target cannot be reached.
+        """
+        headroom = {}
+        for name, func in [('quota', self._quota_headroom), ('cluster', self._cluster_headroom)]:
+            try:
+                core_api = get_api_group('CoreV1Api', target.get('context'), retries=0)
+                for resource, free in func(core_api, target.get('namespace') or 'default').items():
+                    headroom[resource] = min(headroom.get(resource, free), free)
+            except ApiException as e:
+                print('Failed to read the {} headroom of target {}: {}'.format(name, target_key(target), e.reason))
+            except (HTTPError, ConfigException) as e:
+                print('Target {} is not reachable, skipping it: {}'.format(target_key(target), e))
+                return None
+        return headroom
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _store_cache(self, cache):
+        temp_path = '{}.{}'.format(self.cache_path, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(temp_path, self.cache_path)
+
+    @staticmethod
+    def _score(headroom, requests):
+        """
+        Returns the smallest ratio of free to requested resource (higher is better), and whether the task fits.
+        """
+        ratios = [headroom[resource] / requests[resource] for resource in requests
+                  if requests[resource] > 0 and headroom.get(resource) is not None]
+        if not ratios:
+            return float('inf'), True
+        return min(ratios), min(ratios) >= 1
+
+    def choose(self, pod_template):
+        """
+        Returns the target (namespace and context) to run the pod template on.
+        """
+        requests = task_requests(pod_template)
+        now = time.time()
+        cache = self._load_cache()
+        probed = {}
+        for target in self.targets:
+            key = target_key(target)
+            if key not in cache or now - cache[key]['time'] > self.cache_ttl:
+                probed[key] = self._headroom(target)
+
+        ## the cache is merged, reserved from and written under a lock, so concurrent runners see each other's placements
+        with open(self.cache_path+'.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            cache = self._load_cache()
+            candidates = []
+            for target in self.targets:
+                key = target_key(target)
+                if key in probed and (key not in cache or now - cache[key]['time'] > self.cache_ttl):
+                    ## unreachable targets are cached too, so that they are not probed again until the entry expires
+                    cache[key] = {'time': now, 'headroom': probed[key]}
+                if key not in cache or cache[key]['headroom'] is None:
+                    continue
+                score, fits = self._score(cache[key]['headroom'], requests)
+                candidates.append((fits, score, random.random(), target))
+            if not candidates:
+                raise OperetoRuntimeError(error='None of the placement targets can be reached.')
+            fits, score, _, target = max(candidates, key=lambda candidate: candidate[:3])
+            if not fits:
+                print('No placement target has enough headroom for the task, using the least loaded target.')
+
+            headroom = cache[target_key(target)]['headroom']
+            for resource, requested in requests.items():
+                if resource in headroom:
+                    headroom[resource] -= requested
+            try:
+                self._store_cache(cache)
+            except (IOError, OSError) as e:
+                print('Failed to store the placement cache: {}'.format(e))
+        return {'namespace': target.get('namespace') or 'default', 'context': target.get('context')}
@@ -0,0 +1,190 @@
+import time
+from kubernetes.client.rest import ApiException
+from kubernetes_api import container_started, get_async_pool
+
+LOG_DRAIN_TIMEOUT = 10
+JOB_COMPLETION_INDEX_ANNOTATION = 'batch.kubernetes.io/job-completion-index'
+
+
+class PodMonitor(object):
+    """
+    Monitors a task pod until its main container ends, the pod is deleted (the task is cancelled) or the timeout
+    is reached. Pod changes are received from the pod informer if enabled (without a watch or thread of its own),
+    or from a single pod watch otherwise. The log of each container is followed on the shared async pool as soon
+    as the container starts, so completion is noticed as soon as the API server reports it.
+    """
+
+    def __init__(self, kubernetes_api, pod_name, main_container, timeout, containers=None):
+        self.kubernetes_api = kubernetes_api
+        self.pod_name = pod_name
+        self.main_container = main_container
+        self.timeout = timeout
+        self.containers = containers or [main_container]
+        self.log_followers = {}
+        self.success = False
+        self.timed_out = False
+        self.cancelled = False
+        self.end_reason = None
+        self.drain_seconds = 0.0
+
+    def _follow_log(self, container):
+        prefix = '[{}] '.format(container) if len(self.containers) > 1 else ''
+        try:
+            self.kubernetes_api.print_pod_log(self.pod_name, container=container, prefix=prefix)
+        except Exception as e:
+            print('Stopped following the log of container {}: {}'.format(container, e))
+
+    def _check_pod(self, pod):
+        if pod.status is None:
+            return False
+        if pod.status.phase not in ['Pending', 'Running']:
+            self.success = pod.status.phase == 'Succeeded'
+            self.end_reason = 'Pod phase is {}'.format(pod.status.phase)
+            return True
+        for container in pod.status.container_statuses or []:
+            if container.name == self.main_container and container.state.terminated is not None:
+                self.success = container.state.terminated.reason == 'Completed'
+                self.end_reason = 'Container {} terminated: {}'.format(container.name, container.state.terminated.reason)
+                return True
+        return False
+
+    def _on_pod(self, pod):
+        """
+        Handles a change of the pod: starts following the logs of the started containers and returns whether
+        monitoring ended.
+        """
+        for container in self.containers:
+            if container not in self.log_followers and container_started(container)(pod):
+                self.log_followers[container] = get_async_pool().apply_async(self._follow_log, (container,))
+        if self._check_pod(pod):
+            return True
+        ## the deletion timestamp is set as soon as the pod deletion is requested, before its grace period
+        if pod.metadata.deletion_timestamp is not None:
+            self.end_reason = 'Pod is being deleted'
+            self.cancelled = True
+            return True
+        return False
+
+    def _watch(self):
+        for event_type, pod in self.kubernetes_api.watch_objects(self.kubernetes_api.v1.list_namespaced_pod,
+                                                                 field_selector='metadata.name='+self.pod_name,
+                                                                 timeout=self.timeout):
+            if event_type == 'DELETED':
+                self.end_reason = 'Pod was deleted'
+                self.cancelled = True
+                return True
+            if self._on_pod(pod):
+                return True
+        return False
+
+    def run(self):
+        deadline = time.time() + self.timeout
+        ended = False
+        try:
+            if 'pods' in self.kubernetes_api.informers:
+                wait = self.kubernetes_api.informers['pods'].wait_for(self.pod_name, self._on_pod)
+                ended = wait.wait(self.timeout)
+                if wait.deleted:
+                    self.end_reason = 'Pod was deleted'
+                    self.cancelled = True
+                elif wait.error:
+                    print('Pod {} monitoring failed: {}'.format(self.pod_name, wait.error))
+            else:
+                ended = self._watch()
+        finally:
+            if not ended and time.time() >= deadline:
+                self.timed_out = True
+                self.end_reason = 'Timed out after {} seconds'.format(self.timeout)
+            self._drain_logs()
+        if self.end_reason:
+            print('Pod {} monitoring ended: {}'.format(self.pod_name, self.end_reason))
+        return self.success
+
+    def _drain_logs(self):
+        start_time = time.time()
+        follower = self.log_followers.get(self.main_container)
+        if follower is not None and not self.cancelled:
+            follower.wait(LOG_DRAIN_TIMEOUT)
+        self.drain_seconds = time.time() - start_time
+
+
+class JobMonitor(object):
+    """
+    Tracks all the shards (pods) of an Indexed Job through a single pod watch, until every index succeeded,
+    the number of failed pods exceeds the job backoff limit, the job is deleted (the task is cancelled) or the
+    timeout is reached.
+    """
+
+    def __init__(self, kubernetes_api, job_name, main_container, completions, backoff_limit, timeout):
+        self.kubernetes_api = kubernetes_api
+        self.job_name = job_name
+        self.main_container = main_container
+        self.completions = completions
+        self.backoff_limit = backoff_limit
+        self.timeout = timeout
+        self.shards = dict((index, {'pod': None, 'phase': 'Pending', 'exit_code': None, 'output': None})
+                           for index in range(completions))
+        self.failed_pods = set()
+        self.timed_out = False
+        self.cancelled = False
+
+    def _shard_index(self, pod):
+        index = (pod.metadata.annotations or {}).get(JOB_COMPLETION_INDEX_ANNOTATION)
+        return int(index) if index is not None else None
+
+    def _update(self, pod):
+        index = self._shard_index(pod)
+        if index is None or index not in self.shards or pod.status is None:
+            return
+        shard = self.shards[index]
+        if shard['phase'] == 'Succeeded':
+            return
+        previous_phase = shard['phase']
+        shard['pod'] = pod.metadata.name
+        shard['phase'] = pod.status.phase
+        for container in pod.status.container_statuses or []:
+            if container.name == self.main_container and container.state.terminated is not None:
+                shard['exit_code'] = container.state.terminated.exit_code
+                shard['output'] = container.state.terminated.message
+        if pod.status.phase == 'Failed':
+            self.failed_pods.add(pod.metadata.name)
+        if shard['phase'] != previous_phase:
+            print('Shard {} ({}): {}'.format(index, pod.metadata.name, shard['phase']))
+
+    def _job_deleted(self):
+        try:
+            return self.kubernetes_api.get_job(self.job_name).metadata.deletion_timestamp is not None
+        except ApiException as e:
+            if e.status == 404:
+                return True
+            raise
+
+    def _ended(self):
+        if len(self.failed_pods) > self.backoff_limit:
+            return True
+        return all(shard['phase'] == 'Succeeded' for shard in self.shards.values())
+
+    def run(self):
+        for event_type, pod in self.kubernetes_api.watch_objects(self.kubernetes_api.v1.list_namespaced_pod,
+                                                                 label_selector='job-name='+self.job_name,
+                                                                 timeout=self.timeout):
+            if event_type != 'DELETED':
+                self._update(pod)
+            ## shard pods are deleted by the garbage collector once the job is deleted
+            if (event_type == 'DELETED' or pod.metadata.deletion_timestamp is not None) and self._job_deleted():
+                self.cancelled = True
+                print('Job {} was deleted.'.format(self.job_name))
+                break
+            if self._ended():
+                break
+        else:
+            self.timed_out = True
+            print('Job {} timed out after {} seconds.'.format(self.job_name, self.timeout))
+        return all(shard['phase'] == 'Succeeded' for shard in self.shards.values())
+
+    def render(self):
+        lines = ['Shards of job {}:'.format(self.job_name)]
+        for index in sorted(self.shards):
+            shard = self.shards[index]
+            lines.append('  {}: {} (pod: {}, exit code: {})'.format(index, shard['phase'], shard['pod'], shard['exit_code']))
+        return '\n'.join(lines)
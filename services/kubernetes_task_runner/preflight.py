@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+from kubernetes.client.rest import ApiException
+
+PREFLIGHT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'opereto-preflight-cache.json')
+PREFLIGHT_CACHE_TTL = 3600
+PREFLIGHT_CACHE_SIZE = 200
+PREFLIGHT_CACHE_MODE = 0o600
+## rejections caused by the template itself (invalid spec), as opposed to quota, permissions or server errors
+PREFLIGHT_INVALID_STATUSES = (400, 422)
+
+
+def normalized_template_hash(pod_template, pid, kubernetes_api):
+    """
+    Returns the verdict cache key of a pod (or job) template: a hash of the template with the task pid (found in
+    the labels and config map names) replaced by a placeholder, and of the namespace and context it is validated in.
+    """
+    template = json.dumps(pod_template, sort_keys=True)
+    for value in set([pid, pid.lower()]):
+        template = template.replace(value, '{pid}')
+    target = '{}/{}'.format(kubernetes_api.context or 'in-cluster', kubernetes_api.namespace)
+    return hashlib.sha1((target+'\0'+template).encode('utf-8')).hexdigest()
+
+
+def _error_message(error):
+    try:
+        return json.loads(error.body)['message']
+    except (TypeError, ValueError, KeyError):
+        return '{} {}'.format(error.status, error.reason)
+
+
+class TemplateVerdictCache(object):
+    """
+    Local cache (a JSON file shared by the runners of the agent, readable only by its owner) of the server-side
+    dry run verdicts of pod templates, keeping the newest max_size entries. Only the verdict and the rejection
+    error are stored, never the templates, since they may carry secrets (e.g. the worker sidecar token).
+    """
+
+    def __init__(self, path=PREFLIGHT_CACHE_PATH, ttl=PREFLIGHT_CACHE_TTL, max_size=PREFLIGHT_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def _read(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        verdict = self._read().get(key)
+        if verdict is not None and time.time() - verdict['time'] <= self.ttl:
+            return verdict
+        return None
+
+    def put(self, key, verdict):
+        verdict['time'] = time.time()
+        with os.fdopen(os.open(self.path+'.lock', os.O_WRONLY | os.O_CREAT, PREFLIGHT_CACHE_MODE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            verdicts = self._read()
+            verdicts[key] = verdict
+            for old_key in sorted(verdicts, key=lambda item: verdicts[item]['time'])[:max(0, len(verdicts)-self.max_size)]:
+                del verdicts[old_key]
+            temp_path = '{}.{}'.format(self.path, os.getpid())
+            with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, PREFLIGHT_CACHE_MODE), 'w') as cache_file:
+                json.dump(verdicts, cache_file, separators=(',', ':'))
+            os.rename(temp_path, self.path)
+
+
+def preflight(kubernetes_api, pod_template, pid, cache):
+    """
+    Validates the final pod template (or the Job manifest of a sharded task) with a server-side dry run, unless a
+    verdict for the same normalized template is cached. Returns the verdict: valid (True, False, or None if the dry run was inconclusive), error, and whether
+    it was cached. Only template errors and successes are cached.
+    """
+    key = normalized_template_hash(pod_template, pid, kubernetes_api)
+    verdict = cache.get(key)
+    if verdict is not None:
+        verdict['cached'] = True
+        return verdict
+    try:
+        if pod_template.get('kind') == 'Job':
+            kubernetes_api.dry_run_job(pod_template)
+        else:
+            kubernetes_api.dry_run_pod(pod_template)
+        verdict = {'valid': True, 'error': None}
+    except ApiException as e:
+        if e.status == 403:
+            return {'valid': False, 'error': _error_message(e), 'cached': False}
+        if e.status not in PREFLIGHT_INVALID_STATUSES:
+            return {'valid': None, 'error': _error_message(e), 'cached': False}
+        verdict = {'valid': False, 'error': _error_message(e)}
+    try:
+        cache.put(key, verdict)
+    except (IOError, OSError) as e:
+        print('Failed to store the pre-flight verdict: {}'.format(e))
+    verdict['cached'] = False
+    return verdict
@@ -0,0 +1,189 @@
+import os
+import copy
+import json
+import math
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+from kubernetes_api import parse_quantity
+
+PROFILE_STORE_PATH = os.path.join(tempfile.gettempdir(), 'opereto-resource-profiles.json')
+PROFILE_MAX_SAMPLES = 50
+PROFILE_MAX_TEMPLATES = 500
+PROFILE_INTERVAL = 15
+PROFILE_EXEC_ATTEMPTS = 3
+CGROUP_FILES = ['memory.peak', 'memory.current', 'memory/memory.max_usage_in_bytes', 'memory/memory.usage_in_bytes', 'cpuacct/cpuacct.usage']
+CGROUP_COMMAND = 'cd /sys/fs/cgroup && for f in {}; do [ -f $f ] && echo "$f $(cat $f)"; done; ' \
+                 '[ -f cpu.stat ] && grep usage_usec cpu.stat; true'.format(' '.join(CGROUP_FILES))
+
+
+def template_hash(pod_template):
+    """
+    Returns the profile key of a pod template: a hash of its spec without the container resources,
+    so that the profile is kept when requests are changed (by hand or by auto-sizing).
+    """
+    spec = copy.deepcopy(pod_template['spec'])
+    for container in spec.get('containers', []):
+        container.pop('resources', None)
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values)-1, max(0, int(math.ceil(percent/100.0*len(values)))-1))
+    return values[index]
+
+
+def format_cpu(cores):
+    return '{}m'.format(max(1, int(math.ceil(cores*1000))))
+
+
+def format_memory(size):
+    return '{}Mi'.format(max(1, int(math.ceil(size/2.0**20))))
+
+
+class ProfileStore(object):
+    """
+    Local store (a JSON file shared by the runners of the agent) of the peak CPU (cores) and memory (bytes) of
+    the containers of each pod template, keeping the last max_samples task runs per container and the
+    max_templates most recently updated templates.
+    """
+
+    def __init__(self, path=PROFILE_STORE_PATH, max_samples=PROFILE_MAX_SAMPLES, max_templates=PROFILE_MAX_TEMPLATES):
+        self.path = path
+        self.max_samples = max_samples
+        self.max_templates = max_templates
+
+    def _read(self):
+        try:
+            with open(self.path) as store_file:
+                return json.load(store_file)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, profile_key):
+        return self._read().get(profile_key, {})
+
+    def add(self, profile_key, peaks):
+        with open(self.path+'.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            profiles = self._read()
+            profile = profiles.setdefault(profile_key, {})
+            for container, usage in peaks.items():
+                samples = profile.setdefault(container, {'cpu': [], 'memory': []})
+                for resource in ['cpu', 'memory']:
+                    if usage.get(resource) is not None:
+                        samples[resource] = (samples[resource] + [round(usage[resource], 3)])[-self.max_samples:]
+            profile['updated'] = int(time.time())
+            for old_key in sorted(profiles, key=lambda item: profiles[item].get('updated', 0))[:max(0, len(profiles)-self.max_templates)]:
+                del profiles[old_key]
+            temp_path = '{}.{}'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as store_file:
+                json.dump(profiles, store_file, separators=(',', ':'))
+            os.rename(temp_path, self.path)
+
+    def auto_size(self, profile_key, pod_template, percent=90, margin=20, min_samples=3):
+        """
+        Rewrites the cpu and memory requests of the profiled containers of the template to the given percentile
+        of their observed peaks plus a margin (percent), capped by the container limits. Returns the new requests.
+        """
+        profile = self.get(profile_key)
+        sized = {}
+        for container in pod_template['spec']['containers']:
+            samples = profile.get(container['name'])
+            if not samples:
+                continue
+            resources = container.setdefault('resources', {})
+            requests = resources.setdefault('requests', {})
+            limits = resources.get('limits') or {}
+            resized = False
+            for resource, formatter in [('cpu', format_cpu), ('memory', format_memory)]:
+                if len(samples[resource]) < min_samples:
+                    continue
+                value = percentile(samples[resource], percent) * (1 + margin/100.0)
+                if limits.get(resource) is not None:
+                    value = min(value, parse_quantity(limits[resource]))
+                requests[resource] = formatter(value)
+                resized = True
+            if resized:
+                sized[container['name']] = dict(requests)
+        return sized
+
+
+class ResourceSampler(object):
+    """
+    Samples the CPU and memory usage of the pod containers while the task runs and keeps their peaks.
+    Usage is read from the container cgroup stats through exec (memory peak as tracked by the kernel and CPU
+    rate between samples), or from the metrics API for containers without a shell.
+    """
+
+    def __init__(self, kubernetes_api, pod_name, containers, interval=PROFILE_INTERVAL):
+        self.kubernetes_api = kubernetes_api
+        self.pod_name = pod_name
+        self.containers = containers
+        self.interval = interval
+        self.peaks = dict((container, {'cpu': None, 'memory': None}) for container in containers)
+        self.cpu_usage = {}
+        self.exec_failures = dict((container, 0) for container in containers)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _update(self, container, resource, value):
+        if value is not None and (self.peaks[container][resource] is None or value > self.peaks[container][resource]):
+            self.peaks[container][resource] = value
+
+    def _sample_cgroup(self, container):
+        stats = {}
+        for line in self.kubernetes_api.exec_command(self.pod_name, CGROUP_COMMAND, container=container).splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                stats[parts[0]] = float(parts[1])
+        memory = [stats[name] for name in CGROUP_FILES[:4] if name in stats]
+        self._update(container, 'memory', max(memory) if memory else None)
+        cpu_seconds = stats['usage_usec']/1e6 if 'usage_usec' in stats else stats.get('cpuacct/cpuacct.usage', 0)/1e9
+        now = time.time()
+        if cpu_seconds and container in self.cpu_usage:
+            previous_seconds, previous_time = self.cpu_usage[container]
+            self._update(container, 'cpu', (cpu_seconds-previous_seconds)/max(now-previous_time, 0.001))
+        self.cpu_usage[container] = (cpu_seconds, now)
+
+    def _sample_metrics(self):
+        for usage in self.kubernetes_api.get_pod_metrics(self.pod_name).get('containers', []):
+            if usage['name'] in self.peaks and not self._use_exec(usage['name']):
+                self._update(usage['name'], 'cpu', parse_quantity(usage['usage']['cpu']))
+                self._update(usage['name'], 'memory', parse_quantity(usage['usage']['memory']))
+
+    def _use_exec(self, container):
+        ## fall back to the metrics API if exec never worked (e.g. no shell in the container image)
+        return container in self.cpu_usage or self.exec_failures[container] < PROFILE_EXEC_ATTEMPTS
+
+    def sample(self):
+        for container in self.containers:
+            if self._use_exec(container):
+                try:
+                    self._sample_cgroup(container)
+                except Exception:
+                    self.exec_failures[container] += 1
+        if not all(self._use_exec(container) for container in self.containers):
+            try:
+                self._sample_metrics()
+            except Exception:
+                pass
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='resource-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return dict((container, peaks) for container, peaks in self.peaks.items() if any(value is not None for value in peaks.values()))
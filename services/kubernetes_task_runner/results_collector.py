@@ -0,0 +1,82 @@
+import os
+import time
+import threading
+
+RESULTS_SYNC_INTERVAL = 10
+COLLECTOR_IMAGE = 'busybox'
+COLLECTOR_RESOURCES = {
+    "requests": {
+        "cpu": "10m",
+        "memory": "16Mi"
+    },
+    "limits": {
+        "memory": "64Mi"
+    }
+}
+
+
+def collector_container(name, image=COLLECTOR_IMAGE, resources=None):
+    """
+    Returns a minimal sidecar container that only keeps the shared test results directory reachable (over exec)
+    after the main container ends.
+    """
+    return {
+        "image": image,
+        "name": name,
+        "command": ["sh", "-c", "trap 'exit 0' TERM; while true; do sleep 5; done"],
+        "resources": resources or COLLECTOR_RESOURCES
+    }
+
+
+class ResultsCollector(object):
+    """
+    Streams the test results directory of a task pod into a local directory while the task runs, so that the
+    test parser can run on the runner agent instead of in an Opereto worker sidecar. The files modified since
+    the previous sync are copied every interval, and the whole directory is copied once more when stopped.
+    """
+
+    def __init__(self, kubernetes_api, pod_name, container, pod_directory, local_directory, interval=RESULTS_SYNC_INTERVAL):
+        self.kubernetes_api = kubernetes_api
+        self.pod_name = pod_name
+        self.container = container
+        self.pod_directory = pod_directory
+        self.local_directory = local_directory
+        self.interval = interval
+        self.transferred = 0
+        self.syncs = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        if not os.path.exists(local_directory):
+            os.makedirs(local_directory)
+
+    def sync(self, incremental=True):
+        try:
+            self.transferred += self.kubernetes_api.sync_from_pod(self.pod_name, self.pod_directory, self.local_directory,
+                                                                  container=self.container, incremental=incremental)
+            self.syncs += 1
+            return True
+        except Exception as e:
+            ## the collector container may not be running yet
+            if self.syncs:
+                print('Failed to sync test results from pod {}: {}'.format(self.pod_name, e))
+            return False
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.sync()
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='results-collector')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        start_time = time.time()
+        if not self.sync(incremental=False):
+            print('Failed to copy the test results directory from pod {}.'.format(self.pod_name))
+        print('Collected {} bytes of test results from pod {} in {} syncs (final sync took {:.2f} seconds)'.format(
+            self.transferred, self.pod_name, self.syncs, time.time()-start_time))
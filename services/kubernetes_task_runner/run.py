@@ -1,12 +1,26 @@
 import json,yaml
 import os
+import copy
 import re
 import time
+import hashlib
 from opereto.helpers.services import TaskRunner
-from kubernetes_api import KubernetesAPI
+from kubernetes_api import KubernetesAPI, AsyncKubernetesAPI, gather, set_rate_limit, set_connection_pool, API_QPS, API_BURST, \
+    API_POOL_MAXSIZE, API_KEEPALIVE_IDLE_SECONDS, POD_STARTED_PHASES, PID_LABEL, SHARED_CONFIGMAP_HASH_LABEL
+from kubernetes_metrics import LifecycleTimer, pod_startup_durations, emit_summary
+from pod_monitor import PodMonitor, JobMonitor
+from warm_pool import WarmPodPool
+from placement import TaskPlacement, PLACEMENT_CACHE_TTL
+from preflight import preflight, TemplateVerdictCache, PREFLIGHT_CACHE_TTL
+from resource_profile import ProfileStore, ResourceSampler, template_hash, PROFILE_INTERVAL
+from results_collector import ResultsCollector, collector_container, COLLECTOR_IMAGE, RESULTS_SYNC_INTERVAL
 from opereto.utils.validations import JsonSchemeValidator, validate_dict, default_variable_pattern, default_variable_name_scheme, item_properties_scheme
 from opereto.exceptions import OperetoRuntimeError
 
+SHARED_CONFIGMAP_PREFIX = 'opereto-cfg-'
+TERMINATION_MESSAGE_LIMIT = 4096
+CANCEL_GRACE_PERIOD = 5
+
 
 class ServiceRunner(TaskRunner):
 
@@ -45,6 +59,129 @@ class ServiceRunner(TaskRunner):
                 "output_file_path": {
                     "type": ["string", "null"]
                 },
+                "warm_pool": {
+                    "type": ["object", "null"],
+                    "properties": {
+                        "min_size": {
+                            "type": "integer",
+                            "minimum": 0
+                        },
+                        "max_size": {
+                            "type": "integer",
+                            "minimum": 1
+                        },
+                        "idle_ttl": {
+                            "type": "integer",
+                            "minimum": 1
+                        }
+                    },
+                    "additionalProperties": False
+                },
+                "shards": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "shard_parallelism": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "shard_backoff_limit": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "config_maps_mode": {
+                    "enum": ['per_file', 'single', 'shared_immutable', None]
+                },
+                "teardown_propagation_policy": {
+                    "enum": ['Background', 'Foreground', 'Orphan', None]
+                },
+                "teardown_wait": {
+                    "type": ["boolean", "null"]
+                },
+                "cancel_grace_period": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "cancel_collect_output": {
+                    "type": ["boolean", "null"]
+                },
+                "preflight": {
+                    "type": ["boolean", "null"]
+                },
+                "use_informers": {
+                    "type": ["boolean", "null"]
+                },
+                "preflight_cache_ttl": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "output_mode": {
+                    "enum": ['copy', 'termination_message', None]
+                },
+                "test_results_collection": {
+                    "enum": ['sidecar', 'stream', None]
+                },
+                "results_sidecar_resources": {
+                    "type": ["object", "null"]
+                },
+                "results_sync_interval": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "placement_targets": {
+                    "type": ["array", "null"],
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "namespace": {
+                                "type": "string"
+                            },
+                            "context": {
+                                "type": ["string", "null"]
+                            }
+                        },
+                        "required": ['namespace']
+                    }
+                },
+                "placement_cache_ttl": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "resource_profiling": {
+                    "type": ["boolean", "null"]
+                },
+                "resource_profiling_interval": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "auto_size_requests": {
+                    "type": ["boolean", "null"]
+                },
+                "auto_size_percentile": {
+                    "type": ["integer", "null"],
+                    "minimum": 1,
+                    "maximum": 100
+                },
+                "auto_size_margin": {
+                    "type": ["integer", "null"],
+                    "minimum": 0
+                },
+                "api_qps": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "api_burst": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "api_pool_maxsize": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
+                "api_keepalive_idle": {
+                    "type": ["integer", "null"],
+                    "minimum": 1
+                },
                 "required": ['pod_template'],
                 "additionalProperties": True
             }
@@ -53,6 +190,12 @@ class ServiceRunner(TaskRunner):
         validator = JsonSchemeValidator(self.input, input_scheme)
         validator.validate()
 
+        if (self.input.get('shards') or 1) > 1 and self.input.get('warm_pool'):
+            raise OperetoRuntimeError(error='Warm pool is not supported when running the task in shards.')
+
+        if (self.input.get('shards') or 1) > 1 and self.input.get('test_parser_config'):
+            raise OperetoRuntimeError(error='Test parser config is not supported when running the task in shards.')
+
         try:
             if self.pod_template["metadata"]["name"].startswith('opereto'):
                 raise OperetoRuntimeError(error='Pod names containing the prefix [opereto] are reserved names. Please select a different name.')
@@ -68,78 +211,23 @@ class ServiceRunner(TaskRunner):
     def _run_task(self):
         SUCCESS=False
         my_timeout = self.client.get_process_info()['timeout']-60
+        task_deadline = time.time() + my_timeout
 
-        if self.input['pod_config_files']:
-            for config_file in self.input['pod_config_files']:
-                configmap_name = re.sub('[^0-9a-z-]+', '-', config_file['name']+'-'+self.input['pid'].lower())
-                self._print_step_title('Creating config file {}..'.format(configmap_name))
-                configmap_data = config_file['data']
-                if validate_dict(config_file['data']):
-                    configmap_data = yaml.safe_dump(config_file['data'])
-                print(self.kubernetes_api.create_config_map(configmap_name, config_data={config_file['name']: configmap_data}, labels={'opereto_pid': self.input['pid']}))
-                self._state['configmap'][configmap_name]={}
-                self._save_state(self._state)
-                self.config_maps[configmap_name]={
-                    "target": config_file['target']
-                }
-
-            for configmap_name, config_attr in self.config_maps.items():
-                if not 'volumes' in self.pod_template['spec']:
-                    self.pod_template['spec']['volumes']=[]
-                self.pod_template['spec']['volumes'].append(
-                    {
-                        "name": configmap_name+'-vol',
-                        "configMap": {
-                            "name": configmap_name
-                        }
-                    }
-                )
-                for i in range(len(self.pod_template['spec']['containers'])):
-                    if not 'volumeMounts' in self.pod_template['spec']['containers'][i]:
-                        self.pod_template['spec']['containers'][i]['volumeMounts']=[]
-                    self.pod_template['spec']['containers'][i]['volumeMounts'].append(
-                        {
-                            "name": configmap_name+'-vol',
-                            "mountPath": config_attr['target']
-                        }
-                    )
+        ## with a warm pool, config files are copied into the claimed pod instead of mounted from config maps
+        planned_config_maps = []
+        if self.input['pod_config_files'] and not self.input.get('warm_pool'):
+            planned_config_maps = self._plan_config_maps()
+            self._mount_config_maps()
 
-        ## add opereto worker sidecar container
+        ## add the test results sidecar container: an opereto worker running the parser, or a minimal collector
+        ## keeping the results directory reachable while the runner streams it and runs the parser locally
         if self.input['test_parser_config']:
-            self.pod_template['spec']['containers'].append({
-                "image": "opereto/worker",
-                "name": self.test_container_name+"-opereto-worker",
-                "resources": {
-                    "requests": {
-                        "memory": "2Gi"
-                    },
-                    "limits": {
-                        "memory": "2Gi"
-                    }
-                },
-                "env": [
-                    {
-                        "name": "opereto_host",
-                        "value": self.input['opereto_host']
-                    },
-                    {
-                        "name": "opereto_token",
-                        "value": self.input['opereto_token']
-                    },
-                    {
-                        "name": "agent_name",
-                        "value": self.pod_name
-                    },
-                    {
-                        "name": "javaParams",
-                        "value": "-Xms500m -Xmx500m"
-                    },
-                    {
-                        "name": "log_level",
-                        "value": "info"
-                    }
-                ]
-            })
+            if self.results_collection == 'stream':
+                self.pod_template['spec']['containers'].append(
+                    collector_container(self.collector_container_name, image=self.input.get('results_collector_image') or COLLECTOR_IMAGE,
+                                        resources=self.input.get('results_sidecar_resources')))
+            else:
+                self.pod_template['spec']['containers'].append(self._worker_sidecar())
 
             if not 'volumes' in self.pod_template['spec']:
                 self.pod_template['spec']['volumes'] = []
@@ -159,43 +247,88 @@ class ServiceRunner(TaskRunner):
                     }
                 )
 
+        if (self.input.get('shards') or 1) > 1:
+            job_manifest = self._job_manifest()
+            print('Job template:\n{}'.format(json.dumps(job_manifest, indent=4)))
+            if self.input.get('preflight'):
+                with self.timer.phase('preflight'):
+                    self._preflight(job_manifest)
+            with self.timer.phase('config_maps'):
+                gather(self._create_config_maps(planned_config_maps))
+            return self._run_job(job_manifest, max(task_deadline-time.time(), 0))
+
+        ## small outputs are read from the termination message in the final pod status instead of copied from the pod
+        if self.output_mode == 'termination_message' and self.output_file_path:
+            for container in self.pod_template['spec']['containers']:
+                if container['name'] == self.test_container_name:
+                    container['terminationMessagePath'] = self.output_file_path
+
         print('Pod template:\n{}'.format(json.dumps(self.pod_template, indent=4)))
+        if self.input.get('preflight') and not self.input.get('warm_pool'):
+            with self.timer.phase('preflight'):
+                self._preflight(self.pod_template)
+        pending_config_maps = []
+        if planned_config_maps:
+            with self.timer.phase('config_maps'):
+                pending_config_maps = self._create_config_maps(planned_config_maps)
+        collector = None
+        sampler = None
         try:
-            self._print_step_title('Running worker pod..')
-            print(self.kubernetes_api.create_pod(self.pod_template))
-            if self.input['test_parser_config']:
-                self._is_agent_up_and_running(self.pod_name)
+            with self.timer.phase('pod_start'):
+                if self.input.get('warm_pool'):
+                    self._print_step_title('Claiming a warm pool pod..')
+                    self.pod_name = self._claim_pool_pod(max(task_deadline-time.time(), 0))
+                else:
+                    ## the pod starts (scheduling, image pull) while its config maps are still being created,
+                    ## the kubelet mounts them once they exist
+                    self._print_step_title('Running worker pod..')
+                    start_time = time.time()
+                    self.kubernetes_api.create_pod(self.pod_template, wait=False)
+                    pod_start = self.async_api.wait_for_pod(self.pod_name, phases=POD_STARTED_PHASES, timeout=max(task_deadline-time.time(), 0))
+                    gather(pending_config_maps)
+                    pod = pod_start.get(max(task_deadline-time.time(), 0))
+                    print('Pod status: {} (after {:.2f} seconds)'.format(pod.status.phase, pod_start.met_at-start_time))
+                    print(pod)
+            if self.input['test_parser_config'] and self.results_collection != 'stream':
+                with self.timer.phase('agent_start'):
+                    self._is_agent_up_and_running(self.pod_name)
             self._state['pod'][self.pod_name] = {}
             self._save_state(self._state)
-            self._run_parser(self.pod_name)
-            runtime = my_timeout
-            end_container_execution = False
-            while runtime > 0:
-                resp = self.kubernetes_api.get_pod(self.pod_name)
-                if resp.status.phase != 'Running':
-                    if resp.status.phase == 'Succeeded':
-                        SUCCESS = True
-                    end_container_execution = True
-                else:
-                    for container in resp.status.container_statuses:
-                        self.kubernetes_api.print_pod_log(self.pod_name, container=self.test_container_name)
-                        if container.name == self.test_container_name and container.state.terminated is not None:
-                            if container.state.terminated.reason == 'Completed':
-                                SUCCESS = True
-                            end_container_execution = True
-                            break
-
-                if end_container_execution:
-                    time.sleep(5)  ## get the last log lines
-                    self.kubernetes_api.print_pod_log(self.pod_name, container=self.test_container_name)
-                    break
-                time.sleep(10)
-                runtime -= 10
+            if self.input.get('resource_profiling'):
+                sampler = ResourceSampler(self.kubernetes_api, self.pod_name, self.profiled_containers,
+                                          interval=self.input.get('resource_profiling_interval') or PROFILE_INTERVAL)
+                sampler.start()
+            if self.input['test_parser_config'] and self.results_collection == 'stream':
+                collector = ResultsCollector(self.kubernetes_api, self.pod_name, self.collector_container_name,
+                                             self.test_results_directory, self.parser_results_directory,
+                                             interval=self.input.get('results_sync_interval') or RESULTS_SYNC_INTERVAL)
+                collector.start()
+                self._run_parser(self.input['opereto_agent'])
+            else:
+                self._run_parser(self.pod_name)
+            containers = [container['name'] for container in self.pod_template['spec']['containers']]
+            monitor = PodMonitor(self.kubernetes_api, self.pod_name, self.test_container_name,
+                                 max(task_deadline-time.time(), 0), containers=containers)
+            ## the monitor run includes draining the remaining logs, recorded as its own phase
+            run_start = time.time()
+            SUCCESS = monitor.run()
+            self.cancelled = monitor.cancelled
+            self.timer.record('container_run', time.time()-run_start-monitor.drain_seconds)
+            self.timer.record('log_drain', monitor.drain_seconds)
         finally:
+            if collector is not None:
+                with self.timer.phase('results_collect'):
+                    collector.stop()
+            if sampler is not None:
+                self._store_profile(sampler.stop())
             try:
                 self._print_step_title('POD end of execution status:')
                 resp = self.kubernetes_api.get_pod(self.pod_name)
                 print(resp)
+                if self.output_mode == 'termination_message' and self.output_file_path:
+                    self._read_termination_output(resp)
+                for phase, seconds in pod_startup_durations(resp, self.kubernetes_api.get_pod_events(self.pod_name)).items():
+                    self.timer.record(phase, seconds)
             except Exception as e:
                 print(str(e))
 
@@ -203,12 +336,341 @@ class ServiceRunner(TaskRunner):
             return self.client.SUCCESS
         return self.client.FAILURE
 
+    def _preflight(self, manifest):
+        cache_ttl = self.input.get('preflight_cache_ttl')
+        verdict = preflight(self.kubernetes_api, manifest, self.input['pid'],
+                            TemplateVerdictCache(ttl=PREFLIGHT_CACHE_TTL if cache_ttl is None else cache_ttl))
+        cached = ' (cached verdict)' if verdict['cached'] else ''
+        template_name = 'Job template' if manifest.get('kind') == 'Job' else 'Pod template'
+        if verdict['valid'] is None:
+            print('{} pre-flight validation was inconclusive: {}'.format(template_name, verdict['error']))
+        elif not verdict['valid']:
+            self.preflight_failed = True
+            raise OperetoRuntimeError(error='{} was rejected by the server-side dry run{}: {}'.format(template_name, cached, verdict['error']))
+        else:
+            print('{} passed the server-side dry run{}.'.format(template_name, cached))
+
+    def _read_termination_output(self, pod):
+        for container in (pod.status and pod.status.container_statuses) or []:
+            if container.name != self.test_container_name or container.state.terminated is None:
+                continue
+            message = container.state.terminated.message
+            if not message:
+                print('No output found in the termination message of container {}.'.format(container.name))
+            elif len(message.encode('utf-8')) >= TERMINATION_MESSAGE_LIMIT:
+                print('Output of container {} exceeds the termination message limit, copying it from the pod..'.format(container.name))
+            else:
+                try:
+                    output = json.loads(message)
+                except ValueError:
+                    print('The termination message of container {} is not valid JSON, copying the output from the pod..'.format(container.name))
+                    return
+                with open(self.task_output_json, 'w') as output_file:
+                    json.dump(output, output_file, indent=4)
+                self.output_collected = True
+
+    def _store_profile(self, peaks):
+        if not peaks:
+            print('No resource usage was sampled from pod {}.'.format(self.pod_name))
+            return
+        print('Peak resource usage of resource profile {}: {}'.format(self.profile_key, json.dumps(peaks)))
+        try:
+            self.profile_store.add(self.profile_key, peaks)
+        except Exception as e:
+            print('Failed to store resource profile {}: {}'.format(self.profile_key, e))
+
+    def _worker_sidecar(self):
+        return {
+            "image": "opereto/worker",
+            "name": self.test_container_name+"-opereto-worker",
+            "resources": self.input.get('results_sidecar_resources') or {
+                "requests": {
+                    "memory": "2Gi"
+                },
+                "limits": {
+                    "memory": "2Gi"
+                }
+            },
+            "env": [
+                {
+                    "name": "opereto_host",
+                    "value": self.input['opereto_host']
+                },
+                {
+                    "name": "opereto_token",
+                    "value": self.input['opereto_token']
+                },
+                {
+                    "name": "agent_name",
+                    "valueFrom": {
+                        "fieldRef": {
+                            "fieldPath": "metadata.name"
+                        }
+                    }
+                },
+                {
+                    "name": "javaParams",
+                    "value": self.input.get('results_sidecar_java_params') or "-Xms500m -Xmx500m"
+                },
+                {
+                    "name": "log_level",
+                    "value": "info"
+                }
+            ]
+        }
+
+    def _claim_pool_pod(self, timeout=None):
+        pool_config = self.input['warm_pool']
+        pool = WarmPodPool(self.kubernetes_api, self.pod_template, self.test_container_name,
+                           min_size=pool_config.get('min_size', 1), max_size=pool_config.get('max_size', 5),
+                           idle_ttl=pool_config.get('idle_ttl', 1800))
+        labels = {'opereto_pid': self.input['pid']}
+        pod_name = pool.claim(labels)
+        if pod_name:
+            print('Claimed warm pool pod {}.'.format(pod_name))
+        else:
+            print('No idle pod in warm pool {}, starting a new one..'.format(pool.template_hash))
+            pod_name = pool.create_claimed(labels, timeout=timeout)
+        self._state['pod'][pod_name] = {}
+        self._save_state(self._state)
+
+        config_files = {}
+        for config_file in self.input['pod_config_files'] or []:
+            config_files[os.path.join(config_file['target'], config_file['name'])] = self._config_file_data(config_file)
+        pool.deliver(pod_name, config_files)
+        try:
+            pool.maintain()
+        except Exception as e:
+            print('Failed to maintain warm pool {}: {}'.format(pool.template_hash, e))
+        return pod_name
+
+    def _job_manifest(self):
+        completions = self.input['shards']
+        job_name = self.test_container_name+'-job'
+        pod_spec = copy.deepcopy(self.pod_template['spec'])
+        pod_spec['restartPolicy'] = 'Never'
+        for container in pod_spec['containers']:
+            if not container.get('env'):
+                container['env'] = []
+            container['env'] += [
+                {
+                    "name": "OPERETO_SHARD_INDEX",
+                    "valueFrom": {
+                        "fieldRef": {
+                            "fieldPath": "metadata.annotations['batch.kubernetes.io/job-completion-index']"
+                        }
+                    }
+                },
+                {
+                    "name": "OPERETO_SHARD_COUNT",
+                    "value": str(completions)
+                }
+            ]
+            ## shard output is read from the termination message (up to 4KB)
+            if container['name'] == self.test_container_name and self.output_file_path:
+                container['terminationMessagePath'] = self.output_file_path
+
+        job_manifest = {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {
+                "name": job_name,
+                "labels": {
+                    "opereto_pid": self.input['pid']
+                }
+            },
+            "spec": {
+                "completionMode": "Indexed",
+                "completions": completions,
+                "parallelism": self.input.get('shard_parallelism') or completions,
+                "backoffLimit": self.input.get('shard_backoff_limit') or 0,
+                "template": {
+                    "metadata": {
+                        "labels": self.pod_template['metadata']['labels']
+                    },
+                    "spec": pod_spec
+                }
+            }
+        }
+        return job_manifest
+
+    def _run_job(self, job_manifest, timeout):
+        completions = job_manifest['spec']['completions']
+        backoff_limit = job_manifest['spec']['backoffLimit']
+        job_name = job_manifest['metadata']['name']
+        self._print_step_title('Running {} task shards..'.format(completions))
+        self.kubernetes_api.create_job(job_manifest)
+        self._state['job'][job_name] = {}
+        self._save_state(self._state)
+        monitor = JobMonitor(self.kubernetes_api, job_name, self.test_container_name, completions, backoff_limit, timeout)
+        with self.timer.phase('container_run'):
+            SUCCESS = monitor.run()
+        self.cancelled = monitor.cancelled
+        if self.cancelled:
+            return self.client.FAILURE
+        self._print_step_title('Job end of execution status:')
+        print(monitor.render())
+
+        shards_output = {}
+        for index, shard in sorted(monitor.shards.items()):
+            if shard['phase'] != 'Succeeded' and shard['pod']:
+                try:
+                    print('Last log lines of shard {}:\n{}'.format(index, self.kubernetes_api.read_pod_log(shard['pod'], container=self.test_container_name, tail_lines=50)))
+                except Exception as e:
+                    print('Failed to read the log of shard {}: {}'.format(index, e))
+            output = shard['output']
+            if output:
+                try:
+                    output = json.loads(output)
+                except ValueError:
+                    pass
+            shards_output[str(index)] = {
+                'pod': shard['pod'],
+                'phase': shard['phase'],
+                'exit_code': shard['exit_code'],
+                'output': output
+            }
+        with open(self.task_output_json, 'w') as output_file:
+            json.dump({'shards': shards_output}, output_file, indent=4)
+
+        if SUCCESS:
+            return self.client.SUCCESS
+        return self.client.FAILURE
+
+    def _config_file_data(self, config_file):
+        configmap_data = config_file['data']
+        if validate_dict(config_file['data']):
+            configmap_data = yaml.safe_dump(config_file['data'])
+        return configmap_data
+
+    def _plan_config_maps(self):
+        """
+        Fills the config maps to mount and returns the config maps to create (name, state key and creation arguments).
+        Nothing is created and the task state is not changed.
+        """
+        labels = {'opereto_pid': self.input['pid']}
+        planned = []
+        config_maps_mode = self.input.get('config_maps_mode') or 'per_file'
+
+        if config_maps_mode == 'single':
+            ## all files in one config map, each one mounted with its own subPath
+            configmap_name = re.sub('[^0-9a-z-]+', '-', 'task-config-'+self.input['pid'].lower())
+            config_data = {}
+            for config_file in self.input['pod_config_files']:
+                key = re.sub('[^-._a-zA-Z0-9]+', '-', config_file['name'])
+                config_data[key] = self._config_file_data(config_file)
+                self.config_maps.setdefault(configmap_name, {'mounts': []})['mounts'].append({
+                    "target": os.path.join(config_file['target'], config_file['name']),
+                    "sub_path": key
+                })
+            planned.append((configmap_name, 'configmap', {'config_data': config_data, 'labels': labels}))
+
+        elif config_maps_mode == 'shared_immutable':
+            ## content addressed immutable config maps, shared by all tasks using the same file
+            for config_file in self.input['pod_config_files']:
+                configmap_data = self._config_file_data(config_file)
+                content_hash = hashlib.sha1((config_file['name']+'\0'+configmap_data).encode('utf-8')).hexdigest()[:20]
+                configmap_name = SHARED_CONFIGMAP_PREFIX+content_hash
+                planned.append((configmap_name, 'shared_configmap', {'config_data': {config_file['name']: configmap_data},
+                                                                     'labels': {SHARED_CONFIGMAP_HASH_LABEL: content_hash}}))
+                self.config_maps.setdefault(configmap_name, {'mounts': []})['mounts'].append({
+                    "target": config_file['target']
+                })
+
+        else:
+            for config_file in self.input['pod_config_files']:
+                configmap_name = re.sub('[^0-9a-z-]+', '-', config_file['name']+'-'+self.input['pid'].lower())
+                planned.append((configmap_name, 'configmap', {'config_data': {config_file['name']: self._config_file_data(config_file)},
+                                                              'labels': labels}))
+                self.config_maps[configmap_name]={
+                    "mounts": [{"target": config_file['target']}]
+                }
+        return planned
+
+    def _create_config_maps(self, planned):
+        """
+        Saves the planned config maps in the task state and starts creating them concurrently. Returns the pending creations.
+        """
+        for configmap_name, state_key, _ in planned:
+            self._state[state_key][configmap_name] = {}
+        self._save_state(self._state)
+        pending = []
+        for configmap_name, state_key, kwargs in planned:
+            if state_key == 'shared_configmap':
+                self._print_step_title('Using shared config map {}..'.format(configmap_name))
+                pending.append(self.async_api.acquire_shared_config_map(configmap_name, self.input['pid'], **kwargs))
+            else:
+                self._print_step_title('Creating config map {}..'.format(configmap_name))
+                pending.append(self.async_api.create_config_map(configmap_name, **kwargs))
+        return pending
+
+    def _mount_config_maps(self):
+        for configmap_name, config_attr in self.config_maps.items():
+            if not 'volumes' in self.pod_template['spec']:
+                self.pod_template['spec']['volumes']=[]
+            self.pod_template['spec']['volumes'].append(
+                {
+                    "name": configmap_name+'-vol',
+                    "configMap": {
+                        "name": configmap_name
+                    }
+                }
+            )
+            for i in range(len(self.pod_template['spec']['containers'])):
+                if not 'volumeMounts' in self.pod_template['spec']['containers'][i]:
+                    self.pod_template['spec']['containers'][i]['volumeMounts']=[]
+                for mount in config_attr['mounts']:
+                    volume_mount = {
+                        "name": configmap_name+'-vol',
+                        "mountPath": mount['target']
+                    }
+                    if mount.get('sub_path'):
+                        volume_mount['subPath'] = mount['sub_path']
+                    self.pod_template['spec']['containers'][i]['volumeMounts'].append(volume_mount)
+
+    def _release_shared_config_maps(self, shared_config_maps):
+        for config_name in shared_config_maps:
+            try:
+                if self.kubernetes_api.release_shared_config_map(config_name, self.input['pid']):
+                    self._print_step_title('Deleted shared config map {}'.format(config_name))
+                else:
+                    print('Shared config map {} is still used by other tasks.'.format(config_name))
+            except Exception as e:
+                print('Failed to release shared config map {}: {}'.format(config_name, str(e)))
+
     def _setup(self):
         self._state = {
             'configmap': {},
-            'pod': {}
+            'shared_configmap': {},
+            'pod': {},
+            'job': {}
         }
-        self.kubernetes_api = KubernetesAPI()
+        set_rate_limit(self.input.get('api_qps') or API_QPS, self.input.get('api_burst') or API_BURST)
+        set_connection_pool(self.input.get('api_pool_maxsize') or API_POOL_MAXSIZE,
+                            self.input.get('api_keepalive_idle') or API_KEEPALIVE_IDLE_SECONDS)
+        self.profiled_containers = [container['name'] for container in self.pod_template['spec']['containers']]
+        self.profile_key = template_hash(self.pod_template)
+        self.profile_store = ProfileStore()
+        if self.input.get('auto_size_requests'):
+            margin = self.input.get('auto_size_margin')
+            sized = self.profile_store.auto_size(self.profile_key, self.pod_template, percent=self.input.get('auto_size_percentile') or 90,
+                                                 margin=20 if margin is None else margin)
+            if sized:
+                print('Container requests sized by resource profile {}: {}'.format(self.profile_key, json.dumps(sized)))
+        target = {'namespace': 'default', 'context': None}
+        if self.input.get('placement_targets'):
+            cache_ttl = self.input.get('placement_cache_ttl')
+            placement = TaskPlacement(self.input['placement_targets'], cache_ttl=PLACEMENT_CACHE_TTL if cache_ttl is None else cache_ttl)
+            target = placement.choose(self.pod_template)
+            print('Task placed in namespace {} of context {}.'.format(target['namespace'], target['context'] or 'in-cluster'))
+        ## teardown and kill.py connect to the target saved in the state
+        self._state['target'] = target
+        self._save_state(self._state)
+        self.kubernetes_api = KubernetesAPI(namespace=target['namespace'], context=target['context'])
+        self.async_api = AsyncKubernetesAPI(self.kubernetes_api)
+        if self.input.get('use_informers'):
+            ## pod and config map reads of the task are served from one watch of the resources labeled with its pid
+            self.kubernetes_api.enable_informers(kinds=('pods', 'config_maps'), label_selector='{}={}'.format(PID_LABEL, self.input['pid']))
         self.test_container_name = self.pod_template['metadata']['name']
         self.pod_name = self.test_container_name+'-pod'
         self.pod_template['metadata']['name']=self.pod_name
@@ -216,37 +678,92 @@ class ServiceRunner(TaskRunner):
             self.pod_template['metadata']['labels']={}
         self.pod_template['metadata']['labels']['opereto_pid'] = self.input['pid']
         self.config_maps = {}
+        self.timer = LifecycleTimer()
+        self.preflight_failed = False
+        self.cancelled = False
+        self.output_mode = self.input.get('output_mode') or 'copy'
+        self.output_collected = False
+        self.results_collection = self.input.get('test_results_collection') or 'sidecar'
+        self.collector_container_name = self.test_container_name+'-opereto-collector'
         self.parser_results_directory = self.test_results_directory
+        if self.results_collection == 'stream':
+            self.parser_results_directory = os.path.abspath('opereto_test_results')
         self.listener_results_dir = '/var/opereto_listener_results'
 
 
+    def _delete_resources(self, current_state):
+        ## all task resources (pod, jobs, config maps) carry the pid label and are deleted with one call per kind
+        self._print_step_title('Deleting task resources..')
+        errors = self.kubernetes_api.delete_by_label('opereto_pid={}'.format(self.input['pid']),
+                                                     propagation_policy=self.input.get('teardown_propagation_policy') or 'Background',
+                                                     wait=bool(self.input.get('teardown_wait')))
+        for kind, error in errors.items():
+            print('Failed to remove task {}. Please remove them manually : {}'.format(kind.replace('_', ' '), str(error)))
+            self.task_exitcode = 1
+
+        ## shared config maps are not labeled with the pid and are deleted only by their last user
+        if current_state.get('shared_configmap'):
+            self._release_shared_config_maps(current_state['shared_configmap'].keys())
+
+    def _emit_timings(self):
+        summary = self.timer.summary(self.kubernetes_api.metrics)
+        emit_summary(summary, self.input.get('metrics_export_path'))
+        try:
+            self.client.modify_process_property('task_timings', summary)
+        except Exception as e:
+            print('Failed to store task timings: {}'.format(e))
+
+    def _cancel(self):
+        """
+        Cancellation path of kill.py: deletes all task resources at once (pods with the cancel grace period),
+        which also ends the pod or job monitor of the running task as soon as the deletion is requested.
+        The output file is copied first only if cancel_collect_output is set.
+        """
+        start_time = time.time()
+        current_state = self._get_state()
+        target = current_state.get('target') or {}
+        self.kubernetes_api = KubernetesAPI(namespace=target.get('namespace') or 'default', context=target.get('context'))
+        if self.input['keep_pod_running']:
+            print('The task resources are kept (keep_pod_running is set).')
+            return 0
+        if self.input.get('cancel_collect_output') and self.output_file_path and current_state.get('pod'):
+            try:
+                self.kubernetes_api.cp(list(current_state['pod'].keys())[0], self.output_file_path, self.task_output_json)
+            except Exception as e:
+                print('Failed to process output data from output files {}: {}'.format(self.output_file_path, e))
+        grace_period = self.input.get('cancel_grace_period')
+        errors = self.kubernetes_api.delete_by_label('opereto_pid={}'.format(self.input['pid']),
+                                                     grace_period_seconds=CANCEL_GRACE_PERIOD if grace_period is None else grace_period)
+        for kind, error in errors.items():
+            print('Failed to remove task {}. Please remove them manually : {}'.format(kind.replace('_', ' '), str(error)))
+        if current_state.get('shared_configmap'):
+            self._release_shared_config_maps(current_state['shared_configmap'].keys())
+        print('Task resources deleted in {:.2f} seconds.'.format(time.time()-start_time))
+        return 1 if errors else 0
+
     def _teardown(self):
-        self.kubernetes_api = KubernetesAPI()
         current_state = self._get_state()
+        if not hasattr(self, 'kubernetes_api'):
+            target = current_state.get('target') or {}
+            self.kubernetes_api = KubernetesAPI(namespace=target.get('namespace') or 'default', context=target.get('context'))
+        if not hasattr(self, 'timer'):
+            self.timer = LifecycleTimer()
         if not self.input['keep_pod_running']:
-            if self.output_file_path:
-                try:
-                    self.kubernetes_api.cp(self.pod_name, self.output_file_path, self.task_output_json)
-                except Exception as e:
-                    print('Failed to process output data from output files {}: {}'.format(self.output_file_path, e))
-
-            if current_state['pod']:
-                try:
-                    pod_name = current_state['pod'].keys()[0]
-                    self._print_step_title('Deleting worker pod {}..'.format(pod_name))
-                    print(self.kubernetes_api.delete_pod(pod_name))
-                except Exception as e:
-                    print('Failed to remove worker pod {}. Please remove it manually : {}'.format(pod_name, str(e)))
-                    self.task_exitcode=1
-
-            if current_state['configmap']:
-                for config_name in current_state['configmap'].keys():
+            ## a cancelled task is not expected to have an output, unless cancel_collect_output is set
+            collect_output = not getattr(self, 'cancelled', False) or self.input.get('cancel_collect_output')
+            if self.output_file_path and current_state['pod'] and not getattr(self, 'output_collected', False) and collect_output:
+                with self.timer.phase('output_copy'):
                     try:
-                        self._print_step_title('Deleting config map {}'.format(config_name))
-                        print(self.kubernetes_api.delete_config_map(config_name))
+                        self.kubernetes_api.cp(current_state['pod'].keys()[0], self.output_file_path, self.task_output_json)
                     except Exception as e:
-                        print('Failed to remove config map {}. Please remove it manually : {}'.format(config_name, str(e)))
-                        self.task_exitcode = 1
+                        print('Failed to process output data from output files {}: {}'.format(self.output_file_path, e))
+
+            if getattr(self, 'preflight_failed', False):
+                print('No task resources were created.')
+            else:
+                with self.timer.phase('teardown'):
+                    self._delete_resources(current_state)
+        self._emit_timings()
 
 if __name__ == "__main__":
     exit(ServiceRunner().run())
@@ -0,0 +1,187 @@
+import os
+import copy
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import calendar
+import tempfile
+from kubernetes.client.rest import ApiException
+from kubernetes_api import pod_ready
+from opereto.exceptions import OperetoRuntimeError
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+POOL_LABEL = 'opereto_pool'
+POOL_STATE_LABEL = 'opereto_pool_state'
+POOL_TASK_DIRECTORY = '/tmp/opereto-task'
+POOL_STATS_RETRIES = 5
+
+
+class WarmPodPool(object):
+    """
+    A pool of pre-started pods per pod template hash. Idle pool pods run a wait loop in the main container;
+    a task claims an idle pod by relabeling it (optimistic concurrency on the pod resourceVersion), delivers
+    its config files and command by copying them into the pod and then triggers the command. The pool has no
+    controller of its own: it is maintained by the tasks that use it, so idle pods of a template that is no longer
+    used are only evicted by the next task run of that template.
+    """
+
+    def __init__(self, kubernetes_api, pod_template, main_container, min_size=1, max_size=5, idle_ttl=1800):
+        self.kubernetes_api = kubernetes_api
+        self.main_container = main_container
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.command = self._main_container(pod_template).get('command', []) + self._main_container(pod_template).get('args', [])
+        if not self.command:
+            raise OperetoRuntimeError(error='Warm pool requires the command of container {} to be set in the pod template.'.format(main_container))
+        self.pool_template = self._pool_template(pod_template)
+        self.template_hash = hashlib.sha1(json.dumps(self.pool_template, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.pool_template['metadata']['labels'][POOL_LABEL] = self.template_hash
+        self.stats_name = 'opereto-pool-'+self.template_hash
+
+    def _main_container(self, pod_template):
+        for container in pod_template['spec']['containers']:
+            if container['name'] == self.main_container:
+                return container
+        raise OperetoRuntimeError(error='Container {} was not found in the pod template.'.format(self.main_container))
+
+    def _pool_template(self, pod_template):
+        template = copy.deepcopy(pod_template)
+        template['metadata'] = {
+            'labels': dict((key, value) for key, value in (template['metadata'].get('labels') or {}).items() if key != 'opereto_pid')
+        }
+        template['spec']['restartPolicy'] = 'Never'
+        main_container = self._main_container(template)
+        main_container.pop('args', None)
+        main_container['command'] = ['sh', '-c', 'while [ ! -f {0}/start ]; do sleep 0.2; done; exec sh {0}/command.sh'.format(POOL_TASK_DIRECTORY)]
+        return template
+
+    def _new_pod_manifest(self, state='idle', labels=None):
+        manifest = copy.deepcopy(self.pool_template)
+        manifest['metadata']['name'] = '{}-pool-{}-{}'.format(self.main_container, self.template_hash[:8], uuid.uuid4().hex[:6])
+        manifest['metadata']['labels'][POOL_STATE_LABEL] = state
+        manifest['metadata']['labels'].update(labels or {})
+        return manifest
+
+    def _pool_pods(self, state=None):
+        selector = '{}={}'.format(POOL_LABEL, self.template_hash)
+        if state:
+            selector += ',{}={}'.format(POOL_STATE_LABEL, state)
+        return self.kubernetes_api.list_pods(label_selector=selector)
+
+    def claim(self, labels):
+        """
+        Claims an idle and ready pool pod, labeling it with the given labels. Returns the pod name or None (pool miss).
+        """
+        idle_pods = [pod for pod in self._pool_pods(state='idle') if pod.metadata.deletion_timestamp is None and pod_ready(pod)]
+        for pod in sorted(idle_pods, key=lambda pod: pod.metadata.creation_timestamp):
+            claim_labels = dict(labels)
+            claim_labels[POOL_STATE_LABEL] = 'claimed'
+            try:
+                self.kubernetes_api.patch_pod(pod.metadata.name, {
+                    'metadata': {
+                        'labels': claim_labels,
+                        'resourceVersion': pod.metadata.resource_version
+                    }
+                })
+            except ApiException as e:
+                if e.status in [404, 409]:
+                    continue
+                raise
+            self._count('hits')
+            return pod.metadata.name
+        self._count('misses')
+        return None
+
+    def create_claimed(self, labels, timeout=None):
+        """
+        Creates a new pool pod claimed by the task (used on a pool miss) and waits for it to start.
+        """
+        manifest = self._new_pod_manifest(state='claimed', labels=labels)
+        self.kubernetes_api.create_pod(manifest, timeout=timeout)
+        return manifest['metadata']['name']
+
+    def deliver(self, pod_name, config_files=None):
+        """
+        Copies the task config files (target path -> content) and command into a claimed pod and starts the command.
+        """
+        temp_dir = tempfile.mkdtemp(prefix='opereto-pool-')
+        try:
+            for index, (target, content) in enumerate(sorted((config_files or {}).items())):
+                local_path = os.path.join(temp_dir, 'config-{}'.format(index))
+                with open(local_path, 'w') as f:
+                    f.write(content)
+                self.kubernetes_api.cp(pod_name, target, local_path, direction='copy_to', container=self.main_container)
+            command_path = os.path.join(temp_dir, 'command.sh')
+            with open(command_path, 'w') as f:
+                f.write('exec {}\n'.format(' '.join(quote(part) for part in self.command)))
+            self.kubernetes_api.cp(pod_name, POOL_TASK_DIRECTORY+'/command.sh', command_path, direction='copy_to', container=self.main_container)
+            start_path = os.path.join(temp_dir, 'start')
+            open(start_path, 'w').close()
+            self.kubernetes_api.cp(pod_name, POOL_TASK_DIRECTORY+'/start', start_path, direction='copy_to', container=self.main_container)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def maintain(self):
+        """
+        Evicts idle pods older than the idle TTL (above the minimal pool size) and starts new idle pods up to the
+        minimal size, never exceeding the maximal number of idle pods. Called on each task run of the pool.
+        """
+        idle_pods = sorted([pod for pod in self._pool_pods(state='idle') if pod.metadata.deletion_timestamp is None],
+                           key=lambda pod: pod.metadata.creation_timestamp)
+        now = time.time()
+        while len(idle_pods) > self.min_size:
+            created = calendar.timegm(idle_pods[0].metadata.creation_timestamp.utctimetuple())
+            if len(idle_pods) <= self.max_size and now - created < self.idle_ttl:
+                break
+            pod = idle_pods.pop(0)
+            print('Evicting idle pool pod {}..'.format(pod.metadata.name))
+            try:
+                self.kubernetes_api.delete_pod(pod.metadata.name)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+        for count in range(self.min_size - len(idle_pods)):
+            manifest = self._new_pod_manifest()
+            print('Starting idle pool pod {}..'.format(manifest['metadata']['name']))
+            self.kubernetes_api.v1.create_namespaced_pod(body=manifest, namespace=self.kubernetes_api.namespace)
+
+    def _count(self, counter):
+        """
+        Increments a hit/miss counter of the pool stats config map. Counters are best-effort, failures are only logged.
+        """
+        for attempt in range(POOL_STATS_RETRIES):
+            try:
+                try:
+                    stats = self.kubernetes_api.v1.read_namespaced_config_map(self.stats_name, self.kubernetes_api.namespace)
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+                    self.kubernetes_api.create_config_map(self.stats_name, config_data={'hits': '0', 'misses': '0'},
+                                                          labels={POOL_LABEL: self.template_hash}, exist_ok=True)
+                    continue
+                data = stats.data or {}
+                data[counter] = str(int(data.get(counter, 0)) + 1)
+                self.kubernetes_api.v1.replace_namespaced_config_map(self.stats_name, self.kubernetes_api.namespace, {
+                    'metadata': {
+                        'name': self.stats_name,
+                        'labels': stats.metadata.labels,
+                        'resourceVersion': stats.metadata.resource_version
+                    },
+                    'data': data
+                })
+                print('Warm pool {}: {} hits, {} misses'.format(self.template_hash, data.get('hits', 0), data.get('misses', 0)))
+                return
+            except ApiException as e:
+                if e.status != 409:
+                    print('Failed to update warm pool counters: {}'.format(e.reason))
+                    return
+            except OperetoRuntimeError as e:
+                print('Failed to update warm pool counters: {}'.format(e))
+                return
+        print('Failed to update warm pool counters: too many concurrent updates.')
@@ -0,0 +1,304 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services'))
+
+from pyopereto.client import OperetoClientError
+from opereto.exceptions import OperetoRuntimeError
+from kubernetes import client as kubernetes_client
+from dockereto_workers import AgentReadinessTracker, PostOperationScheduler, RollingImageUpdate, QueueAutoscaler, AUTOSCALE_ANNOTATION
+
+
+class AgentsClient(object):
+    """
+    Opereto client stub knowing only the given agents (agent id to online state).
+    """
+
+    def __init__(self, agents):
+        self.agents = agents
+
+    def search_agents(self, limit=None, filter=None):
+        return []
+
+    def get_agent(self, agent_id):
+        if agent_id not in self.agents:
+            raise OperetoClientError('Agent {} does not exist'.format(agent_id), code=404)
+        return {'online': self.agents[agent_id]}
+
+
+class AgentReadinessTrackerTest(unittest.TestCase):
+
+    def _tracker(self, agents, agent_ids, timeout):
+        return AgentReadinessTracker(AgentsClient(agents), None, agent_ids, 'workers', timeout=timeout, initial_delay=0.01, max_delay=0.01)
+
+    def test_missing_agent_counts_as_offline(self):
+        ## e.g. an agent unregistered after an autoscale scale down
+        tracker = self._tracker({'worker-0': False}, ['worker-0', 'worker-1'], timeout=5)
+        self.assertEqual(tracker.wait(online=False), [])
+
+    def test_missing_agent_does_not_count_as_online(self):
+        tracker = self._tracker({'worker-0': True}, ['worker-0', 'worker-1'], timeout=0.1)
+        self.assertEqual(tracker.wait(online=True), ['worker-1'])
+
+
+class ProcessesClient(object):
+    """
+    Opereto client stub running each process for the given number of status polls, ending with the status given
+    per service (success by default). Records the process start order and the largest number of running processes.
+    """
+
+    def __init__(self, polls=2, statuses=None):
+        self.polls = polls
+        self.statuses = statuses or {}
+        self.processes = {}
+        self.started = []
+        self.stopped = []
+        self.max_running = 0
+
+    def create_process(self, service, agent=None, title=None, **kwargs):
+        if self.statuses.get(service) == 'create_error':
+            raise OperetoClientError('Failed to create a new process', code=500)
+        pid = 'pid-{}'.format(len(self.started))
+        self.processes[pid] = {'service': service, 'polls': 0}
+        self.started.append(service)
+        self.max_running = max(self.max_running, len([p for p in self.processes.values() if p['polls'] < self.polls]))
+        return pid
+
+    def get_process_status(self, pid):
+        process = self.processes[pid]
+        process['polls'] += 1
+        if process['polls'] < self.polls:
+            return 'in_process'
+        return self.statuses.get(process['service'], 'success')
+
+    def stop_process(self, pids, status='terminated', message=''):
+        self.stopped.extend(pids)
+
+
+class PostOperationSchedulerTest(unittest.TestCase):
+
+    def _scheduler(self, client, concurrency=2, fail_fast=True):
+        return PostOperationScheduler(client, concurrency=concurrency, fail_fast=fail_fast, poll_interval=0)
+
+    def test_dependencies_and_concurrency(self):
+        client = ProcessesClient()
+        scheduler = self._scheduler(client)
+        scheduler.add('setup', 'setup', 'worker')
+        scheduler.add('a', 'a', 'worker', depends_on=['setup'])
+        scheduler.add('b', 'b', 'worker', depends_on=['setup'])
+        scheduler.add('c', 'c', 'worker', depends_on=['setup'])
+        scheduler.add('report', 'report', 'worker', depends_on=['a', 'b', 'c'])
+        self.assertTrue(scheduler.run())
+        self.assertEqual(client.started[0], 'setup')
+        self.assertEqual(sorted(client.started[1:4]), ['a', 'b', 'c'])
+        self.assertEqual(client.started[4], 'report')
+        self.assertEqual(client.max_running, 2)
+
+    def test_circular_dependency(self):
+        scheduler = self._scheduler(ProcessesClient())
+        scheduler.add('a', 'a', 'worker', depends_on=['c'])
+        scheduler.add('b', 'b', 'worker', depends_on=['a'])
+        scheduler.add('c', 'c', 'worker', depends_on=['b'])
+        with self.assertRaises(OperetoRuntimeError):
+            scheduler.run()
+
+    def test_unknown_dependency(self):
+        scheduler = self._scheduler(ProcessesClient())
+        scheduler.add('a', 'a', 'worker', depends_on=['missing'])
+        with self.assertRaises(OperetoRuntimeError):
+            scheduler.run()
+
+    def test_fail_fast_stops_running_and_skips_pending(self):
+        ## slow never ends
+        client = ProcessesClient(polls=1, statuses={'bad': 'failure', 'slow': 'in_process'})
+        scheduler = self._scheduler(client)
+        scheduler.add('bad', 'bad', 'worker')
+        scheduler.add('slow', 'slow', 'worker')
+        scheduler.add('next', 'next', 'worker', depends_on=['slow'])
+        self.assertFalse(scheduler.run())
+        self.assertEqual([operation['status'] for operation in scheduler.operations], ['failure', 'terminated', 'skipped'])
+        self.assertEqual(client.stopped, [scheduler.by_name['slow']['pid']])
+
+    def test_failed_dependency_skips_dependents(self):
+        client = ProcessesClient(statuses={'bad': 'failure'})
+        scheduler = self._scheduler(client, fail_fast=False)
+        scheduler.add('bad', 'bad', 'worker')
+        scheduler.add('after', 'after', 'worker', depends_on=['bad'])
+        scheduler.add('other', 'other', 'worker')
+        self.assertFalse(scheduler.run())
+        self.assertEqual([operation['status'] for operation in scheduler.operations], ['failure', 'skipped', 'success'])
+
+    def test_create_failure_stops_running_operations(self):
+        client = ProcessesClient(polls=3, statuses={'bad': 'create_error'})
+        scheduler = self._scheduler(client, concurrency=0)
+        scheduler.add('first', 'first', 'worker')
+        scheduler.add('bad', 'bad', 'worker')
+        scheduler.add('last', 'last', 'worker', depends_on=['first'])
+        self.assertFalse(scheduler.run())
+        self.assertEqual([operation['status'] for operation in scheduler.operations], ['terminated', 'error', 'skipped'])
+        self.assertEqual(client.stopped, [scheduler.by_name['first']['pid']])
+
+
+class StatefulSetApi(object):
+    """
+    KubernetesAPI stub of a stateful set whose waves (in order) roll out unless listed in failed_waves, in which
+    case the given pods of the wave are not ready.
+    """
+
+    def __init__(self, name, replicas, image, failed_waves=None):
+        self.name = name
+        self.replicas = replicas
+        self.image = image
+        self.failed_waves = failed_waves or {}
+        self.patches = []
+        self.waits = 0
+
+    def get_stateful_set(self, name):
+        return kubernetes_client.V1StatefulSet(
+            metadata=kubernetes_client.V1ObjectMeta(name=name),
+            spec=kubernetes_client.V1StatefulSetSpec(
+                replicas=self.replicas, selector=kubernetes_client.V1LabelSelector(), service_name=name,
+                template=kubernetes_client.V1PodTemplateSpec(spec=kubernetes_client.V1PodSpec(
+                    containers=[kubernetes_client.V1Container(name='worker', image=self.image)]))),
+            status=kubernetes_client.V1StatefulSetStatus(replicas=self.replicas, update_revision='new'))
+
+    def modify_stateful_set(self, name, patch):
+        self.patches.append(patch)
+
+    def wait_for_stateful_set(self, name, condition, timeout=None):
+        self.waits += 1
+        if self.waits in self.failed_waves:
+            return None
+        return self.get_stateful_set(name)
+
+    def list_pods(self, label_selector=None):
+        not_ready = self.failed_waves.get(self.waits, [])
+        return [kubernetes_client.V1Pod(
+            metadata=kubernetes_client.V1ObjectMeta(name='{}-{}'.format(self.name, ordinal), labels={'controller-revision-hash': 'new'}),
+            status=kubernetes_client.V1PodStatus(conditions=[kubernetes_client.V1PodCondition(
+                type='Ready', status='False' if '{}-{}'.format(self.name, ordinal) in not_ready else 'True')]))
+            for ordinal in range(self.replicas)]
+
+    def partitions(self):
+        return [patch['spec']['updateStrategy']['rollingUpdate']['partition'] for patch in self.patches]
+
+
+class RollingImageUpdateTest(unittest.TestCase):
+
+    def test_waves_from_the_highest_ordinal(self):
+        api = StatefulSetApi('workers', 5, 'worker:1')
+        update = RollingImageUpdate(api, 'workers', 'worker:2', wave_size=2)
+        self.assertTrue(update.run())
+        self.assertEqual(api.partitions(), [5, 3, 1, 0])
+        self.assertEqual(api.patches[0]['spec']['template']['spec']['containers'], [{'name': 'worker', 'image': 'worker:2'}])
+        self.assertEqual([wave['pods'] for wave in update.waves], [['workers-3', 'workers-4'], ['workers-1', 'workers-2'], ['workers-0']])
+
+    def test_failures_within_the_threshold_continue(self):
+        api = StatefulSetApi('workers', 4, 'worker:1', failed_waves={1: ['workers-3']})
+        update = RollingImageUpdate(api, 'workers', 'worker:2', wave_size=2, failure_threshold=1)
+        self.assertTrue(update.run())
+        self.assertEqual(update.waves[0]['failed'], ['workers-3'])
+        self.assertEqual(api.partitions(), [4, 2, 0])
+
+    def test_failures_above_the_threshold_pause(self):
+        api = StatefulSetApi('workers', 4, 'worker:1', failed_waves={1: ['workers-3']})
+        update = RollingImageUpdate(api, 'workers', 'worker:2', wave_size=2)
+        self.assertFalse(update.run())
+        self.assertEqual(api.partitions(), [4, 2])
+
+    def test_failures_above_the_threshold_roll_back(self):
+        api = StatefulSetApi('workers', 4, 'worker:1', failed_waves={2: ['workers-0', 'workers-1']})
+        update = RollingImageUpdate(api, 'workers', 'worker:2', wave_size=2, failure_threshold=1, on_failure='rollback')
+        self.assertFalse(update.run())
+        self.assertEqual(api.partitions(), [4, 2, 0, 0])
+        self.assertEqual(api.patches[-1]['spec']['template']['spec']['containers'], [{'name': 'worker', 'image': 'worker:1'}])
+
+    def test_agents_not_online_count_as_failed(self):
+        api = StatefulSetApi('workers', 2, 'worker:1')
+        update = RollingImageUpdate(api, 'workers', 'worker:2', wave_size=1, wait_agents=lambda pods: pods)
+        self.assertFalse(update.run())
+        self.assertEqual(update.waves[0]['failed'], ['workers-1'])
+
+
+class DemandClient(object):
+    """
+    Opereto client stub returning the given processes from the process search.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    def _call_rest_api(self, method, url, data=None, error=None):
+        return self.processes
+
+
+class ScaleApi(object):
+
+    def __init__(self, replicas, last_scale=0):
+        self.replicas = replicas
+        self.last_scale = last_scale
+        self.scaled = []
+
+    def get_stateful_set(self, name):
+        return kubernetes_client.V1StatefulSet(
+            metadata=kubernetes_client.V1ObjectMeta(name=name, annotations={AUTOSCALE_ANNOTATION: str(self.last_scale)}),
+            spec=kubernetes_client.V1StatefulSetSpec(replicas=self.replicas, selector=kubernetes_client.V1LabelSelector(),
+                                                     service_name=name, template=kubernetes_client.V1PodTemplateSpec()))
+
+    def scale_stateful_set(self, name, replicas):
+        self.scaled.append(replicas)
+        self.replicas = replicas
+
+    def modify_stateful_set(self, name, patch):
+        self.last_scale = float(patch['metadata']['annotations'][AUTOSCALE_ANNOTATION])
+
+
+def _processes(count, agents='workers', status='registered'):
+    return [{'status': status, 'agents': agents} for index in range(count)]
+
+
+class QueueAutoscalerTest(unittest.TestCase):
+
+    def _autoscaler(self, api, processes, min_replicas=1, max_replicas=5, processes_per_worker=2):
+        self.registered = []
+        self.unregistered = []
+        return QueueAutoscaler(DemandClient(processes), api, 'workers', 'workers', min_replicas, max_replicas,
+                               processes_per_worker=processes_per_worker, scale_up_cooldown=60, scale_down_cooldown=300,
+                               register=self.registered.extend, unregister=self.unregistered.extend)
+
+    def test_desired_replicas(self):
+        autoscaler = self._autoscaler(ScaleApi(1), [])
+        self.assertEqual([autoscaler.desired_replicas(demand) for demand in [0, 1, 2, 3, 9, 11, 100]], [1, 1, 1, 2, 5, 5, 5])
+
+    def test_scale_up_registers_the_added_agents(self):
+        api = ScaleApi(1)
+        autoscaler = self._autoscaler(api, _processes(3) + _processes(2, agents='workers-0', status='in_process'))
+        self.assertEqual(autoscaler.evaluate(), 3)
+        self.assertEqual(api.scaled, [3])
+        self.assertEqual(self.registered, ['workers-1', 'workers-2'])
+        self.assertEqual(autoscaler.history[0]['demand'], 5)
+
+    def test_scale_down_unregisters_the_removed_agents(self):
+        api = ScaleApi(4)
+        autoscaler = self._autoscaler(api, _processes(2, status='success'))
+        self.assertEqual(autoscaler.evaluate(), 1)
+        self.assertEqual(self.unregistered, ['workers-1', 'workers-2', 'workers-3'])
+
+    def test_cooldown(self):
+        api = ScaleApi(1, last_scale=time.time())
+        autoscaler = self._autoscaler(api, _processes(4))
+        self.assertEqual(autoscaler.evaluate(), 1)
+        self.assertEqual(api.scaled, [])
+
+    def test_processes_of_other_agents_are_not_counted(self):
+        ## the default free text search also returns processes that only mention the worker label
+        api = ScaleApi(1)
+        autoscaler = self._autoscaler(api, _processes(6, agents='other-workers'))
+        self.assertEqual(autoscaler.evaluate(), 1)
+        self.assertEqual(api.scaled, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
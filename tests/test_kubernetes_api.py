@@ -0,0 +1,296 @@
+import io
+import os
+import sys
+import base64
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services'))
+
+from kubernetes import client as kubernetes_client
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import ProtocolError
+from opereto.exceptions import OperetoRuntimeError
+from kubernetes_api import KubernetesAPI, TokenBucket, ResilientApi, _subset_of
+
+
+class ExecResponse(object):
+    """
+    Stand-in for the exec websocket client: serves the given stdout chunks, then closes, and records stdin.
+    """
+
+    def __init__(self, stdout=None, returncode=0):
+        self.stdout = list(stdout or [])
+        self.stdin = []
+        self.returncode = returncode
+
+    def is_open(self):
+        return bool(self.stdout)
+
+    def update(self, timeout=0):
+        pass
+
+    def peek_stdout(self):
+        return bool(self.stdout)
+
+    def read_stdout(self):
+        return self.stdout.pop(0)
+
+    def peek_stderr(self):
+        return False
+
+    def read_stderr(self):
+        return ''
+
+    def write_stdin(self, data):
+        self.stdin.append(data)
+
+    def close(self):
+        pass
+
+
+def _tar(name, content):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as archive:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        archive.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+class CopyEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.kubernetes_api = KubernetesAPI()
+        self.commands = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _exec(self, resp):
+        def _exec_stream(pod_id, command, container=None, stdin=False):
+            self.commands.append(command)
+            return resp
+        self.kubernetes_api._exec_stream = _exec_stream
+
+    def test_copy_from_decodes_chunks_split_at_any_offset(self):
+        content = os.urandom(5000)
+        encoded = base64.b64encode(_tar('output.json', content)).decode('ascii')
+        ## base64 output is wrapped in lines and read in chunks that do not end on 4 character boundaries
+        encoded = '\n'.join(encoded[start:start+76] for start in range(0, len(encoded), 76))
+        self._exec(ExecResponse([encoded[start:start+1001] for start in range(0, len(encoded), 1001)]))
+        local_path = os.path.join(self.temp_dir, 'output.json')
+        self.kubernetes_api.cp('pod', '/results/output.json', local_path)
+        with open(local_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertIn('-C /results output.json | base64', self.commands[0])
+
+    def test_copy_from_rejects_truncated_archive(self):
+        encoded = base64.b64encode(_tar('output.json', b'{}')).decode('ascii')
+        self._exec(ExecResponse([encoded[:-2]]))
+        with self.assertRaises(OperetoRuntimeError):
+            self.kubernetes_api.cp('pod', '/results/output.json', os.path.join(self.temp_dir, 'output.json'))
+
+    def test_copy_to_sends_exactly_the_encoded_size(self):
+        local_path = os.path.join(self.temp_dir, 'config')
+        with open(local_path, 'wb') as f:
+            f.write(os.urandom(200000))
+        resp = ExecResponse()
+        self._exec(resp)
+        self.kubernetes_api.cp('pod', '/etc/task/config', local_path, direction='copy_to')
+        encoded = ''.join(resp.stdin)
+        self.assertIn('head -c {} | base64 -d'.format(len(encoded)), self.commands[0])
+        with tarfile.open(fileobj=io.BytesIO(base64.b64decode(encoded))) as archive:
+            self.assertEqual(archive.getnames(), ['config'])
+            with open(local_path, 'rb') as f:
+                self.assertEqual(archive.extractfile('config').read(), f.read())
+
+
+class PagedList(object):
+    """
+    List call stub serving the given pages (lists of names) and raising the given error for the given continue tokens.
+    """
+
+    def __init__(self, pages, errors=None):
+        self.pages = pages
+        self.errors = errors or {}
+        self.calls = []
+
+    def __call__(self, namespace, limit=None, label_selector=None, _continue=None):
+        self.calls.append(_continue)
+        if _continue in self.errors:
+            raise self.errors.pop(_continue)
+        index = int(_continue or 0)
+        next_token = str(index+1) if index+1 < len(self.pages) else None
+        return kubernetes_client.V1PodList(items=[kubernetes_client.V1Pod(metadata=kubernetes_client.V1ObjectMeta(name=name))
+                                                  for name in self.pages[index]],
+                                           metadata=kubernetes_client.V1ListMeta(_continue=next_token))
+
+
+class IterObjectsTest(unittest.TestCase):
+
+    def _iter(self, list_func):
+        kubernetes_api = KubernetesAPI()
+        kubernetes_api._collection_funcs = lambda kind: (None, list_func)
+        return [obj.metadata.name for obj in kubernetes_api.iter_objects('pods', label_selector='opereto_pid', limit=2)]
+
+    def test_pages(self):
+        list_func = PagedList([['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(self._iter(list_func), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(list_func.calls, [None, '1', '2'])
+
+    def test_restarts_when_the_continue_token_expires(self):
+        list_func = PagedList([['a', 'b'], ['c']], errors={'1': ApiException(status=410, reason='Expired')})
+        self.assertEqual(self._iter(list_func), ['a', 'b', 'a', 'b', 'c'])
+        self.assertEqual(list_func.calls, [None, '1', None, '1'])
+
+    def test_other_errors_are_raised(self):
+        list_func = PagedList([['a', 'b'], ['c']], errors={'1': ApiException(status=500, reason='Internal')})
+        with self.assertRaises(ApiException):
+            self._iter(list_func)
+
+    def test_expired_without_continue_token_is_raised(self):
+        list_func = PagedList([['a']], errors={None: ApiException(status=410, reason='Expired')})
+        with self.assertRaises(ApiException):
+            self._iter(list_func)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_qps(self):
+        limiter = TokenBucket(qps=100, burst=3)
+        self.assertEqual([limiter.acquire() for attempt in range(3)], [0, 0, 0])
+        self.assertGreater(limiter.acquire(), 0)
+
+    def test_configure_caps_the_available_tokens(self):
+        limiter = TokenBucket(qps=100, burst=10)
+        limiter.configure(100, 1)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertGreater(limiter.acquire(), 0)
+
+
+class SubsetOfTest(unittest.TestCase):
+
+    def test_dicts(self):
+        self.assertTrue(_subset_of({'a': 1}, {'a': 1, 'b': 2}))
+        self.assertFalse(_subset_of({'a': 1, 'c': 3}, {'a': 1, 'b': 2}))
+        self.assertFalse(_subset_of({'a': {'b': 1}}, {'a': None}))
+
+    def test_lists_of_objects_allow_added_items(self):
+        ## e.g. the service account token volume added by admission
+        desired = {'volumes': [{'name': 'config'}]}
+        self.assertTrue(_subset_of(desired, {'volumes': [{'name': 'token'}, {'name': 'config', 'configMap': {'name': 'x'}}]}))
+        self.assertFalse(_subset_of(desired, {'volumes': [{'name': 'token'}]}))
+
+    def test_lists_of_values_must_be_equal(self):
+        self.assertTrue(_subset_of({'command': ['sh', '-c']}, {'command': ['sh', '-c']}))
+        self.assertFalse(_subset_of({'command': ['sh', '-c']}, {'command': ['sh', '-c', 'true']}))
+
+
+class NoLimit(object):
+
+    def acquire(self):
+        return 0
+
+
+class CountingMetrics(object):
+
+    def __init__(self):
+        self.retries = 0
+
+    def record_retry(self, name):
+        self.retries += 1
+
+    def record_throttled(self, name):
+        pass
+
+
+class FlakyApi(object):
+    """
+    API group stub whose calls fail with the given errors (in order) before succeeding.
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def read_namespaced_config_map(self, name, namespace, **kwargs):
+        self._call()
+        return 'result'
+
+    def create_namespaced_config_map(self, namespace, body, **kwargs):
+        self._call()
+        return 'created'
+
+    def delete_namespaced_config_map(self, name, namespace, **kwargs):
+        self._call()
+        return 'deleted'
+
+
+class ResilientApiTest(unittest.TestCase):
+
+    def _api(self, flaky, retries=3):
+        self.metrics = CountingMetrics()
+        api_client = kubernetes_client.ApiClient(kubernetes_client.Configuration())
+        return ResilientApi(flaky, api_client, NoLimit(), self.metrics, retries=retries, base_delay=0, max_delay=0)
+
+    def test_retries_transient_errors(self):
+        flaky = FlakyApi([ApiException(status=503), ApiException(status=429), ProtocolError('Connection aborted.')])
+        self.assertEqual(self._api(flaky).read_namespaced_config_map('name', 'default'), 'result')
+        self.assertEqual((flaky.calls, self.metrics.retries), (4, 3))
+
+    def test_does_not_retry_client_errors(self):
+        flaky = FlakyApi([ApiException(status=400)])
+        with self.assertRaises(ApiException):
+            self._api(flaky).read_namespaced_config_map('name', 'default')
+        self.assertEqual(flaky.calls, 1)
+
+    def test_gives_up_after_the_retries(self):
+        flaky = FlakyApi([ApiException(status=500)] * 3)
+        with self.assertRaises(ApiException):
+            self._api(flaky, retries=2).read_namespaced_config_map('name', 'default')
+        self.assertEqual(flaky.calls, 3)
+
+    def test_no_retries(self):
+        flaky = FlakyApi([ProtocolError('Connection aborted.')])
+        with self.assertRaises(ProtocolError):
+            self._api(flaky, retries=0).read_namespaced_config_map('name', 'default')
+        self.assertEqual(flaky.calls, 1)
+
+    def _retried_create(self, existing):
+        ## the first attempt was applied but its response was lost
+        flaky = FlakyApi([ApiException(status=504), ApiException(status=409)])
+        flaky.read_namespaced_config_map = lambda name, namespace: existing
+        body = {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'config', 'labels': {'opereto_pid': 'pid'}},
+                'data': {'file': 'content'}}
+        return self._api(flaky).create_namespaced_config_map('default', body=body)
+
+    def test_retried_create_of_a_matching_object(self):
+        existing = {'metadata': {'name': 'config', 'labels': {'opereto_pid': 'pid'}, 'uid': 'uid'}, 'data': {'file': 'content'}}
+        self.assertEqual(self._retried_create(existing), existing)
+
+    def test_retried_create_of_a_different_object(self):
+        existing = {'metadata': {'name': 'config', 'labels': {'opereto_pid': 'other'}}, 'data': {'file': 'content'}}
+        with self.assertRaises(ApiException):
+            self._retried_create(existing)
+
+    def test_retried_delete_of_a_deleted_object(self):
+        flaky = FlakyApi([ApiException(status=502), ApiException(status=404)])
+        self.assertIsNone(self._api(flaky).delete_namespaced_config_map('config', 'default'))
+
+    def test_not_found_on_first_delete_is_raised(self):
+        flaky = FlakyApi([ApiException(status=404)])
+        with self.assertRaises(ApiException):
+            self._api(flaky).delete_namespaced_config_map('config', 'default')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+services_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services')
+sys.path.insert(0, os.path.join(services_dir, 'kubernetes_task_runner'))
+sys.path.insert(0, services_dir)
+
+from kubernetes_task_runner.run import ServiceRunner, SHARED_CONFIGMAP_PREFIX
+
+
+def _runner(pid, config_files, config_maps_mode=None):
+    ## no Kubernetes API and no task state: planning must not create anything
+    runner = ServiceRunner.__new__(ServiceRunner)
+    runner.input = {'pid': pid, 'pod_config_files': config_files, 'config_maps_mode': config_maps_mode}
+    runner.config_maps = {}
+    return runner
+
+
+CONFIG_FILES = [
+    {'name': 'app.conf', 'target': '/etc/app', 'data': 'debug = true'},
+    {'name': 'settings.yaml', 'target': '/etc/settings', 'data': {'workers': 4}}
+]
+
+
+class PlanConfigMapsTest(unittest.TestCase):
+
+    def test_per_file(self):
+        runner = _runner('Pid_1', CONFIG_FILES)
+        planned = runner._plan_config_maps()
+        self.assertEqual([(name, state_key) for name, state_key, _ in planned],
+                         [('app-conf-pid-1', 'configmap'), ('settings-yaml-pid-1', 'configmap')])
+        self.assertEqual(planned[0][2], {'config_data': {'app.conf': 'debug = true'}, 'labels': {'opereto_pid': 'Pid_1'}})
+        self.assertEqual(planned[1][2]['config_data'], {'settings.yaml': 'workers: 4\n'})
+        self.assertEqual(runner.config_maps['settings-yaml-pid-1'], {'mounts': [{'target': '/etc/settings'}]})
+
+    def test_single(self):
+        runner = _runner('Pid_1', CONFIG_FILES, config_maps_mode='single')
+        planned = runner._plan_config_maps()
+        self.assertEqual(len(planned), 1)
+        name, state_key, kwargs = planned[0]
+        self.assertEqual((name, state_key), ('task-config-pid-1', 'configmap'))
+        self.assertEqual(sorted(kwargs['config_data']), ['app.conf', 'settings.yaml'])
+        self.assertEqual(runner.config_maps[name]['mounts'], [
+            {'target': '/etc/app/app.conf', 'sub_path': 'app.conf'},
+            {'target': '/etc/settings/settings.yaml', 'sub_path': 'settings.yaml'}
+        ])
+
+    def test_shared_immutable_is_content_addressed(self):
+        first = _runner('pid1', CONFIG_FILES, config_maps_mode='shared_immutable')._plan_config_maps()
+        second = _runner('pid2', CONFIG_FILES, config_maps_mode='shared_immutable')._plan_config_maps()
+        self.assertEqual([name for name, _, _ in first], [name for name, _, _ in second])
+        for name, state_key, kwargs in first:
+            self.assertTrue(name.startswith(SHARED_CONFIGMAP_PREFIX))
+            self.assertEqual(state_key, 'shared_configmap')
+            self.assertNotIn('opereto_pid', kwargs['labels'])
+
+        changed = [dict(CONFIG_FILES[0], data='debug = false')]
+        third = _runner('pid1', changed, config_maps_mode='shared_immutable')._plan_config_maps()
+        self.assertNotEqual(third[0][0], first[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
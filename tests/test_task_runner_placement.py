@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+services_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services')
+sys.path.insert(0, os.path.join(services_dir, 'kubernetes_task_runner'))
+sys.path.insert(0, services_dir)
+
+from opereto.exceptions import OperetoRuntimeError
+from placement import TaskPlacement, target_key
+
+
+class StaticPlacement(TaskPlacement):
+    """
+    TaskPlacement probing the given headroom per target key (None for an unreachable target).
+    """
+
+    def __init__(self, headroom, probes, **kwargs):
+        TaskPlacement.__init__(self, [{'namespace': key} for key in sorted(headroom)], **kwargs)
+        self.headroom = headroom
+        self.probes = probes
+
+    def _headroom(self, target):
+        self.probes.append(target['namespace'])
+        headroom = self.headroom[target['namespace']]
+        return dict(headroom) if headroom is not None else None
+
+
+def _pod_template(cpu='1', memory='1Gi'):
+    return {'spec': {'containers': [{'name': 'task', 'resources': {'requests': {'cpu': cpu, 'memory': memory}}}]}}
+
+
+class TaskPlacementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'placement.json')
+        self.probes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _placement(self, headroom, cache_ttl=60):
+        return StaticPlacement(headroom, self.probes, cache_path=self.cache_path, cache_ttl=cache_ttl)
+
+    def _cached_headroom(self, namespace):
+        with open(self.cache_path) as cache_file:
+            return json.load(cache_file)[target_key({'namespace': namespace})]['headroom']
+
+    def test_score(self):
+        requests = {'cpu': 2.0, 'memory': 1024.0, 'pods': 1.0}
+        self.assertEqual(TaskPlacement._score({'cpu': 4.0, 'memory': 1024.0, 'pods': 10.0}, requests), (1.0, True))
+        self.assertEqual(TaskPlacement._score({'cpu': 1.0, 'pods': 10.0}, requests), (0.5, False))
+        ## unknown dimensions do not limit the placement
+        self.assertEqual(TaskPlacement._score({}, requests), (float('inf'), True))
+
+    def test_reservations_spread_tasks(self):
+        headroom = {'a': {'cpu': 4.0, 'pods': 10.0}, 'b': {'cpu': 2.0, 'pods': 10.0}}
+        self.assertEqual(self._placement(headroom).choose(_pod_template())['namespace'], 'a')
+        self.assertEqual(self._placement(headroom).choose(_pod_template())['namespace'], 'a')
+        self.assertEqual(self._cached_headroom('a'), {'cpu': 2.0, 'pods': 8.0})
+        ## the cached headroom is shared and only probed once per cache_ttl
+        self.assertEqual(sorted(self.probes), ['a', 'b'])
+
+    def test_expired_headroom_is_probed_again(self):
+        headroom = {'a': {'cpu': 4.0}}
+        self._placement(headroom, cache_ttl=-1).choose(_pod_template())
+        self._placement(headroom, cache_ttl=-1).choose(_pod_template())
+        self.assertEqual(self.probes, ['a', 'a'])
+        self.assertEqual(self._cached_headroom('a'), {'cpu': 3.0})
+
+    def test_least_loaded_target_when_nothing_fits(self):
+        headroom = {'a': {'cpu': 0.5}, 'b': {'cpu': 0.25}}
+        self.assertEqual(self._placement(headroom).choose(_pod_template())['namespace'], 'a')
+
+    def test_unreachable_targets_are_skipped_and_cached(self):
+        headroom = {'a': None, 'b': {'cpu': 1.0}}
+        self.assertEqual(self._placement(headroom).choose(_pod_template())['namespace'], 'b')
+        self.assertEqual(self._placement(headroom).choose(_pod_template())['namespace'], 'b')
+        self.assertEqual(sorted(self.probes), ['a', 'b'])
+
+    def test_no_reachable_target(self):
+        with self.assertRaises(OperetoRuntimeError):
+            self._placement({'a': None}).choose(_pod_template())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+
+services_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services')
+sys.path.insert(0, os.path.join(services_dir, 'kubernetes_task_runner'))
+sys.path.insert(0, services_dir)
+
+from kubernetes.client.rest import ApiException
+from preflight import preflight, normalized_template_hash, TemplateVerdictCache
+
+
+class DryRunApi(object):
+    """
+    KubernetesAPI stub whose dry runs fail with the given error, if any, and are counted.
+    """
+
+    def __init__(self, error=None, namespace='default', context=None):
+        self.error = error
+        self.namespace = namespace
+        self.context = context
+        self.dry_runs = []
+
+    def _dry_run(self, kind):
+        self.dry_runs.append(kind)
+        if self.error is not None:
+            raise self.error
+
+    def dry_run_pod(self, pod_manifest):
+        self._dry_run('pod')
+
+    def dry_run_job(self, job_manifest):
+        self._dry_run('job')
+
+
+def _api_error(status, message):
+    error = ApiException(status=status, reason='Error')
+    error.body = '{{"message": "{}"}}'.format(message)
+    return error
+
+
+def _pod_template(pid):
+    return {'metadata': {'name': 'task', 'labels': {'opereto_pid': pid}},
+            'spec': {'volumes': [{'name': 'config', 'configMap': {'name': 'app-conf-'+pid.lower()}}]}}
+
+
+class PreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = TemplateVerdictCache(path=os.path.join(self.temp_dir, 'preflight.json'), ttl=60, max_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_hash_ignores_the_pid_but_not_the_target(self):
+        api = DryRunApi()
+        self.assertEqual(normalized_template_hash(_pod_template('Pid1'), 'Pid1', api),
+                         normalized_template_hash(_pod_template('Pid2'), 'Pid2', api))
+        self.assertNotEqual(normalized_template_hash(_pod_template('Pid1'), 'Pid1', api),
+                            normalized_template_hash(_pod_template('Pid1'), 'Pid1', DryRunApi(namespace='other')))
+
+    def test_valid_verdict_is_cached(self):
+        api = DryRunApi()
+        verdict = preflight(api, _pod_template('pid1'), 'pid1', self.cache)
+        self.assertEqual((verdict['valid'], verdict['error'], verdict['cached']), (True, None, False))
+        verdict = preflight(api, _pod_template('pid2'), 'pid2', self.cache)
+        self.assertEqual((verdict['valid'], verdict['cached']), (True, True))
+        self.assertEqual(api.dry_runs, ['pod'])
+
+    def test_invalid_verdict_is_cached(self):
+        api = DryRunApi(_api_error(422, 'spec.containers: Required value'))
+        for pid in ['pid1', 'pid2']:
+            verdict = preflight(api, _pod_template(pid), pid, self.cache)
+            self.assertEqual((verdict['valid'], verdict['error']), (False, 'spec.containers: Required value'))
+        self.assertEqual(api.dry_runs, ['pod'])
+
+    def test_forbidden_and_server_errors_are_not_cached(self):
+        for status, valid in [(403, False), (500, None)]:
+            api = DryRunApi(_api_error(status, 'error'))
+            for pid in ['pid1', 'pid2']:
+                self.assertEqual(preflight(api, _pod_template(pid), pid, self.cache)['valid'], valid)
+            self.assertEqual(api.dry_runs, ['pod', 'pod'])
+
+    def test_job_manifest_is_dry_run_as_a_job(self):
+        api = DryRunApi()
+        job_manifest = {'kind': 'Job', 'metadata': {'name': 'task-job'}, 'spec': {'template': _pod_template('pid1')}}
+        preflight(api, job_manifest, 'pid1', self.cache)
+        self.assertEqual(api.dry_runs, ['job'])
+
+    def test_cache_expiry_size_and_mode(self):
+        self.cache.put('a', {'valid': True, 'error': None})
+        self.cache.put('b', {'valid': True, 'error': None})
+        self.cache.put('c', {'valid': False, 'error': 'invalid'})
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('c')['error'], 'invalid')
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache.path).st_mode), 0o600)
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.get('c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+services_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services')
+sys.path.insert(0, os.path.join(services_dir, 'kubernetes_task_runner'))
+sys.path.insert(0, services_dir)
+
+from resource_profile import ProfileStore, template_hash, percentile
+
+
+def _pod_template(resources=None):
+    container = {'name': 'task', 'image': 'task:1'}
+    if resources is not None:
+        container['resources'] = resources
+    return {'spec': {'containers': [container, {'name': 'sidecar', 'image': 'sidecar:1'}]}}
+
+
+class ProfileStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = ProfileStore(path=os.path.join(self.temp_dir, 'profiles.json'), max_samples=5, max_templates=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _add_runs(self, profile_key, cpu, memory):
+        for cpu_peak, memory_peak in zip(cpu, memory):
+            self.store.add(profile_key, {'task': {'cpu': cpu_peak, 'memory': memory_peak}})
+
+    def test_template_hash_ignores_resources(self):
+        self.assertEqual(template_hash(_pod_template()), template_hash(_pod_template({'requests': {'cpu': '1'}})))
+
+    def test_percentile(self):
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 90), 5)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+
+    def test_keeps_the_last_samples_and_templates(self):
+        self._add_runs('a', range(1, 8), range(1, 8))
+        self.assertEqual(self.store.get('a')['task']['cpu'], [3, 4, 5, 6, 7])
+        self.store.add('b', {'task': {'cpu': 1}})
+        with open(self.store.path) as store_file:
+            profiles = json.load(store_file)
+        profiles['a']['updated'] -= 10
+        with open(self.store.path, 'w') as store_file:
+            json.dump(profiles, store_file)
+        self.store.add('c', {'task': {'cpu': 1}})
+        self.assertEqual(self.store.get('a'), {})
+        self.assertNotEqual(self.store.get('b'), {})
+
+    def test_auto_size(self):
+        self._add_runs('a', [0.5, 0.9, 0.7, 1.0, 0.6], [2**30, 2**29, 2**29, 2**29, 2**29])
+        pod_template = _pod_template()
+        sized = self.store.auto_size('a', pod_template, percent=90, margin=20)
+        self.assertEqual(sized, {'task': {'cpu': '1200m', 'memory': '1229Mi'}})
+        self.assertEqual(pod_template['spec']['containers'][0]['resources']['requests'], sized['task'])
+        self.assertNotIn('resources', pod_template['spec']['containers'][1])
+
+    def test_auto_size_is_capped_by_limits(self):
+        self._add_runs('a', [2.0, 2.0, 2.0], [2**30, 2**30, 2**30])
+        pod_template = _pod_template({'limits': {'cpu': '1500m'}})
+        self.assertEqual(self.store.auto_size('a', pod_template)['task']['cpu'], '1500m')
+
+    def test_auto_size_needs_min_samples(self):
+        self._add_runs('a', [2.0, 2.0], [2**30, 2**30])
+        pod_template = _pod_template({'requests': {'cpu': '100m'}})
+        self.assertEqual(self.store.auto_size('a', pod_template, min_samples=3), {})
+        self.assertEqual(pod_template['spec']['containers'][0]['resources']['requests'], {'cpu': '100m'})
+
+
+if __name__ == '__main__':
+    unittest.main()